@@ -0,0 +1,485 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script measures how the preparation of testing trees
+# (see prepare_testing.py) scales with the size of the tree.
+#
+# Synthetic testing trees of different sizes are generated
+# (see testing_tree_generator.py) and the phases
+#
+# - setup_testing_tree
+# - determine_unique_firmware_builds
+# - export_as_cmake
+#
+# are timed for every tree. Every measurement runs in a fresh
+# interpreter process, i.e. the peak memory (maximum resident set size)
+# of the process can be recorded as well. The fastest of several
+# repetitions is reported.
+#
+# Results can be stored as a baseline (command line option
+# --write_baseline) and later runs are compared to the baseline.
+# A regression is reported if
+#
+# - a phase takes longer than the baseline by more than a tolerance
+#   factor (command line option --tolerance),
+# - the peak memory exceeds the baseline by more than a tolerance
+#   factor (command line option --memory_tolerance), or
+# - the scaling exponent of a phase between two consecutive tree
+#   sizes, i.e. log(t2/t1)/log(n2/n1), exceeds the baseline's
+#   exponent (command line option --scaling_tolerance).
+#
+# Absolute times depend on the machine the baseline was recorded on.
+# Scaling exponents do not, i.e. they catch e.g. a linear algorithm
+# that became quadratic on any machine.
+#
+# The exit status is 1 if a regression was detected.
+
+import argparse
+import sys
+import os
+import json
+import math
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
+
+import testing_tree_generator
+
+try:
+   import resource
+except ImportError:
+   resource = None
+
+# The benchmark cases in order of increasing tree size.
+#
+benchmark_cases = [
+   ("small",  testing_tree_generator.TreeParameters(depth = 3, fan_out = 10)),
+   ("medium", testing_tree_generator.TreeParameters(depth = 4, fan_out = 10)),
+   ("large",  testing_tree_generator.TreeParameters(depth = 5, fan_out = 10))
+]
+
+default_cases = ["small", "medium"]
+
+benchmark_phases = [ "setup_testing_tree",
+                     "determine_unique_firmware_builds",
+                     "export_as_cmake" ]
+
+default_baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     "benchmark_baseline.json")
+
+# Differences below this time (in seconds) are considered noise
+#
+min_time_difference = 0.01
+
+def peak_memory_kb():
+
+   if resource is None:
+      return None
+
+   # Linux reports kilobytes, macOS bytes
+   #
+   max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   if sys.platform == "darwin":
+      max_rss //= 1024
+
+   return max_rss
+
+# Trees are cached in the work directory under a name that
+# depends on their parameters.
+#
+def tree_directory(work_dir, case_name, parameters):
+
+   key = hashlib.sha256(json.dumps(parameters.toDict(),
+                                   sort_keys = True).encode('utf-8'))
+
+   return os.path.join(work_dir, "%s-%s" % (case_name, key.hexdigest()[:12]))
+
+def ensure_tree(work_dir, case_name, parameters):
+
+   tree_root = tree_directory(work_dir, case_name, parameters)
+
+   if os.path.isdir(tree_root):
+      return tree_root
+
+   # Generate to a temporary directory first, i.e. an interrupted
+   # generation is never reused.
+   #
+   tmp_root = tree_root + ".tmp"
+   shutil.rmtree(tmp_root, ignore_errors = True)
+
+   sys.stdout.write("Generating %s testing tree (%d directories)\n"
+      % (case_name, parameters.getNumDirectories()))
+   sys.stdout.flush()
+
+   testing_tree_generator.generate_testing_tree(tmp_root, parameters)
+   os.rename(tmp_root, tree_root)
+
+   return tree_root
+
+# Runs the benchmarked phases on a tree. This is executed in a
+# fresh interpreter process.
+#
+def measure(tree_root, output_dir, connection):
+
+   import time
+   import prepare_testing
+
+   # Suppress the progress output of prepare_testing.py
+   #
+   sys.stdout = open(os.devnull, "w")
+
+   times = {}
+
+   start = time.perf_counter()
+   test_nodes_by_path = prepare_testing.setup_testing_tree(tree_root)
+   times["setup_testing_tree"] = time.perf_counter() - start
+
+   start = time.perf_counter()
+   unique_firmware_builds_by_digest \
+      = prepare_testing.determine_unique_firmware_builds(test_nodes_by_path)
+   times["determine_unique_firmware_builds"] = time.perf_counter() - start
+
+   start = time.perf_counter()
+   prepare_testing.export_as_cmake(os.path.join(output_dir, "tests.cmake"),
+                                   test_nodes_by_path,
+                                   unique_firmware_builds_by_digest)
+   times["export_as_cmake"] = time.perf_counter() - start
+
+   n_tests = sum(1 for test_node in test_nodes_by_path.values()
+                 if test_node.generatesTests())
+
+   connection.send({ "phases" : times,
+                     "nodes" : len(test_nodes_by_path),
+                     "tests" : n_tests,
+                     "firmware_builds" : len(unique_firmware_builds_by_digest),
+                     "peak_memory_kb" : peak_memory_kb() })
+   connection.close()
+
+def run_case(tree_root, output_dir, repeats):
+
+   context = multiprocessing.get_context("spawn")
+
+   result = None
+
+   for repetition in range(repeats):
+
+      receiver, sender = context.Pipe(duplex = False)
+
+      process = context.Process(target = measure,
+                                args = (tree_root, output_dir, sender))
+      process.start()
+      sender.close()
+
+      try:
+         measurement = receiver.recv()
+      except EOFError:
+         measurement = None
+
+      process.join()
+
+      if measurement is None:
+         sys.exit("Benchmark of testing tree \"%s\" failed (exit code %s)"
+            % (tree_root, process.exitcode))
+
+      if result is None:
+         result = measurement
+         continue
+
+      for phase, duration in measurement["phases"].items():
+         result["phases"][phase] = min(result["phases"][phase], duration)
+
+      if measurement["peak_memory_kb"] is not None:
+         result["peak_memory_kb"] = max(result["peak_memory_kb"],
+                                        measurement["peak_memory_kb"])
+
+   return result
+
+# Computes the scaling exponents of all phases between consecutive
+# cases
+#
+def scaling_exponents(results, case_names):
+
+   exponents = {}
+
+   for previous_name, name in zip(case_names, case_names[1:]):
+
+      if not previous_name in results or not name in results:
+         continue
+
+      previous = results[previous_name]
+      current = results[name]
+
+      if current["nodes"] <= previous["nodes"]:
+         continue
+
+      node_ratio = math.log(float(current["nodes"]) / previous["nodes"])
+
+      for phase in benchmark_phases:
+
+         previous_time = previous["phases"][phase]
+         current_time = current["phases"][phase]
+
+         if previous_time <= 0.0 or current_time <= 0.0:
+            continue
+
+         exponents["%s/%s:%s" % (previous_name, name, phase)] \
+            = math.log(current_time / previous_time) / node_ratio
+
+   return exponents
+
+def compare_to_baseline(results, baseline, case_names,
+                        tolerance, memory_tolerance, scaling_tolerance):
+
+   regressions = []
+
+   baseline_results = baseline.get("cases", {})
+
+   for name in case_names:
+
+      if not name in baseline_results:
+         sys.stdout.write("No baseline for case %s\n" % name)
+         continue
+
+      current = results[name]
+      reference = baseline_results[name]
+
+      if current["nodes"] != reference["nodes"] \
+            or current["firmware_builds"] != reference["firmware_builds"]:
+         regressions.append(
+            "%s: the testing tree differs from the baseline's tree "
+            "(%d nodes, %d firmware builds instead of %d and %d). "
+            "Please record a new baseline"
+            % (name, current["nodes"], current["firmware_builds"],
+               reference["nodes"], reference["firmware_builds"]))
+         continue
+
+      for phase in benchmark_phases:
+
+         current_time = current["phases"][phase]
+         reference_time = reference["phases"][phase]
+
+         if current_time > reference_time * tolerance \
+               and current_time - reference_time > min_time_difference:
+            regressions.append(
+               "%s: %s took %.3f s instead of %.3f s"
+               % (name, phase, current_time, reference_time))
+
+      if current["peak_memory_kb"] and reference.get("peak_memory_kb") \
+            and current["peak_memory_kb"] \
+                  > reference["peak_memory_kb"] * memory_tolerance:
+         regressions.append(
+            "%s: peak memory %d kB instead of %d kB"
+            % (name, current["peak_memory_kb"], reference["peak_memory_kb"]))
+
+   exponents = scaling_exponents(results, case_names)
+   reference_exponents = scaling_exponents(baseline_results, case_names)
+
+   for key, exponent in sorted(exponents.items()):
+
+      reference_exponent = reference_exponents.get(key)
+
+      if reference_exponent is None:
+         continue
+
+      if exponent > reference_exponent + scaling_tolerance:
+         regressions.append(
+            "%s scales with exponent %.2f instead of %.2f"
+            % (key, exponent, reference_exponent))
+
+   return regressions
+
+def report_results(results, case_names, file = sys.stdout):
+
+   file.write("%-8s %8s %8s %8s" % ("case", "nodes", "tests", "builds"))
+   for phase in benchmark_phases:
+      file.write(" %12s" % phase[:12])
+   file.write(" %10s\n" % "peak [kB]")
+
+   for name in case_names:
+
+      result = results[name]
+
+      file.write("%-8s %8d %8d %8d" % (name, result["nodes"],
+                                       result["tests"],
+                                       result["firmware_builds"]))
+      for phase in benchmark_phases:
+         file.write(" %10.3f s" % result["phases"][phase])
+      file.write(" %10s\n" % result["peak_memory_kb"])
+
+   for key, exponent in sorted(scaling_exponents(results,
+                                                 case_names).items()):
+      file.write("Scaling exponent %s: %.2f\n" % (key, exponent))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool measures how the preparation of testing trees "
+       "scales with the size of the tree and compares the results "
+       "to a stored baseline.")
+
+    case_names = [name for name, parameters in benchmark_cases]
+
+    parser.add_argument('--cases',
+      metavar  = 'case',
+      dest     = 'cases',
+      nargs    = '+',
+      choices  = case_names,
+      default  = default_cases,
+      help     = 'The benchmark cases to run (%s, default: %s)'
+                    % (", ".join(case_names), " ".join(default_cases))
+    )
+
+    parser.add_argument('-r', '--repeats',
+      metavar  = 'N',
+      dest     = 'repeats',
+      type     = int,
+      default  = 3,
+      help     = 'The number of repetitions of every case '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('-w', '--work_dir',
+      metavar  = 'path',
+      dest     = 'work_dir',
+      help     = 'A directory where generated testing trees are kept '
+                 'between runs (default: a temporary directory)'
+    )
+
+    parser.add_argument('-b', '--baseline',
+      metavar  = 'file',
+      dest     = 'baseline',
+      default  = default_baseline_file,
+      help     = 'The baseline file (default: %(default)s)'
+    )
+
+    parser.add_argument('--write_baseline',
+      dest     = 'write_baseline',
+      action   = 'store_true',
+      help     = 'Store the results as the new baseline instead of '
+                 'comparing them'
+    )
+
+    parser.add_argument('--tolerance',
+      metavar  = 'factor',
+      dest     = 'tolerance',
+      type     = float,
+      default  = 1.5,
+      help     = 'The factor a phase may be slower than the baseline '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--memory_tolerance',
+      metavar  = 'factor',
+      dest     = 'memory_tolerance',
+      type     = float,
+      default  = 1.25,
+      help     = 'The factor the peak memory may exceed the baseline '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--scaling_tolerance',
+      metavar  = 'exponent',
+      dest     = 'scaling_tolerance',
+      type     = float,
+      default  = 0.3,
+      help     = 'The amount a scaling exponent may exceed the '
+                 'baseline (default: %(default)s)'
+    )
+
+    parser.add_argument('--results',
+      metavar  = 'file',
+      dest     = 'results',
+      help     = 'An output file for the results in JSON format'
+    )
+
+    args = parser.parse_args()
+
+    # Run the cases in order of increasing size
+    #
+    selected_cases = [(name, parameters) for name, parameters
+                      in benchmark_cases if name in args.cases]
+    selected_names = [name for name, parameters in selected_cases]
+
+    work_dir = args.work_dir
+    if work_dir:
+       os.makedirs(work_dir, exist_ok = True)
+    else:
+       work_dir = tempfile.mkdtemp(prefix = "leidokos_benchmark_")
+
+    results = {}
+
+    try:
+       output_dir = tempfile.mkdtemp(dir = work_dir)
+
+       for name, parameters in selected_cases:
+
+          tree_root = ensure_tree(work_dir, name, parameters)
+
+          sys.stdout.write("Running %s benchmark\n" % name)
+          sys.stdout.flush()
+
+          results[name] = run_case(tree_root, output_dir, args.repeats)
+          results[name]["parameters"] = parameters.toDict()
+
+       shutil.rmtree(output_dir, ignore_errors = True)
+    finally:
+       if not args.work_dir:
+          shutil.rmtree(work_dir, ignore_errors = True)
+
+    report_results(results, selected_names)
+
+    if args.results:
+       with open(args.results, "w") as stream:
+          json.dump({ "cases" : results }, stream, indent = 1,
+                    sort_keys = True)
+          stream.write("\n")
+
+    if args.write_baseline:
+       with open(args.baseline, "w") as stream:
+          json.dump({ "cases" : results }, stream, indent = 1,
+                    sort_keys = True)
+          stream.write("\n")
+       sys.stdout.write("Baseline written to file \"%s\"\n" % args.baseline)
+       return
+
+    if not os.path.exists(args.baseline):
+       sys.stdout.write("No baseline file \"%s\" found\n" % args.baseline)
+       return
+
+    with open(args.baseline, "r") as stream:
+       baseline = json.load(stream)
+
+    regressions = compare_to_baseline(results, baseline, selected_names,
+                                      args.tolerance,
+                                      args.memory_tolerance,
+                                      args.scaling_tolerance)
+
+    if regressions:
+       for regression in regressions:
+          sys.stdout.write("Regression: %s\n" % regression)
+       sys.exit(1)
+
+    sys.stdout.write("No regressions compared to the baseline\n")
+
+if __name__ == "__main__":
+    main()
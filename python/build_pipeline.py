@@ -0,0 +1,747 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script builds the firmwares of a JSON build graph
+# (see prepare_testing.py, command line option --json_build_graph)
+# and runs their tests in a single pipeline.
+#
+# When firmwares are build by the build system and tests are run
+# afterwards (e.g. by CTest or test_runner.py), no test starts before
+# the slowest firmware build finished. Here, every firmware build is
+# a producer and the tests that use it are its consumers. As soon as
+# a firmware build succeeded, its tests are handed to a pool of test
+# workers (see test_runner.py) while other firmwares are still being
+# build. The overall time thus approaches the time of the longest
+# firmware build plus the time of its tests instead of the time of all
+# firmware builds plus the time of all tests.
+#
+# Firmware builds are started in the order of decreasing cost,
+# i.e. the duration of the firmware build plus the durations of
+# all its tests. Costs are read from a timing history (command line
+# option --timing_history, see timing_history.py) or a JSON file in the
+# format of the shard costs of prepare_testing.py (command line
+# option --costs). Firmware builds and tests without a recorded cost
+# are assigned the default estimates of prepare_testing.py.
+#
+# Firmware builds are run through the build scripts that CMake
+# generates in the build directory. If the firmware builds of a module
+# set share a build tree (command line option --module_set_builds),
+# at most one firmware build of every module set runs at a time.
+#
+# *** Job slots and memory ***
+#
+# All firmware builds share the job slots of a single jobserver (see
+# jobserver.py), i.e. the makes that compile the firmwares run as many
+# compiler jobs as there are free slots altogether instead of every
+# build running its own number of jobs (command line option
+# --build_slots, default: number of CPUs). Every running firmware build
+# holds one slot. If the pipeline is run by a make that provides a
+# jobserver (e.g. make -j64 pipeline), its slots are shared instead.
+#
+# Every compiler process can be restricted to a maximum amount of
+# memory (command line option --memory_limit). The number of slots is
+# then reduced to the number of compiler processes that fit into the
+# physical memory. A compile that exceeds the limit fails instead of
+# exhausting the memory of the machine.
+#
+# After all firmwares were build, the usage of the job slots is
+# reported, i.e. the CPU time of all firmware builds relative to the
+# CPU time that the slots provided, the average and maximum number of
+# concurrent firmware builds, the time firmware builds waited for a
+# free slot and the peak memory of a single process.
+#
+# The durations of firmware builds and the results of all tests can
+# be written to a JSON file (command line option --results) and
+# recorded in the timing history.
+
+import argparse
+import sys
+import os
+import json
+import time
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+
+import prepare_testing
+import test_runner
+import timing_history
+import jobserver
+
+try:
+   import resource
+except ImportError:
+   resource = None
+
+# The interval (in seconds) in which running firmware builds are
+# checked for completion
+#
+poll_interval = 0.05
+
+# A firmware build of the build graph and the tests that use it
+#
+class FirmwareBuildJob(object):
+
+   def __init__(self, firmware_build, tests, cost):
+
+      self.build_id = firmware_build["build_id"]
+      self.digest = firmware_build["digest"]
+      self.module_set_id = firmware_build.get("module_set_id")
+      self.tests = tests
+
+      # The estimated duration of the firmware build and all its tests
+      #
+      self.cost = cost
+
+      self.process = None
+      self.token = None
+      self.start_time = None
+      self.duration = 0.0
+      self.exit_code = None
+
+      # The CPU time and the peak memory of the firmware build
+      # and all its child processes
+      #
+      self.cpu_time = 0.0
+      self.peak_memory_kb = None
+
+# Collects the usage of the job slots by firmware builds
+#
+class BuildSlotUsage(object):
+
+   def __init__(self, slots):
+
+      # The number of job slots or None if unknown
+      #
+      self.slots = slots
+
+      self.first_start = None
+      self.last_finish = None
+      self.last_change = None
+      self.n_running = 0
+      self.max_running = 0
+      self.running_time = 0.0
+      self.waiting_time = 0.0
+      self.cpu_time = 0.0
+      self.peak_memory_kb = None
+
+   def update(self, now, n_running):
+
+      if self.last_change is not None:
+         self.running_time += self.n_running * (now - self.last_change)
+
+      self.last_change = now
+      self.n_running = n_running
+      self.max_running = max(self.max_running, n_running)
+
+   def buildStarted(self, now, n_running):
+
+      if self.first_start is None:
+         self.first_start = now
+
+      self.update(now, n_running)
+
+   def buildFinished(self, job, now, n_running):
+
+      self.last_finish = now
+      self.update(now, n_running)
+
+      self.cpu_time += job.cpu_time
+      if job.peak_memory_kb is not None:
+         self.peak_memory_kb = max(self.peak_memory_kb or 0,
+                                   job.peak_memory_kb)
+
+   # A firmware build could have been started if a slot was available
+   #
+   def waitedForSlot(self, duration):
+      self.waiting_time += duration
+
+   def getBuildTime(self):
+
+      if self.first_start is None:
+         return 0.0
+
+      return self.last_finish - self.first_start
+
+   def toDict(self):
+      return { "slots" : self.slots,
+               "build_time" : self.getBuildTime(),
+               "cpu_time" : self.cpu_time,
+               "average_concurrent_builds" :
+                  self.running_time / (self.getBuildTime() or 1.0),
+               "max_concurrent_builds" : self.max_running,
+               "waiting_time" : self.waiting_time,
+               "peak_memory_kb" : self.peak_memory_kb }
+
+   def report(self, file = sys.stdout):
+
+      build_time = self.getBuildTime()
+      if build_time <= 0.0:
+         return
+
+      file.write("Firmware builds took %.2f s, %.2f s CPU time"
+                 % (build_time, self.cpu_time))
+      if self.slots:
+         file.write(", %.0f %% of %d job slots"
+                    % (100.0 * self.cpu_time / (self.slots * build_time),
+                       self.slots))
+      file.write("\n")
+
+      file.write("Concurrent firmware builds: %.1f on average, %d at most, "
+                 "%.2f s waited for a free job slot\n"
+                 % (self.running_time / build_time, self.max_running,
+                    self.waiting_time))
+
+      if self.peak_memory_kb:
+         file.write("Peak memory of a firmware build process: %.1f MB\n"
+                    % (self.peak_memory_kb / 1024.0))
+
+# Reads the firmware builds of a JSON build graph and assigns their
+# tests. Tests whose firmware build is not part of the graph are
+# returned separately.
+#
+# Returns a tuple (list of FirmwareBuildJob, tests without a
+# firmware build).
+#
+def read_firmware_build_jobs(json_build_graph_filename, tests, costs):
+
+   with open(json_build_graph_filename, "r") as stream:
+      build_graph = json.load(stream)
+
+   build_costs = costs.get("firmware_builds", {})
+   test_costs = costs.get("tests", {})
+
+   tests_by_build_id = {}
+   for test in tests:
+      tests_by_build_id.setdefault(test["firmware_build_id"], []).append(test)
+
+   jobs = []
+   for firmware_build in build_graph.get("firmware_builds", []):
+
+      build_tests = tests_by_build_id.pop(firmware_build["build_id"], [])
+
+      # Firmware builds that are not needed by any selected test are
+      # not build
+      #
+      if not build_tests:
+         continue
+
+      cost = build_costs.get(firmware_build["digest"],
+                             prepare_testing.default_firmware_build_cost)
+
+      for test in build_tests:
+         test_cost = test_costs.get(test["name"])
+         if test_cost is None:
+            test_cost = test_costs.get(test["digest"],
+                                       prepare_testing.default_test_cost)
+         cost += test_cost
+
+      jobs.append(FirmwareBuildJob(firmware_build, build_tests, cost))
+
+   orphaned_tests = [test for build_tests in tests_by_build_id.values()
+                     for test in build_tests]
+
+   return (jobs, orphaned_tests)
+
+# Reads recorded costs from a file, see prepare_testing.load_shard_costs
+#
+def load_costs(costs_filename, history_filename):
+
+   if costs_filename:
+      return prepare_testing.load_shard_costs(costs_filename)
+
+   if history_filename and os.path.exists(history_filename):
+      return prepare_testing.load_shard_costs(history_filename)
+
+   return {}
+
+def report_build(job, build_dir, file = sys.stdout):
+
+   status = "BUILT"
+   if job.exit_code != 0:
+      status = "FAILED"
+
+   file.write("         %-8s %8.2f s  firmware build %s\n"
+      % (status, job.duration, str(job.build_id)))
+
+   if job.exit_code != 0:
+      file.write("   See \"%s\"\n"
+         % prepare_testing.firmware_build_log_file(build_dir, job.build_id))
+
+# Returns the amount of physical memory in kB or None if unknown
+#
+def physical_memory_kb():
+
+   try:
+      return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 1024
+   except (ValueError, OSError, AttributeError):
+      return None
+
+# Limits the number of job slots to the number of processes whose
+# memory limit fits into the physical memory
+#
+def limit_slots_by_memory(slots, memory_limit_mb):
+
+   memory_kb = physical_memory_kb()
+   if not memory_limit_mb or not memory_kb:
+      return slots
+
+   return max(1, min(slots, memory_kb // (memory_limit_mb * 1024)))
+
+# Returns a function that restricts the address space of a child
+# process and of all its children to memory_limit_mb
+#
+def memory_limiter(memory_limit_mb):
+
+   if not memory_limit_mb or not resource:
+      return None
+
+   limit = memory_limit_mb * 1024 * 1024
+
+   def limit_memory():
+      resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+   return limit_memory
+
+# Checks if a firmware build process terminated. Returns its exit
+# code or None if it is still running. The CPU time and peak memory
+# of the process and all its children are stored in the job.
+#
+def poll_build(job):
+
+   if not hasattr(os, "wait4"):
+      return job.process.poll()
+
+   pid, wait_status, rusage = os.wait4(job.process.pid, os.WNOHANG)
+   if pid == 0:
+      return None
+
+   job.process.returncode = os.waitstatus_to_exitcode(wait_status)
+   job.cpu_time = rusage.ru_utime + rusage.ru_stime
+   job.peak_memory_kb = timing_history.max_rss_kb(rusage.ru_maxrss)
+
+   return job.process.returncode
+
+# Builds firmwares and runs their tests. At most build_jobs firmware
+# builds and test_jobs test workers run concurrently. The arguments
+# preload_module, leidokos_python_dir, init_script and chunk_runner
+# are those of test_runner.run_tests(...).
+#
+# If a jobserver is passed, all firmware builds use the jobserver to 
+# run their compiler jobs. One running firmware build uses the 
+# implicit job slot of this process, every other one must acquire a 
+# token of the jobserver before it is started. When the build that
+# uses the implicit slot finishes, the slot passes to the next build
+# that is started.
+# The address space of every process of a firmware build is limited
+# to memory_limit_mb, if specified. The usage of job slots is
+# collected in usage (BuildSlotUsage), if specified.
+#
+# Returns a list of test result dicts ordered like the tests of the
+# jobs. The durations and exit codes of the firmware builds are stored
+# in the jobs.
+#
+def run_pipeline(jobs, build_dir, build_jobs, test_jobs,
+                 cmake_executable = "cmake",
+                 shared_module_builds = True,
+                 preload_module = test_runner.default_preload_module,
+                 leidokos_python_dir = None,
+                 init_script = None,
+                 chunk_runner = test_runner.run_test_chunk,
+                 file = sys.stdout,
+                 jobserver = None,
+                 memory_limit_mb = None,
+                 usage = None):
+
+   usage = usage or BuildSlotUsage(None)
+
+   env = os.environ
+   pass_fds = ()
+   if jobserver:
+      env = jobserver.environment(env)
+      pass_fds = tuple(jobserver.child_fds)
+
+   preexec_fn = memory_limiter(memory_limit_mb)
+
+   n_tests = sum(len(job.tests) for job in jobs)
+
+   # Longest processing time first
+   #
+   pending_jobs = sorted(jobs, key = lambda x: (-x.cost, x.build_id))
+   running_jobs = []
+   busy_module_sets = set()
+
+   test_pool = test_runner.TestChunkPool(test_jobs, chunk_runner)
+
+   results = []
+
+   def report(result):
+      results.append(result)
+      test_runner.report_result(result, len(results), n_tests, file)
+
+   def start_build(job, token):
+
+      log_filename = prepare_testing.firmware_build_log_file(build_dir,
+                                                             job.build_id)
+      os.makedirs(os.path.dirname(log_filename), exist_ok = True)
+
+      job.token = token
+      job.start_time = time.monotonic()
+      job.process = subprocess.Popen([cmake_executable,
+         "-Dlog_file=" + log_filename,
+         "-P", prepare_testing.firmware_build_script(build_dir,
+                                                     job.build_id)],
+         stdout = subprocess.DEVNULL,
+         env = env,
+         pass_fds = pass_fds,
+         preexec_fn = preexec_fn)
+
+      running_jobs.append(job)
+      if shared_module_builds:
+         busy_module_sets.add(job.module_set_id)
+
+      usage.buildStarted(job.start_time, len(running_jobs))
+
+   def finish_build(job):
+
+      now = time.monotonic()
+      job.duration = now - job.start_time
+      job.exit_code = job.process.returncode
+      job.process = None
+
+      if job.token:
+         jobserver.release(job.token)
+         job.token = None
+
+      running_jobs.remove(job)
+      busy_module_sets.discard(job.module_set_id)
+
+      usage.buildFinished(job, now, len(running_jobs))
+
+      if job.exit_code == 0 \
+            and not os.path.exists(prepare_testing.firmware_binary(
+                                      build_dir, job.build_id)):
+         job.exit_code = 1
+
+      report_build(job, build_dir, file)
+
+      if job.exit_code != 0:
+         for test in job.tests:
+            report(test_runner.test_result(test, "not_built",
+               message = "Firmware build %s failed" % str(job.build_id)))
+         return
+
+      # Split the tests of the firmware build only as far as
+      # needed to occupy all test workers
+      #
+      test_pool.addChunks(test_runner.plan_test_chunks(job.tests,
+                                                       build_dir,
+                                                       test_jobs,
+                                                       preload_module,
+                                                       leidokos_python_dir,
+                                                       init_script))
+
+   waiting_since = None
+
+   while pending_jobs or running_jobs or not test_pool.isIdle():
+
+      # Start the most expensive firmware builds whose module set is
+      # not in use. A firmware build that is started while no 
+      # running build uses the implicit job slot of this process
+      # takes over this slot instead of acquiring a token.
+      #
+      for job in list(pending_jobs):
+         if len(running_jobs) >= build_jobs:
+            break
+         if shared_module_builds and job.module_set_id in busy_module_sets:
+            continue
+
+         token = None
+         if jobserver and any(running_job.token is None 
+                              for running_job in running_jobs):
+            token = jobserver.tryAcquire()
+            if token is None:
+               if waiting_since is None:
+                  waiting_since = time.monotonic()
+               break
+
+         if waiting_since is not None:
+            usage.waitedForSlot(time.monotonic() - waiting_since)
+            waiting_since = None
+
+         pending_jobs.remove(job)
+         start_build(job, token)
+
+      test_pool.startWorkers()
+
+      timeout = None
+      if running_jobs:
+         timeout = poll_interval
+
+      connections = test_pool.connections()
+      if connections:
+         ready = multiprocessing.connection.wait(connections, timeout)
+      else:
+         time.sleep(poll_interval)
+         ready = []
+
+      for receiver in ready:
+         for result in test_pool.receive(receiver):
+            report(result)
+
+      for job in list(running_jobs):
+         if poll_build(job) is not None:
+            finish_build(job)
+
+   return test_runner.sort_results(
+             results, [ test for job in jobs for test in job.tests ])
+
+def report_pipeline_summary(jobs, results, duration, file = sys.stdout):
+
+   test_runner.report_summary(results, duration, file)
+
+   n_failed = sum(1 for job in jobs if job.exit_code != 0)
+
+   file.write("%d of %d firmware builds succeeded\n"
+              % (len(jobs) - n_failed, len(jobs)))
+
+   build_time = sum(job.duration for job in jobs)
+   test_time = sum(result["duration"] for result in results)
+
+   file.write("Wall time %.2f s, sum of firmware build times %.2f s, "
+              "sum of test times %.2f s\n"
+              % (duration, build_time, test_time))
+
+def write_results(results_filename, jobs, results, usage = None):
+
+   firmware_builds = [ { "build_id" : job.build_id,
+                         "digest" : job.digest,
+                         "exit_code" : job.exit_code,
+                         "duration" : job.duration,
+                         "cpu_time" : job.cpu_time,
+                         "peak_memory_kb" : job.peak_memory_kb }
+                       for job in sorted(jobs, key = lambda x: x.build_id) ]
+
+   data = { "firmware_builds" : firmware_builds, "tests" : results }
+   if usage:
+      data["build_slot_usage"] = usage.toDict()
+
+   with open(results_filename, "w") as stream:
+      json.dump(data, stream, indent = 3)
+      stream.write("\n")
+
+# Records the durations of all firmware builds and the results of all
+# tests in a timing history
+#
+def record_results(history_filename, jobs, results):
+
+   with timing_history.TimingHistory(history_filename) as history:
+      for job in jobs:
+         if job.exit_code is None:
+            continue
+         history.recordBuild(job.digest, job.duration,
+                             exit_status = job.exit_code)
+
+   test_runner.record_results(history_filename, results)
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool builds the firmwares of a JSON build graph that is "
+       "generated by prepare_testing.py and runs the tests of every "
+       "firmware as soon as it is build.")
+
+    parser.add_argument('-g', '--json_build_graph',
+      metavar  = 'file',
+      dest     = 'json_build_graph',
+      required = True,
+      help     = 'The JSON build graph generated by prepare_testing.py'
+    )
+
+    parser.add_argument('-b', '--build_dir',
+      metavar  = 'path',
+      dest     = 'build_dir',
+      help     = 'The CMake build directory that contains the firmware '
+                 'build scripts (default: current directory)'
+    )
+
+    parser.add_argument('--build_slots',
+      metavar  = 'N',
+      dest     = 'build_slots',
+      type     = int,
+      default  = multiprocessing.cpu_count(),
+      help     = 'The number of job slots that all firmware builds share '
+                 'unless a jobserver of a parent make is available '
+                 '(default: number of CPUs)'
+    )
+
+    parser.add_argument('--build_jobs',
+      metavar  = 'N',
+      dest     = 'build_jobs',
+      type     = int,
+      help     = 'The maximum number of concurrent firmware builds '
+                 '(default: number of job slots)'
+    )
+
+    parser.add_argument('--memory_limit',
+      metavar  = 'MB',
+      dest     = 'memory_limit',
+      type     = int,
+      help     = 'The maximum amount of memory (address space) of every '
+                 'process of a firmware build, e.g. a compiler. The '
+                 'number of job slots is limited to the number of such '
+                 'processes that fit into the physical memory'
+    )
+
+    parser.add_argument('--no_jobserver',
+      dest     = 'no_jobserver',
+      action   = 'store_true',
+      help     = 'Do not share job slots between firmware builds'
+    )
+
+    parser.add_argument('-j', '--jobs',
+      metavar  = 'N',
+      dest     = 'jobs',
+      type     = int,
+      default  = multiprocessing.cpu_count(),
+      help     = 'The number of test worker processes '
+                 '(default: number of CPUs)'
+    )
+
+    parser.add_argument('-R', '--tests_regex',
+      metavar  = 'regex',
+      dest     = 'tests_regex',
+      help     = 'Only build the firmwares of and run the tests whose '
+                 'names match the regular expression'
+    )
+
+    parser.add_argument('--cmake_executable',
+      metavar  = 'file',
+      dest     = 'cmake_executable',
+      default  = 'cmake',
+      help     = 'The cmake executable that runs the firmware build '
+                 'scripts'
+    )
+
+    parser.add_argument('--module_set_builds',
+      dest     = 'module_set_builds',
+      choices  = ['shared', 'separate'],
+      default  = 'shared',
+      help     = 'Whether the firmware builds of a module set share a '
+                 'build tree, see prepare_testing.py '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--costs',
+      metavar  = 'file',
+      dest     = 'costs',
+      help     = 'A timing history database or a JSON file with '
+                 'recorded costs of firmware builds and tests that '
+                 'determines the order of firmware builds (default: '
+                 'the timing history)'
+    )
+
+    test_runner.add_worker_arguments(parser)
+
+    parser.add_argument('--timing_history',
+      metavar  = 'file',
+      dest     = 'timing_history',
+      help     = 'A timing history database (see timing_history.py) '
+                 'that costs are read from and the results are '
+                 'recorded in'
+    )
+
+    parser.add_argument('--results',
+      metavar  = 'file',
+      dest     = 'results',
+      help     = 'An output file with the results of firmware builds '
+                 'and tests (JSON)'
+    )
+
+    args = parser.parse_args()
+
+    build_dir = os.path.abspath(args.build_dir or os.getcwd())
+
+    preload_module, leidokos_python_dir, init_script, chunk_runner \
+       = test_runner.worker_options(args)
+
+    tests = test_runner.read_tests(args.json_build_graph, args.tests_regex)
+
+    jobs, orphaned_tests = read_firmware_build_jobs(
+                              args.json_build_graph, tests,
+                              load_costs(args.costs, args.timing_history))
+
+    build_server = None
+    if not args.no_jobserver:
+       build_server = jobserver.join_jobserver(os.environ.get("MAKEFLAGS"))
+       if not build_server:
+          build_server = jobserver.create_jobserver(
+             limit_slots_by_memory(args.build_slots, args.memory_limit))
+       sys.stdout.write("Building firmwares using the %s\n"
+                        % build_server.description)
+
+    build_jobs = args.build_jobs
+    if not build_jobs:
+       build_jobs = (build_server and build_server.slots) or args.build_slots
+
+    usage = BuildSlotUsage(build_server and build_server.slots)
+
+    start_time = time.monotonic()
+
+    try:
+       results = run_pipeline(jobs, build_dir,
+                              max(1, build_jobs),
+                              max(1, args.jobs),
+                              args.cmake_executable,
+                              args.module_set_builds == "shared",
+                              preload_module,
+                              leidokos_python_dir,
+                              init_script,
+                              chunk_runner,
+                              jobserver = build_server,
+                              memory_limit_mb = args.memory_limit,
+                              usage = usage)
+    finally:
+       if build_server:
+          build_server.close()
+
+    results += [ test_runner.test_result(test, "not_built",
+                    message = "Firmware build %s does not exist"
+                              % str(test["firmware_build_id"]))
+                 for test in orphaned_tests ]
+    results = test_runner.sort_results(results, tests)
+
+    report_pipeline_summary(jobs, results, time.monotonic() - start_time)
+    usage.report()
+
+    if args.results:
+       write_results(args.results, jobs, results, usage)
+
+    if args.timing_history:
+       record_results(args.timing_history, jobs, results)
+
+    if any(result["status"] != "passed" for result in results) \
+          or any(job.exit_code != 0 for job in jobs):
+       sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,699 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script maintains a content addressed cache of firmware
+# binaries (kaleidoscope.firmware) that can be shared between build
+# directories and CI workspaces.
+#
+# *** Cache keys ***
+#
+# Firmware binaries are stored under a key that is derived from the
+# firmware digest computed by prepare_testing.py. As firmware builds
+# may reference moving commits (e.g. origin/master), the digest is
+# combined with the commits that are actually checked out in the
+# firmware build directory (the boards repository, all its submodules
+# and all separately cloned modules) and with an optional string
+# that describes the build configuration.
+#
+# *** Backends ***
+#
+# A cache is either a local directory or the URL of an HTTP server
+# (http://...). A simple cache server that stores artifacts in
+# a local directory can be started with
+#
+#   firmware_cache.py --cache <dir> serve --port <port>
+#
+# Artifacts are published atomically. The local directory backend
+# evicts the least recently used artifacts whenever the size of
+# the cache exceeds its size limit.
+#
+# *** Build system integration ***
+#
+# The firmware build scripts generated by the CMake build system call
+#
+#   firmware_cache.py --cache <cache> restore --digest <digest> \
+#      --checkout_dir <boards dir> --target <firmware binary>
+#
+# before a firmware is build. If the artifact is found (exit code 0),
+# the build is skipped. Otherwise (exit code 2), the firmware is build
+# and published afterwards with the "publish" command.
+
+import argparse
+import sys
+import os
+import hashlib
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import urllib.request
+import urllib.error
+import http.server
+
+# Exit code of the restore command if an artifact is not cached
+#
+exit_code_miss = 2
+
+# Temporary files are created with mode 0600. Artifacts and restored
+# firmware binaries (shared libraries) receive the usual mode instead
+# as caches are shared between users and workspaces.
+#
+def determine_default_file_mode():
+   umask = os.umask(0)
+   os.umask(umask)
+   return 0o755 & ~umask
+
+default_file_mode = determine_default_file_mode()
+
+# Runs a git command in a directory and returns its output
+#
+def git_output(git_executable, args, cwd):
+
+   return subprocess.check_output([git_executable] + args, cwd = cwd,
+                                  stderr = subprocess.DEVNULL) \
+             .decode('utf-8', 'replace')
+
+# Returns the git repositories below a boards directory whose commits
+# define the firmware, i.e. the boards repository itself and
+# all modules that were cloned into its libraries directory.
+# Modules that are submodules of the boards repository are covered
+# by the boards repository's submodule status.
+#
+def find_repositories(checkout_dir):
+
+   repositories = [checkout_dir]
+
+   libraries_dir = os.path.join(checkout_dir, "libraries")
+   if os.path.isdir(libraries_dir):
+      for name in sorted(os.listdir(libraries_dir)):
+         module_dir = os.path.join(libraries_dir, name)
+         if os.path.isdir(os.path.join(module_dir, ".git")):
+            repositories.append(module_dir)
+
+   return repositories
+
+# Computes the key of a firmware artifact
+#
+def compute_artifact_key(digest,
+                         checkout_dirs = [],
+                         extra_key = None,
+                         git_executable = "git"):
+
+   m = hashlib.sha256()
+
+   m.update(digest.encode('utf-8'))
+
+   for checkout_dir in checkout_dirs:
+      for repository in find_repositories(checkout_dir):
+         m.update(os.path.relpath(repository, checkout_dir).encode('utf-8'))
+         m.update(git_output(git_executable,
+                             ["rev-parse", "HEAD"],
+                             repository).encode('utf-8'))
+         m.update(git_output(git_executable,
+                             ["submodule", "status", "--recursive"],
+                             repository).encode('utf-8'))
+
+   if extra_key:
+      m.update(extra_key.encode('utf-8'))
+
+   return m.hexdigest()
+
+# Copies a file to a temporary file in the target directory and
+# renames it. Readers thus never see partially written files.
+#
+def atomic_copy(source, target):
+
+   target_dir = os.path.dirname(os.path.abspath(target))
+   os.makedirs(target_dir, exist_ok = True)
+
+   fd, tmp_filename = tempfile.mkstemp(dir = target_dir, prefix = ".tmp.")
+   try:
+      with os.fdopen(fd, 'wb') as tmp_file:
+         with open(source, 'rb') as source_file:
+            shutil.copyfileobj(source_file, tmp_file)
+      os.chmod(tmp_filename, default_file_mode)
+      os.replace(tmp_filename, target)
+   except BaseException:
+      if os.path.exists(tmp_filename):
+         os.remove(tmp_filename)
+      raise
+
+# Writes data to a file atomically
+#
+def atomic_write(data, target):
+
+   target_dir = os.path.dirname(os.path.abspath(target))
+   os.makedirs(target_dir, exist_ok = True)
+
+   fd, tmp_filename = tempfile.mkstemp(dir = target_dir, prefix = ".tmp.")
+   try:
+      with os.fdopen(fd, 'wb') as tmp_file:
+         tmp_file.write(data)
+      os.chmod(tmp_filename, default_file_mode)
+      os.replace(tmp_filename, target)
+   except BaseException:
+      if os.path.exists(tmp_filename):
+         os.remove(tmp_filename)
+      raise
+
+# A cache that stores artifacts in a local directory as
+# <cache dir>/<key[:2]>/<key>. The modification time of an artifact
+# is updated whenever it is restored and serves as the time of
+# last use for LRU eviction.
+#
+class LocalDirectoryBackend(object):
+
+   def __init__(self, cache_dir, max_size = None):
+
+      self.cache_dir = cache_dir
+      self.max_size = max_size
+
+      # Eviction may run in several threads of the cache server
+      #
+      self.lock = threading.Lock()
+
+   def artifactPath(self, key):
+      return os.path.join(self.cache_dir, key[:2], key)
+
+   def contains(self, key):
+      return os.path.isfile(self.artifactPath(key))
+
+   # Copies the artifact to target. Returns False if the
+   # artifact is not cached.
+   #
+   def fetch(self, key, target):
+
+      artifact_path = self.artifactPath(key)
+
+      try:
+         atomic_copy(artifact_path, target)
+      except FileNotFoundError:
+         return False
+
+      self.touch(artifact_path)
+
+      return True
+
+   def read(self, key):
+
+      artifact_path = self.artifactPath(key)
+
+      try:
+         with open(artifact_path, 'rb') as artifact:
+            data = artifact.read()
+      except FileNotFoundError:
+         return None
+
+      self.touch(artifact_path)
+
+      return data
+
+   def touch(self, artifact_path):
+      try:
+         os.utime(artifact_path)
+      except OSError:
+         pass
+
+   # Returns the number of evicted artifacts
+   #
+   def publish(self, key, source):
+      atomic_copy(source, self.artifactPath(key))
+      return self.evict()
+
+   def write(self, key, data):
+      atomic_write(data, self.artifactPath(key))
+      return self.evict()
+
+   # Returns a list of tuples (time of last use, size, path)
+   #
+   def entries(self):
+
+      entries = []
+
+      if not os.path.isdir(self.cache_dir):
+         return entries
+
+      for subdir in os.scandir(self.cache_dir):
+         if not subdir.is_dir() or len(subdir.name) != 2:
+            continue
+         for entry in os.scandir(subdir.path):
+            if entry.name.startswith(".tmp."):
+               continue
+            try:
+               stat = entry.stat()
+            except FileNotFoundError:
+               continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+      return entries
+
+   def size(self):
+      return sum(entry[1] for entry in self.entries())
+
+   # Removes least recently used artifacts until the cache
+   # fits its size limit
+   #
+   def evict(self):
+
+      if not self.max_size:
+         return 0
+
+      with self.lock:
+
+         entries = self.entries()
+         total_size = sum(entry[1] for entry in entries)
+
+         n_evicted = 0
+         for last_use, size, path in sorted(entries):
+            if total_size <= self.max_size:
+               break
+            try:
+               os.remove(path)
+            except FileNotFoundError:
+               pass
+            total_size -= size
+            n_evicted += 1
+
+         return n_evicted
+
+# Raised if a cache server can not be reached or fails to
+# answer a request
+#
+class CacheUnavailableError(Exception):
+   pass
+
+# A cache that is accessed through HTTP. Artifacts are read with
+# GET <url>/<key> and published with PUT <url>/<key>.
+#
+# The timeout applies to every blocking socket operation, not to a
+# whole transfer. It is kept short as an unreachable server would
+# otherwise delay every firmware build.
+#
+class HTTPBackend(object):
+
+   def __init__(self, url, timeout = 10):
+      self.url = url.rstrip("/")
+      self.timeout = timeout
+
+   def unavailable(self, exc):
+      return CacheUnavailableError("Firmware cache \"%s\" unavailable: %s"
+                                   % (self.url, getattr(exc, "reason", exc)))
+
+   def read(self, key):
+
+      try:
+         with urllib.request.urlopen(self.url + "/" + key,
+                                     timeout = self.timeout) as response:
+            return response.read()
+      except urllib.error.HTTPError as exc:
+         if exc.code == 404:
+            return None
+         raise self.unavailable(exc)
+      except OSError as exc:
+         raise self.unavailable(exc)
+
+   def contains(self, key):
+
+      request = urllib.request.Request(self.url + "/" + key, method = "HEAD")
+      try:
+         with urllib.request.urlopen(request, timeout = self.timeout):
+            return True
+      except urllib.error.HTTPError as exc:
+         if exc.code == 404:
+            return False
+         raise self.unavailable(exc)
+      except OSError as exc:
+         raise self.unavailable(exc)
+
+   def fetch(self, key, target):
+
+      data = self.read(key)
+      if data is None:
+         return False
+
+      atomic_write(data, target)
+
+      return True
+
+   def publish(self, key, source):
+
+      with open(source, 'rb') as source_file:
+         data = source_file.read()
+
+      request = urllib.request.Request(self.url + "/" + key, data = data,
+                                       method = "PUT")
+      try:
+         with urllib.request.urlopen(request, timeout = self.timeout):
+            pass
+      except OSError as exc:
+         raise self.unavailable(exc)
+
+      return 0
+
+   def readStatistics(self):
+
+      try:
+         with urllib.request.urlopen(self.url + "/stats",
+                                     timeout = self.timeout) as response:
+            return response.read().decode('utf-8')
+      except OSError as exc:
+         raise self.unavailable(exc)
+
+# Hit and miss statistics of a cache. The cache server updates the
+# statistics from several threads, i.e. counters must only be changed
+# through count(...).
+#
+class CacheStatistics(object):
+
+   def __init__(self):
+      self.hits = 0
+      self.misses = 0
+      self.publishes = 0
+      self.evictions = 0
+      self.lock = threading.Lock()
+
+   # Adds n to the counter with the given name
+   #
+   def count(self, name, n = 1):
+      with self.lock:
+         setattr(self, name, getattr(self, name) + n)
+
+   def hitRate(self):
+      requests = self.hits + self.misses
+      if requests == 0:
+         return 0.0
+      return float(self.hits) / requests
+
+   def toDict(self):
+      with self.lock:
+         return { "hits" : self.hits,
+                  "misses" : self.misses,
+                  "publishes" : self.publishes,
+                  "evictions" : self.evictions,
+                  "hit_rate" : self.hitRate() }
+
+# The firmware cache as used by the build system
+#
+class FirmwareCache(object):
+
+   def __init__(self, backend):
+      self.backend = backend
+      self.statistics = CacheStatistics()
+
+   # Restores a firmware artifact. Returns True on a cache hit.
+   # An unavailable cache server is reported and counts as a miss.
+   #
+   def restore(self, key, target):
+
+      try:
+         hit = self.backend.fetch(key, target)
+      except CacheUnavailableError as error:
+         sys.stdout.write("%s\n" % error)
+         hit = False
+
+      if hit:
+         self.statistics.count("hits")
+         return True
+
+      self.statistics.count("misses")
+      return False
+
+   # Publishes a firmware artifact. Failing to reach the cache server
+   # is not fatal, the firmware is just not cached.
+   #
+   def publish(self, key, source):
+
+      try:
+         n_evicted = self.backend.publish(key, source)
+      except CacheUnavailableError as error:
+         sys.stdout.write("Warning: %s\n" % error)
+         return
+
+      self.statistics.count("evictions", n_evicted)
+      self.statistics.count("publishes")
+
+# Creates a cache for a local directory or an URL
+#
+def open_cache(cache, max_size = None, timeout = 10):
+
+   if cache.startswith("http://") or cache.startswith("https://"):
+      return FirmwareCache(HTTPBackend(cache, timeout))
+
+   return FirmwareCache(LocalDirectoryBackend(cache, max_size))
+
+# A stand-in cache server that stores artifacts in a local
+# directory. Statistics are available as JSON at /stats.
+#
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+
+   # Set by serve(...)
+   #
+   cache = None
+
+   def key(self):
+
+      key = self.path.strip("/")
+
+      # Keys are hex digests. Anything else could escape the
+      # cache directory.
+      #
+      if (not key) or any(c not in "0123456789abcdef" for c in key):
+         self.send_error(400, "Invalid key")
+         return None
+
+      return key
+
+   def sendData(self, data, content_type = "application/octet-stream"):
+      self.send_response(200)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+   def do_GET(self):
+
+      if self.path == "/stats":
+         self.sendData(json.dumps(self.cache.statistics.toDict()).encode('utf-8'),
+                       "application/json")
+         return
+
+      key = self.key()
+      if not key:
+         return
+
+      data = self.cache.backend.read(key)
+      if data is None:
+         self.cache.statistics.count("misses")
+         self.send_error(404)
+         return
+
+      self.cache.statistics.count("hits")
+      self.sendData(data)
+
+   def do_HEAD(self):
+
+      key = self.key()
+      if not key:
+         return
+
+      if self.cache.backend.contains(key):
+         self.send_response(200)
+      else:
+         self.send_response(404)
+      self.end_headers()
+
+   def do_PUT(self):
+
+      key = self.key()
+      if not key:
+         return
+
+      length = int(self.headers.get("Content-Length", 0))
+      data = self.rfile.read(length)
+
+      n_evicted = self.cache.backend.write(key, data)
+
+      self.cache.statistics.count("evictions", n_evicted)
+      self.cache.statistics.count("publishes")
+
+      self.send_response(201)
+      self.end_headers()
+
+   def log_message(self, format, *args):
+      pass
+
+def serve(cache_dir, max_size, host, port):
+
+   CacheRequestHandler.cache \
+      = FirmwareCache(LocalDirectoryBackend(cache_dir, max_size))
+
+   server = http.server.ThreadingHTTPServer((host, port), CacheRequestHandler)
+
+   sys.stdout.write("Serving firmware cache \"%s\" at http://%s:%d\n"
+                    % (cache_dir, host, server.server_address[1]))
+   sys.stdout.flush()
+
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+
+def report_statistics(cache):
+   sys.stdout.write("Firmware cache: %d hit(s), %d miss(es), %d publish(es), "
+      "%d eviction(s)\n"
+      % (cache.statistics.hits, cache.statistics.misses,
+         cache.statistics.publishes, cache.statistics.evictions))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool maintains a content addressed cache of Kaleidoscope "
+       "firmware binaries.")
+
+    parser.add_argument('-c', '--cache',
+      metavar  = 'dir|url',
+      dest     = 'cache',
+      required = True,
+      help     = 'A cache directory or the URL of a cache server'
+    )
+
+    parser.add_argument('-s', '--max_size',
+      metavar  = 'MB',
+      dest     = 'max_size',
+      type     = int,
+      help     = 'The maximum size of a local cache directory in MB'
+    )
+
+    parser.add_argument('-t', '--timeout',
+      metavar  = 's',
+      dest     = 'timeout',
+      type     = float,
+      default  = 10,
+      help     = 'The time to wait for a cache server to answer '
+                 '(default: 10 s)'
+    )
+
+    subparsers = parser.add_subparsers(dest = 'command')
+    subparsers.required = True
+
+    def add_key_arguments(subparser):
+       subparser.add_argument('--digest',
+         dest     = 'digest',
+         required = True,
+         help     = 'The firmware digest generated by prepare_testing.py'
+       )
+       subparser.add_argument('--checkout_dir',
+         dest     = 'checkout_dirs',
+         action   = 'append',
+         default  = [],
+         help     = 'A boards directory whose checked out commits '
+                    'are part of the cache key'
+       )
+       subparser.add_argument('--extra_key',
+         dest     = 'extra_key',
+         help     = 'An additional string that is part of the cache key'
+       )
+       subparser.add_argument('--git_executable',
+         dest     = 'git_executable',
+         default  = 'git',
+         help     = 'The git executable'
+       )
+
+    restore_parser = subparsers.add_parser('restore',
+       help = 'Restore a firmware binary (exit code %d on a miss)'
+              % exit_code_miss)
+    add_key_arguments(restore_parser)
+    restore_parser.add_argument('--target',
+      dest     = 'target',
+      required = True,
+      help     = 'The firmware binary to restore'
+    )
+
+    publish_parser = subparsers.add_parser('publish',
+       help = 'Publish a firmware binary')
+    add_key_arguments(publish_parser)
+    publish_parser.add_argument('--source',
+      dest     = 'source',
+      required = True,
+      help     = 'The firmware binary to publish'
+    )
+
+    subparsers.add_parser('stats',
+       help = 'Report the content of the cache')
+
+    serve_parser = subparsers.add_parser('serve',
+       help = 'Serve a local cache directory through HTTP')
+    serve_parser.add_argument('--host',
+      dest     = 'host',
+      default  = '127.0.0.1',
+      help     = 'The interface to listen on'
+    )
+    serve_parser.add_argument('--port',
+      dest     = 'port',
+      type     = int,
+      default  = 8742,
+      help     = 'The port to listen on'
+    )
+
+    args = parser.parse_args()
+
+    max_size = None
+    if args.max_size:
+       max_size = args.max_size * 1024 * 1024
+
+    if args.command == 'serve':
+       serve(args.cache, max_size, args.host, args.port)
+       return
+
+    cache = open_cache(args.cache, max_size, args.timeout)
+
+    if args.command == 'stats':
+       if isinstance(cache.backend, LocalDirectoryBackend):
+          entries = cache.backend.entries()
+          sys.stdout.write("%d artifact(s), %.1f MB\n"
+             % (len(entries), sum(e[1] for e in entries) / (1024.0 * 1024.0)))
+       else:
+          try:
+             sys.stdout.write(cache.backend.readStatistics() + "\n")
+          except CacheUnavailableError as error:
+             sys.exit(str(error))
+       return
+
+    try:
+       key = compute_artifact_key(args.digest, args.checkout_dirs,
+                                  args.extra_key, args.git_executable)
+    except (subprocess.CalledProcessError, OSError) as exc:
+       sys.exit("Unable to determine the checked out commits: %s" % exc)
+
+    if args.command == 'restore':
+       hit = cache.restore(key, args.target)
+       report_statistics(cache)
+       if not hit:
+          sys.exit(exit_code_miss)
+
+    elif args.command == 'publish':
+       cache.publish(key, args.source)
+       report_statistics(cache)
+
+if __name__ == "__main__":
+    main()
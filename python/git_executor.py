@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script executes a git plan that is generated
+# by prepare_testing.py (command line option --git_plan).
+#
+# A git plan lists every distinct repository URL that is used
+# by any of the firmware builds together with the path of a
+# local mirror and all commits that are checked out from
+# the repository. Every URL appears only once, no matter how many
+# firmware builds use it.
+#
+# For every URL of the plan, the executor
+#
+# - clones a bare mirror repository if it does not exist yet,
+# - fetches the mirror if it is supposed to be updated or if one
+#   of the commits cannot be resolved in the mirror, and
+# - verifies that all commits can be resolved.
+#
+# Operations for different URLs are run concurrently as asyncio
+# subprocesses. The number of concurrent operations is bounded.
+# Failed operations are retried. Finally, the duration of
+# every operation is reported.
+#
+# Firmware builds then clone from the mirrors (see the git mirror
+# section in prepare_testing.py), i.e. no git objects are
+# transferred over the network during their configuration.
+
+import argparse
+import sys
+import os
+import json
+import shutil
+import time
+import asyncio
+
+# A single entry of a git plan
+#
+class GitOperation(object):
+
+   def __init__(self, url = None, mirror = None, commits = None):
+
+      self.url = url
+      self.mirror = mirror
+      self.commits = commits or []
+
+      # Execution results
+      #
+      self.success = False
+      self.attempts = 0
+      self.duration = 0.0
+      self.error = None
+
+   def toDict(self):
+      return { "url" : self.url,
+               "mirror" : self.mirror,
+               "commits" : self.commits }
+
+   @staticmethod
+   def fromDict(operation_dict):
+      return GitOperation(operation_dict.get("url"),
+                          operation_dict.get("mirror"),
+                          operation_dict.get("commits"))
+
+def write_git_plan(git_plan_filename, operations):
+
+   with open(git_plan_filename, "w") as stream:
+      json.dump({ "operations" : [op.toDict() for op in operations] },
+                stream, indent = 3)
+      stream.write("\n")
+
+def read_git_plan(git_plan_filename):
+
+   with open(git_plan_filename, "r") as stream:
+      plan = json.load(stream)
+
+   return [GitOperation.fromDict(op) for op in plan.get("operations", [])]
+
+# Raised when a git command of an operation fails
+#
+class GitError(Exception):
+   pass
+
+async def run_git(git_executable, args, cwd = None):
+
+   process = await asyncio.create_subprocess_exec(
+      git_executable, *args,
+      cwd = cwd,
+      stdout = asyncio.subprocess.PIPE,
+      stderr = asyncio.subprocess.STDOUT)
+
+   output, _ = await process.communicate()
+
+   if process.returncode != 0:
+      raise GitError("git %s failed:\n%s"
+         % (" ".join(args), output.decode('utf-8', 'replace')))
+
+# Commits are specified with respect to a regular clone, e.g. as
+# origin/master. In a mirror, branches are not prefixed with the
+# remote name.
+#
+def mirror_revisions(commit):
+
+   revisions = [commit]
+
+   if commit.startswith("origin/"):
+      revisions.append(commit[len("origin/"):])
+
+   return revisions
+
+async def resolves_commit(git_executable, mirror, commit):
+
+   for revision in mirror_revisions(commit):
+      try:
+         await run_git(git_executable,
+                       ["rev-parse", "--verify", "--quiet",
+                        revision + "^{commit}"],
+                       cwd = mirror)
+         return True
+      except GitError:
+         pass
+
+   return False
+
+async def unresolved_commits(git_executable, operation):
+
+   unresolved = []
+   for commit in operation.commits:
+      if not await resolves_commit(git_executable, operation.mirror, commit):
+         unresolved.append(commit)
+
+   return unresolved
+
+# Runs the git commands of a single operation once.
+#
+# Garbage collection is disabled in mirrors as the clones of the
+# firmware builds depend on the mirrors' objects.
+#
+async def execute_operation_once(operation, git_executable, update_existing):
+
+   if not os.path.isdir(operation.mirror):
+
+      os.makedirs(os.path.dirname(operation.mirror), exist_ok = True)
+
+      # Clone to a temporary path first to never leave an incomplete
+      # mirror behind.
+      #
+      tmp_path = operation.mirror + ".tmp"
+      if os.path.exists(tmp_path):
+         shutil.rmtree(tmp_path)
+
+      try:
+         await run_git(git_executable,
+                       ["clone", "--mirror", operation.url, tmp_path])
+         await run_git(git_executable, ["config", "gc.auto", "0"],
+                       cwd = tmp_path)
+      except GitError:
+         if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+         raise
+
+      os.replace(tmp_path, operation.mirror)
+
+   elif update_existing \
+         or await unresolved_commits(git_executable, operation):
+      await run_git(git_executable, ["fetch", "--prune"],
+                    cwd = operation.mirror)
+
+   unresolved = await unresolved_commits(git_executable, operation)
+   if unresolved:
+      raise GitError("unable to resolve commit(s) %s of \"%s\""
+                     % (", ".join(unresolved), operation.url))
+
+async def execute_operation(operation, semaphore, git_executable,
+                            retries, update_existing):
+
+   async with semaphore:
+
+      start_time = time.monotonic()
+
+      while True:
+
+         operation.attempts += 1
+
+         try:
+            await execute_operation_once(operation, git_executable,
+                                         update_existing)
+            operation.success = True
+            operation.error = None
+            break
+         except (GitError, OSError) as exc:
+            operation.error = str(exc)
+
+         if operation.attempts > retries:
+            break
+
+         # Back off before retrying, e.g. to survive
+         # short network outages
+         #
+         await asyncio.sleep(min(2**(operation.attempts - 1), 30))
+
+      operation.duration = time.monotonic() - start_time
+
+async def execute_operations(operations, jobs, git_executable,
+                             retries, update_existing):
+
+   semaphore = asyncio.Semaphore(jobs)
+
+   await asyncio.gather(*[
+      execute_operation(operation, semaphore, git_executable,
+                        retries, update_existing)
+      for operation in operations])
+
+# Executes all operations of a git plan with at most jobs
+# concurrent operations. Every failed operation is retried
+# up to retries times.
+#
+# Returns True if all operations succeeded.
+#
+def execute_git_plan(operations,
+                     jobs = 8,
+                     git_executable = "git",
+                     retries = 2,
+                     update_existing = False):
+
+   if not operations:
+      return True
+
+   asyncio.run(execute_operations(operations, max(1, jobs), git_executable,
+                                  retries, update_existing))
+
+   return all(operation.success for operation in operations)
+
+# Writes a report with the duration and the result of every operation
+#
+def report_git_plan(operations, file = sys.stdout):
+
+   for operation in sorted(operations, key = lambda x: -x.duration):
+
+      if operation.success:
+         status = "ok"
+      else:
+         status = "FAILED"
+
+      file.write("%8.2f s  %-6s  %d attempt(s)  %s\n"
+         % (operation.duration, status, operation.attempts, operation.url))
+
+      if not operation.success:
+         file.write("   " + operation.error.strip().replace("\n", "\n   ")
+                    + "\n")
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool executes a git plan that is generated by "
+       "prepare_testing.py and maintains local mirrors of all git "
+       "repositories needed by the firmware builds.")
+
+    parser.add_argument('-p', '--git_plan',
+      metavar  = 'file',
+      dest     = 'git_plan',
+      required = True,
+      help     = 'The git plan file'
+    )
+
+    parser.add_argument('-j', '--jobs',
+      metavar  = 'N',
+      dest     = 'jobs',
+      type     = int,
+      default  = 8,
+      help     = 'The maximum number of concurrent git operations'
+    )
+
+    parser.add_argument('-r', '--retries',
+      metavar  = 'N',
+      dest     = 'retries',
+      type     = int,
+      default  = 2,
+      help     = 'The number of retries of failed operations'
+    )
+
+    parser.add_argument('--update',
+      dest     = 'update',
+      action   = 'store_true',
+      help     = 'Fetch existing mirrors'
+    )
+
+    parser.add_argument('--git_executable',
+      metavar  = 'file',
+      dest     = 'git_executable',
+      default  = 'git',
+      help     = 'The git executable'
+    )
+
+    args = parser.parse_args()
+
+    operations = read_git_plan(args.git_plan)
+
+    success = execute_git_plan(operations, args.jobs, args.git_executable,
+                               args.retries, args.update)
+
+    report_git_plan(operations)
+
+    if not success:
+       sys.exit("Not all git operations succeeded.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This module implements the jobserver protocol of GNU make.
+#
+# A jobserver is a pipe that holds one token (a single byte) for every
+# job slot except one. Every participating process owns one implicit
+# slot. It reads a token from the pipe before it starts any further job
+# and writes the token back when the job finished. Child processes
+# find the pipe through the environment variable MAKEFLAGS, i.e.
+# every make that is started by a firmware build (e.g. through
+# cmake --build) shares the same slots instead of adding jobs of its
+# own.
+#
+# A jobserver is either created with a given number of slots
+# (create_jobserver(...)) or the jobserver of a parent make is joined
+# (join_jobserver(...)), e.g. if the build is started by make -j64.
+#
+# Tokens are read by this process in non-blocking mode. As the
+# O_NONBLOCK flag would affect all processes that share an open pipe,
+# the jobserver is a named pipe that is opened separately for this
+# process and for the child processes. The jobserver of a parent
+# make is reopened through /proc/self/fd. This requires POSIX
+# and, for parent jobservers that are passed as file descriptors,
+# Linux.
+
+import os
+import re
+import stat
+import errno
+import shutil
+import tempfile
+
+class JobServer(object):
+
+   # slots is the total number of job slots or None if unknown.
+   # token_fd is opened in non-blocking mode for this process.
+   # child_fds are the file descriptors that child processes
+   # must inherit.
+   #
+   def __init__(self, slots, makeflags, token_fd, child_fds,
+                description, tmp_dir = None):
+
+      self.slots = slots
+      self.makeflags = makeflags
+      self.token_fd = token_fd
+      self.child_fds = child_fds
+      self.description = description
+      self.tmp_dir = tmp_dir
+
+   # Reads a token from the pipe. Returns the token or None if no
+   # token is available.
+   #
+   def tryAcquire(self):
+
+      try:
+         token = os.read(self.token_fd, 1)
+      except OSError as exc:
+         if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return None
+         raise
+
+      if not token:
+         return None
+
+      return token
+
+   # Returns a token that was acquired by tryAcquire()
+   #
+   def release(self, token):
+      os.write(self.token_fd, token)
+
+   # Returns a copy of the environment env that makes child processes
+   # use the jobserver
+   #
+   def environment(self, env):
+
+      env = dict(env)
+      env["MAKEFLAGS"] = self.makeflags
+      env.pop("MFLAGS", None)
+
+      return env
+
+   def close(self):
+
+      os.close(self.token_fd)
+
+      if self.tmp_dir:
+         for fd in self.child_fds:
+            os.close(fd)
+         shutil.rmtree(self.tmp_dir, ignore_errors = True)
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+# Creates a jobserver with the given number of slots
+#
+def create_jobserver(slots):
+
+   slots = max(1, slots)
+
+   tmp_dir = tempfile.mkdtemp(prefix = "leidokos_jobserver_")
+   fifo = os.path.join(tmp_dir, "jobserver")
+   os.mkfifo(fifo, 0o600)
+
+   # Opening a named pipe for reading and writing never blocks
+   #
+   child_fd = os.open(fifo, os.O_RDWR)
+   os.set_inheritable(child_fd, True)
+
+   token_fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+
+   # This process owns the implicit slot
+   #
+   os.write(token_fd, b"+" * (slots - 1))
+
+   makeflags = " -j%d --jobserver-auth=%d,%d" % (slots, child_fd, child_fd)
+
+   return JobServer(slots, makeflags, token_fd, [child_fd],
+                    "jobserver with %d slots" % slots, tmp_dir)
+
+def is_fifo(fd):
+   try:
+      return stat.S_ISFIFO(os.fstat(fd).st_mode)
+   except OSError:
+      return False
+
+# Joins the jobserver of a parent make that is advertised in
+# makeflags. Returns None if there is no jobserver or if it can
+# not be used, e.g. because the parent make did not pass its file
+# descriptors to this process.
+#
+def join_jobserver(makeflags):
+
+   if not makeflags:
+      return None
+
+   slots = None
+   match = re.search(r"(?:^|\s)-j(\d+)", makeflags)
+   if match:
+      slots = int(match.group(1))
+
+   # GNU make >= 4.4 uses a named pipe
+   #
+   match = re.search(r"--jobserver-auth=fifo:(\S+)", makeflags)
+   if match:
+      try:
+         token_fd = os.open(match.group(1), os.O_RDWR | os.O_NONBLOCK)
+      except OSError:
+         return None
+      return JobServer(slots, makeflags, token_fd, [],
+                       "jobserver of the parent make")
+
+   match = re.search(r"--jobserver-(?:auth|fds)=(\d+),(\d+)", makeflags)
+   if not match:
+      return None
+
+   read_fd, write_fd = int(match.group(1)), int(match.group(2))
+
+   if not is_fifo(read_fd) or not is_fifo(write_fd):
+      return None
+
+   # Reopen the pipe to obtain a file description of our own that
+   # can be switched to non-blocking mode
+   #
+   try:
+      token_fd = os.open("/proc/self/fd/%d" % read_fd,
+                         os.O_RDWR | os.O_NONBLOCK)
+   except OSError:
+      return None
+
+   return JobServer(slots, makeflags, token_fd, [read_fd, write_fd],
+                    "jobserver of the parent make")
@@ -70,6 +70,16 @@
 #
 # Tests that define equal combinations of custom modules and firmware sketch share
 # a common firmware build to minimize the amount of build overhead.
+# Sketches are compared by content, i.e. identical sketch files in different
+# directories result in a shared firmware build.
+#
+# Firmware builds are further grouped by their module set, i.e. the
+# boards repository and the modules without the sketch. The modules 
+# of a module set are checked out and compiled only once. The firmware 
+# builds of a module set are then build one after another in the same
+# build tree where only the sketch needs to be compiled and linked 
+# unless LEIDOKOS_TESTING_SHARED_MODULE_BUILDS is disabled (see 
+# kaleidoscope_module_set(...) in CMakeLists.txt).
 # The firmware is build to run on the host system (x86) and wrapped
 # in a shared library that can be loaded as a Python module.
 # The latter is done using the Leidokos-Python-Wrapper.
@@ -105,52 +115,163 @@
 # Tests are automatically generated for every node in the 
 # directory tree that is either a leaf node or contains a 
 # file named "__test__".
+#
+# *** Shared git mirrors ***
+#
+# If a git mirror directory is specified (command line option -g), a
+# bare mirror repository is cloned to this directory for every 
+# distinct repository URL that is used by the firmware builds
+# (boards repository and firmware modules). Firmware builds then 
+# clone with --reference to the mirror, i.e. they share git objects
+# instead of fetching and storing their own copies.
+#
+# Mirrors are filled concurrently (see git_executor.py), one operation
+# per distinct URL that fetches all commits required by any firmware
+# build. The plan of these operations can be written to a file 
+# (command line option --git_plan) to be executed separately.
+#
+# *** Incremental preparation ***
+#
+# If a manifest file is specified (command line option -m), the
+# resolved testing tree is stored in this file together with the 
+# modification time, size and content hash of every directory and
+# input file (sketch, driver, specification) that was scanned. 
+# Consecutive runs only re-evaluate those directories whose 
+# content changed and all their descendants. Any other part of 
+# the testing tree is reused from the manifest.
+#
+# *** Change impact selection ***
+#
+# On request (command line options --changed_files and --since), only 
+# the tests and firmware builds that are affected by a set of changed 
+# files are exported. A test is affected by the input files (sketch, 
+# driver, specification, __external__ and __test__) of its own directory
+# and of all parent directories. Changes outside of the testing tree,
+# e.g. of the tested module's code, select all tests.
+#
+# *** Sharding ***
+#
+# To distribute tests over several CI nodes, the command line option
+# --shard INDEX/COUNT restricts all exported information to a single
+# shard. All tests that use the same firmware build end up in the same
+# shard, i.e. every firmware is build on exactly one node. Shards are
+# balanced by estimated costs of firmware builds and tests that can be
+# replaced by recorded costs (command line option --shard_costs), e.g.
+# from a timing history (see timing_history.py).
+# The assignment only depends on the testing tree and the costs, i.e.
+# all nodes compute the same partition independently.
+#
+# *** Profiling ***
+#
+# The command line option --profile measures the time spent in the
+# phases of the preparation (directory walk, specification loading, 
+# firmware build deduplication, exports, ...) and counts the work done
+# in every phase (directories, specification files, test nodes,
+# hashed files and bytes, ...). The phases are written as a Chrome 
+# trace event file that can be viewed with chrome://tracing or 
+# https://ui.perfetto.dev and a summary is printed.
+# The option --cprofile additionally records all function calls
+# with cProfile.
+#
+# *** Library use ***
+#
+# This script can also be imported (see testing_api.py). Errors are 
+# raised as exceptions derived from PrepareTestingError, and 
+# diagnostics are passed to a replaceable reporter (see report(...)).
+# Modules that are only required by some of the functions (yaml, 
+# git_executor, timing_history, ...) are imported on first use
+# to keep imports fast.
+#
+# *** Watch mode ***
+#
+# With the command line option --watch, the script keeps running after
+# the exports were written. It watches all directories of the testing
+# tree, including __external__ directories, for changes (see 
+# watch_daemon.py). Only the subtrees of changed directories are set 
+# up again (see patch_testing_tree(...)) and the exports are 
+# regenerated immediately. Queries about tests and firmware builds
+# are answered via a Unix domain socket (command line 
+# option --watch_socket).
 
-import argparse
 import sys
 import os
+import array
+import bisect
 import hashlib
-import yaml
-import copy
 import fnmatch
+import contextlib
+import pickle
+import mmap
+import io
+import json
+import shlex
+import time
+import tempfile
 
-# Finds a files that match the globbing pattern 
-# (non-recursively)
+# The C implementation of the yaml loader (LibYAML) is 
+# considerably faster than the pure python version but not
+# necessarily available.
 #
-def find_files(pattern, path):
-   result = []
-   for root, dirs, files in os.walk(path):
-      if path != root:
-         continue
-      for name in files:
-         if fnmatch.fnmatch(name, pattern):
-            result.append(os.path.join(root, name))
-   return result
+def yaml_loader():
+   
+   import yaml
+   
+   return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-# Finds a files that matches name (non-recursively)
+# *** Errors ***
 #
-def find_file(name, path):
-   for root, dirs, files in os.walk(path):
-      if path != root:
-         continue
-      if name in files:
-         return os.path.join(root, name)
-   return None
+# All errors that prevent the preparation of tests are raised as
+# exceptions derived from PrepareTestingError. When run as a 
+# script, the error message is reported and the script exits.
+#
+class PrepareTestingError(Exception):
+   pass
 
-def find_unique_file(pattern, path, file_type_descr):
+# The testing tree contains test nodes with incomplete 
+# information. problems lists a message for every defect.
+#
+class InvalidTestingTreeError(PrepareTestingError):
    
-   files = find_files(pattern, path)
+   def __init__(self, message, problems):
+      PrepareTestingError.__init__(self, message)
+      self.problems = problems
+
+# An __external__ specification that is not a directory or that
+# is accompanied by other files
+#
+class ExternalSpecificationError(PrepareTestingError):
    
-   n_files = len(files)
+   def __init__(self, message, path):
+      PrepareTestingError.__init__(self, message)
+      self.path = path
+
+# Two tests share the same global name
+#
+class TestNameConflictError(PrepareTestingError):
    
-   selected_file = None
-   if n_files > 0:
-      selected_file = files[0]
-      if n_files > 1:
-         sys.stdout.write("Warning: Multiple " + file_type_descr + " found in directory \""
-            + path + "\". Using the first encounter \""
-            + selected_file + "\"")
-   return selected_file
+   def __init__(self, message, name, paths):
+      PrepareTestingError.__init__(self, message)
+      self.name = name
+      self.paths = paths
+
+class ShardSpecificationError(PrepareTestingError):
+   pass
+
+class GitError(PrepareTestingError):
+   pass
+
+# Diagnostics (warnings and progress information) are passed to 
+# the reporter, a function that accepts a message. By default, 
+# diagnostics are written to stdout.
+#
+reporter = None
+
+def report(message):
+   
+   if reporter:
+      reporter(message)
+   else:
+      sys.stdout.write(message)
 
 # The names of the files and directories
 # that may be defined in the testing directory structure.
@@ -163,6 +284,440 @@ firmware_sketch_pattern            = "*sketch.ino"
 test_driver_pattern                = "*driver.py"
 test_specification_pattern         = "*specification.yaml"
 
+# Records the time spent in the phases of the preparation and counts 
+# of the work done. When profiling is disabled, phases and counts 
+# are no-ops.
+#
+class ProfilePhase(object):
+   
+   def __init__(self, profiler, name):
+      self.profiler = profiler
+      self.name = name
+      self.counts = {}
+      self.depth = 0
+      self.start = 0.0
+      self.duration = 0.0
+      
+   def __enter__(self):
+      self.depth = len(self.profiler.phase_stack)
+      self.profiler.phase_stack.append(self)
+      self.start = time.perf_counter()
+      return self
+   
+   def __exit__(self, *args):
+      self.duration = time.perf_counter() - self.start
+      self.profiler.phase_stack.pop()
+      return False
+   
+class NullProfilePhase(object):
+   
+   def __enter__(self):
+      return self
+   
+   def __exit__(self, *args):
+      return False
+
+null_profile_phase = NullProfilePhase()
+
+class Profiler(object):
+   
+   def __init__(self):
+      self.enabled = False
+      self.phases = []
+      self.phase_stack = []
+      self.start = 0.0
+      
+   def enable(self):
+      self.enabled = True
+      self.start = time.perf_counter()
+      
+   # Returns a context manager that times a phase. Phases can be nested.
+   #
+   def phase(self, name):
+      
+      if not self.enabled:
+         return null_profile_phase
+      
+      phase = ProfilePhase(self, name)
+      self.phases.append(phase)
+      
+      return phase
+   
+   # Adds to a counter of the innermost active phase
+   #
+   def count(self, name, n = 1):
+      
+      if not self.enabled or not self.phase_stack:
+         return
+      
+      counts = self.phase_stack[-1].counts
+      counts[name] = counts.get(name, 0) + n
+      
+   # Writes the phases in the Chrome trace event format that can be
+   # viewed with chrome://tracing or https://ui.perfetto.dev
+   #
+   def writeChromeTrace(self, filename):
+      
+      pid = os.getpid()
+      
+      events = []
+      for phase in self.phases:
+         events.append({
+            "name" : phase.name,
+            "cat" : "prepare_testing",
+            "ph" : "X",
+            "ts" : (phase.start - self.start) * 1e6,
+            "dur" : phase.duration * 1e6,
+            "pid" : pid,
+            "tid" : 0,
+            "args" : phase.counts
+         })
+         
+      with open(filename, "w") as stream:
+         json.dump({ "traceEvents" : events, 
+                     "displayTimeUnit" : "ms" }, stream, indent = 1)
+         stream.write("\n")
+   
+   def writeSummary(self, file = sys.stdout):
+      
+      total = sum(phase.duration for phase in self.phases 
+                  if phase.depth == 0)
+      
+      file.write("%-40s %10s %6s  %s\n" % ("phase", "ms", "%", "counts"))
+      
+      for phase in self.phases:
+         
+         percentage = 0.0
+         if total > 0.0:
+            percentage = 100.0 * phase.duration / total
+            
+         counts = ", ".join("%s=%d" % (name, n) 
+                            for name, n in sorted(phase.counts.items()))
+         
+         file.write("%-40s %10.1f %6.1f  %s\n"
+            % ("  " * phase.depth + phase.name, phase.duration * 1e3, 
+               percentage, counts))
+         
+      file.write("%-40s %10.1f\n" % ("total", total * 1e3))
+      
+profiler = Profiler()
+
+# Selects the first file of a list of files that were found in 
+# the same directory and warns if there are several candidates.
+#
+def select_unique_file(files, path, file_type_descr):
+   
+   n_files = len(files)
+   
+   selected_file = None
+   if n_files > 0:
+      selected_file = files[0]
+      if n_files > 1:
+         report("Warning: Multiple " + file_type_descr + " found in directory \""
+            + path + "\". Using the first encounter \""
+            + selected_file + "\"")
+   return selected_file
+
+# The content of every directory of the testing tree is read exactly 
+# once. All entries that are relevant for the test specification
+# are classified during this single pass and stored in an instance
+# of class DirectoryScan that is handed to the respective TestNode.
+#
+class DirectoryScan(object):
+   
+   __slots__ = ( "path", 
+                 "subdirs", 
+                 "file_names", 
+                 "firmware_sketch_names", 
+                 "python_driver_names", 
+                 "specification_names",
+                 "has_test_trigger", 
+                 "external_specification", 
+                 "external_specification_is_dir", 
+                 "external_scan" )
+   
+   def __init__(self, path):
+      
+      self.path = path
+      
+      # Absolute paths of all sub-directories in the order they were 
+      # encountered. The strings are shared with the paths of 
+      # the test nodes.
+      #
+      self.subdirs = ()
+      
+      # Basenames of all non-directory entries and of the classified
+      # files. Basenames are interned, i.e. the common names
+      # (sketch.ino, driver.py, ...) are stored only once for 
+      # the whole tree. Absolute paths are generated on demand.
+      #
+      self.file_names = ()
+      
+      self.firmware_sketch_names = ()
+      self.python_driver_names = ()
+      self.specification_names = ()
+      
+      self.has_test_trigger = False
+      
+      # The path of an __external__ entry (if present) and 
+      # the scan of its content if it is a directory
+      #
+      self.external_specification = None
+      self.external_specification_is_dir = False
+      self.external_scan = None
+      
+   def absolutePaths(self, names):
+      return [os.path.join(self.path, name) for name in names]
+      
+   @property
+   def files(self):
+      return self.absolutePaths(self.file_names)
+   
+   @property
+   def firmware_sketches(self):
+      return self.absolutePaths(self.firmware_sketch_names)
+   
+   @property
+   def python_drivers(self):
+      return self.absolutePaths(self.python_driver_names)
+   
+   @property
+   def specifications(self):
+      return self.absolutePaths(self.specification_names)
+      
+   # Returns all files of the directory whose content influences 
+   # the test specification
+   #
+   def inputFiles(self):
+      return self.absolutePaths(self.firmware_sketch_names 
+                                + self.python_driver_names 
+                                + self.specification_names)
+      
+# Returns a tuple of the entries of a list. Empty lists are 
+# replaced by the shared empty tuple.
+#
+def compact(entries):
+   if not entries:
+      return ()
+   return tuple(entries)
+      
+# Reads the entries of a directory (non-recursively) with a single
+# call to os.scandir and classifies them.
+#
+def scan_directory(path):
+   
+   scan = DirectoryScan(path)
+   
+   profiler.count("directories")
+   
+   try:
+      entries = list(os.scandir(path))
+   except OSError:
+      
+      # Unreadable directories are treated as empty, just as os.walk
+      # would do.
+      #
+      return scan
+   
+   profiler.count("directory_entries", len(entries))
+   
+   subdirs = []
+   file_names = []
+   firmware_sketch_names = []
+   python_driver_names = []
+   specification_names = []
+   
+   for entry in entries:
+      
+      # Symbolic links to directories are followed
+      #
+      try:
+         is_dir = entry.is_dir()
+      except OSError:
+         is_dir = False
+         
+      if entry.name == external_specification_subdir_name:
+         scan.external_specification = entry.path
+         scan.external_specification_is_dir = is_dir
+         if is_dir:
+            scan.external_scan = scan_directory(entry.path)
+         else:
+            file_names.append(sys.intern(entry.name))
+         continue
+      
+      if is_dir:
+         subdirs.append(entry.path)
+         continue
+      
+      name = sys.intern(entry.name)
+      
+      file_names.append(name)
+      
+      if name == test_trigger_basename:
+         scan.has_test_trigger = True
+      if fnmatch.fnmatch(name, firmware_sketch_pattern):
+         firmware_sketch_names.append(name)
+      if fnmatch.fnmatch(name, test_driver_pattern):
+         python_driver_names.append(name)
+      if fnmatch.fnmatch(name, test_specification_pattern):
+         specification_names.append(name)
+         
+   scan.subdirs = compact(subdirs)
+   scan.file_names = compact(file_names)
+   scan.firmware_sketch_names = compact(firmware_sketch_names)
+   scan.python_driver_names = compact(python_driver_names)
+   scan.specification_names = compact(specification_names)
+         
+   return scan
+
+# Specification files are only parsed in a separate process 
+# if there are at least as many distinct specifications. For smaller
+# numbers, the overhead of starting worker processes dominates.
+#
+parallel_parsing_threshold = 256
+
+# Parses the content of a yaml specification file. Returns a tuple
+# of the parsed document and an error message (None on success).
+#
+def parse_specification(content):
+   
+   import yaml
+   
+   try:
+      return (yaml.load(content, Loader = yaml_loader()), None)
+   except yaml.YAMLError as exc:
+      return (None, str(exc))
+   
+def read_file(filename):
+   with open(filename, 'rb') as stream:
+      return stream.read()
+   
+# Reads and parses a set of yaml specification files ahead of 
+# tree generation. Files are read concurrently. Every distinct 
+# document is parsed only once, no matter how many files 
+# (duplicates or symbolic links) share the same content. 
+#
+# Returns a dict that maps filenames to the tuples returned by
+# parse_specification(...).
+#
+def load_specifications(filenames, jobs = None):
+   
+   import concurrent.futures
+   
+   if not jobs:
+      jobs = os.cpu_count() or 1
+      
+   # Symbolic links that point to the same file are only read once.
+   #
+   real_filenames = {}
+   for filename in filenames:
+      real_filenames[filename] = os.path.realpath(filename)
+      
+   unique_real_filenames = list(set(real_filenames.values()))
+   
+   profiler.count("specification_files", len(unique_real_filenames))
+   
+   with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+      contents = list(executor.map(read_file, unique_real_filenames))
+      
+   # Memoize by content digest to parse identical documents only once
+   #
+   content_digests_by_real_filename = {}
+   contents_by_digest = {}
+   for real_filename, content in zip(unique_real_filenames, contents):
+      digest = hashlib.sha256(content).hexdigest()
+      content_digests_by_real_filename[real_filename] = digest
+      contents_by_digest[digest] = content
+      
+   digests = list(contents_by_digest.keys())
+   unique_contents = [contents_by_digest[digest] for digest in digests]
+   
+   profiler.count("specifications_parsed", len(unique_contents))
+   
+   if (jobs > 1) and (len(unique_contents) >= parallel_parsing_threshold):
+      with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) \
+            as executor:
+         chunksize = max(1, len(unique_contents) // (4*jobs))
+         parsed = list(executor.map(parse_specification, unique_contents,
+                                    chunksize = chunksize))
+   else:
+      parsed = [parse_specification(content) for content in unique_contents]
+      
+   parsed_by_digest = dict(zip(digests, parsed))
+   
+   specifications = {}
+   for filename, real_filename in real_filenames.items():
+      specifications[filename] = parsed_by_digest[
+         content_digests_by_real_filename[real_filename]]
+      
+   return specifications
+
+# Computes a digest of a file's content. The file is memory mapped
+# and hashed in chunks.
+#
+def compute_file_digest(filename):
+   
+   m = hashlib.sha256()
+   
+   with open(filename, 'rb') as stream:
+      
+      size = os.fstat(stream.fileno()).st_size
+      
+      profiler.count("files_hashed")
+      profiler.count("bytes_hashed", size)
+      
+      # Empty files cannot be mapped
+      #
+      if size == 0:
+         return m.hexdigest()
+      
+      with mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+         
+         chunk_size = 1 << 20
+         view = memoryview(mapped)
+         try:
+            for offset in range(0, size, chunk_size):
+               m.update(view[offset:offset + chunk_size])
+         finally:
+            view.release()
+         
+   return m.hexdigest()
+
+# Content digests of files are cached by device, inode, modification
+# time and size. Files that are referenced through different paths 
+# (e.g. hard or symbolic links) are thus only hashed once, and 
+# a file that is modified in place is hashed again.
+#
+class FileDigestCache(object):
+   
+   def __init__(self):
+      self.digests = {}
+      
+   def key(self, stat):
+      return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+   
+   # Registers a digest that is already known, e.g. from the tree 
+   # manifest
+   #
+   def add(self, stat, digest):
+      self.digests[self.key(stat)] = digest
+      
+   def getDigest(self, filename, stat = None):
+      
+      if not stat:
+         stat = os.stat(filename)
+         
+      key = self.key(stat)
+      
+      digest = self.digests.get(key)
+      if not digest:
+         digest = compute_file_digest(filename)
+         self.digests[key] = digest
+         
+      return digest
+   
+file_digest_cache = FileDigestCache()
+
 # Every bit of information that influences a test is an
 # abstract entity. 
 #
@@ -173,6 +728,8 @@ test_specification_pattern         = "*specification.yaml"
 #
 class Entity(object):
    
+   __slots__ = ( "path", )
+   
    def __init__(self):
       self.path = None
    
@@ -180,6 +737,8 @@ class Entity(object):
       self.path = path.path
 
 class File(Entity):
+   
+   __slots__ = ( "filename", )
 
    def __init__(self, filename = None):
        
@@ -187,12 +746,17 @@ class File(Entity):
       
    def __eq__(self, other):
     return self.filename == other.filename
+ 
+   # Returns a digest of the file's content
+   #
+   def getDigest(self):
+      return file_digest_cache.getDigest(self.filename)
 
 class PythonDriver(File):
-   pass
+   __slots__ = ()
 
 class FirmwareSketch(File):
-   pass
+   __slots__ = ()
        
 # A property represents any bit of information that
 # was e.g. collected from the yaml specification. 
@@ -200,8 +764,14 @@ class FirmwareSketch(File):
 # The name is not stored in the property but
 # defined by the class member name.
 #
+# Inherited properties are not copied. All nodes that inherit a 
+# property share the property instance of the node that
+# defined it.
+#
 class Property(Entity):
    
+   __slots__ = ( "value", )
+   
    def __init__(self, value = None):
       
       self.value = value
@@ -224,6 +794,8 @@ class Property(Entity):
 #
 class KaleidoscopeModule(object):
    
+   __slots__ = ( "url", "commit", "name" )
+   
    def __init__(self):
       
       self.url = None
@@ -241,25 +813,130 @@ class KaleidoscopeModule(object):
       m.update(str(self.commit).encode('utf-8'))
       m.update(str(self.name).encode('utf-8'))
       
-      return m.hexdigest()
+      # Many specifications define the same modules
+      #
+      return sys.intern(m.hexdigest())
+    
+# The set of modules of a firmware build. Modules are indexed 
+# by name and by digest. 
+#
+# Firmware builds that are cloned share their module registry until
+# one of them adds a module (copy-on-write). The registry that 
+# is about to be modified is then copied first.
+#
+class ModuleRegistry(object):
+   
+   __slots__ = ( "modules", 
+                 "module_digests", 
+                 "positions_by_name", 
+                 "digest_counts", 
+                 "is_shared", 
+                 "sorted_digests" )
+   
+   def __init__(self, other = None):
+      
+      if other:
+         self.modules = list(other.modules)
+         self.module_digests = list(other.module_digests)
+         self.positions_by_name = dict(other.positions_by_name)
+         self.digest_counts = dict(other.digest_counts)
+      else:
+         self.modules = []
+         self.module_digests = []
+         self.positions_by_name = {}
+         self.digest_counts = {}
+         
+      # Is set as soon as more than one firmware build references
+      # the registry
+      #
+      self.is_shared = False
+      
+      # The sorted concatenation of all module digests (memoized)
+      #
+      self.sorted_digests = None
+      
+   def containsDigest(self, digest):
+      return digest in self.digest_counts
+   
+   # Adds a module. A module with the same name as the new
+   # module is replaced.
+   #
+   def add(self, new_module, new_digest):
+      
+      position = None
+      if new_module.name:
+         position = self.positions_by_name.get(new_module.name)
+         
+      if position is None:
+         if new_module.name:
+            self.positions_by_name[new_module.name] = len(self.modules)
+         self.modules.append(new_module)
+         self.module_digests.append(new_digest)
+      else:
+         old_digest = self.module_digests[position]
+         
+         old_count = self.digest_counts[old_digest]
+         if old_count == 1:
+            del self.digest_counts[old_digest]
+         else:
+            self.digest_counts[old_digest] = old_count - 1
+            
+         self.modules[position] = new_module
+         self.module_digests[position] = new_digest
+         
+      self.digest_counts[new_digest] = self.digest_counts.get(new_digest, 0) + 1
+      
+      self.sorted_digests = None
+      
+   # As the order of updating the overall digest is not commutative 
+   # with respect to the modules, we have to sort them first
+   #
+   def getSortedDigests(self):
+      
+      if self.sorted_digests is None:
+         self.sorted_digests = "".join(sorted(self.module_digests))
+         
+      return self.sorted_digests
     
 class FirmwareBuild(Entity):
+   
+   __slots__ = ( "module_registry", 
+                 "firmware_sketch", 
+                 "boards_url", 
+                 "boards_commit", 
+                 "digest", 
+                 "module_set_digest",
+                 "position",
+                 "module_set" )
 
    def __init__(self, parent_build = None):
       
       if parent_build:
-         self.modules = parent_build.modules
-         self.module_digests = parent_build.module_digests
+         self.module_registry = parent_build.module_registry
+         self.module_registry.is_shared = True
          self.firmware_sketch = parent_build.firmware_sketch
          self.boards_url = parent_build.boards_url
          self.boards_commit = parent_build.boards_commit
       else:
-         self.modules = []
-         self.module_digests = []
+         self.module_registry = ModuleRegistry()
          self.firmware_sketch = None
          self.boards_url = None
          self.boards_commit = None
          
+      # The digests are computed on demand and reset whenever the 
+      # firmware build is modified
+      #
+      self.digest = None
+      self.module_set_digest = None
+      
+      # The unique module set (see determine_module_sets(...))
+      #
+      self.module_set = None
+      
+   @property
+   def modules(self):
+      return self.module_registry.modules
+         
    # Checks if the firmware build is valid, i.e. well 
    # defined
    #
@@ -272,106 +949,141 @@ class FirmwareBuild(Entity):
    # Checks if a certain module is already contained
    #
    def containsModule(self, new_module):
-          
-      new_module_digest = new_module.getDigest()
-
-      # Check if a module with same digest is already present
-      #
-      try:
-         list_index = self.module_digests.index(new_module_digest)
-         
-         # The fact that no exception has been thrown 
-         # indicates that a matching digest was found.
-         
-         # In this case, we do not need to take any 
-         # action and just go with the parent list
-         # of modules.
-         
-         return True
-         
-      except:
-         pass
-         
-      return False
+      return self.module_registry.containsDigest(new_module.getDigest())
    
    # Clones a firmware sketch definition on a certain tree level 
-   # to be customized on the next higher tree level
+   # to be customized on the next higher tree level. The module 
+   # registry is shared until one of the builds adds a module.
    #
    def clone(self):
-            
-      new_self = FirmwareBuild(self)
-      
-      # This firmware build must be made unique.
-      # Therefore, make a shallow copy of modules and module_digests. 
-      #
-      new_self.modules = copy.copy(self.modules)
-      new_self.module_digests = copy.copy(self.module_digests)
-      new_self.firmware_sketch = self.firmware_sketch
-      
-      return new_self
+      return FirmwareBuild(self)
      
-   # Adds a module to the firmware definition
+   # Adds a module to the firmware definition. A module with 
+   # the same name is replaced.
    #
    def addModule(self, new_module):
-
-      new_name = new_module.name
-      do_append = True
       
-      new_digest = new_module.getDigest()
-      
-      if new_name:
+      if self.module_registry.is_shared:
+         self.module_registry = ModuleRegistry(self.module_registry)
          
-         # Checks if the firmware build already
-         # contains a module that has the same name as the new
-         # module. If so, we replace it.
-         #
-         for i, module in enumerate(self.modules):
-            if module.name == new_name:
-               self.modules[i] = new_module
-               self.module_digests[i] = new_digest
-               do_append = False
-               break
-            
-      if do_append:
-         self.modules.append(new_module)
-         self.module_digests.append(new_digest)
+      self.module_registry.add(new_module, new_module.getDigest())
+      
+      self.digest = None
+      self.module_set_digest = None
+      
+   def setFirmwareSketch(self, firmware_sketch):
+      self.firmware_sketch = firmware_sketch
+      self.digest = None
+      
+   def setBoardsUrl(self, boards_url):
+      self.boards_url = boards_url
+      self.digest = None
+      self.module_set_digest = None
+      
+   def setBoardsCommit(self, boards_commit):
+      self.boards_commit = boards_commit
+      self.digest = None
+      self.module_set_digest = None
             
-   # Computes the module_digests of all modules. As the order of
-   # updating the overall digest is not commutative 
-   # with respect to the members, we have to sort them first
+   # Computes a digest of the module set, i.e. of the boards 
+   # repository and the modules, but not of the sketch. The digest
+   # is memoized until the next modification.
    #
-   def getDigest(self):
-
-      module_digests = []
-      for module in self.modules:
-         module_digests.append(module.getDigest())
+   def getModuleSetDigest(self):
+      
+      if self.module_set_digest:
+         return self.module_set_digest
+      
+      m = hashlib.sha256()
+      
+      m.update(self.module_registry.getSortedDigests().encode('utf-8'))
+         
+      m.update(str(self.boards_url).encode('utf-8'))
+      m.update(str(self.boards_commit).encode('utf-8'))
+      
+      self.module_set_digest = sys.intern(m.hexdigest())
       
-      module_digests.sort()
+      return self.module_set_digest
       
+   # Computes a digest of all information that defines the 
+   # firmware build. The digest is memoized until the next 
+   # modification.
+   #
+   def getDigest(self):
+      
+      if self.digest:
+         return self.digest
+
       m = hashlib.sha256()
       
-      for digest in module_digests:
-         m.update(str(digest).encode('utf-8'))
+      m.update(self.module_registry.getSortedDigests().encode('utf-8'))
          
       m.update(str(self.boards_url).encode('utf-8'))
       m.update(str(self.boards_commit).encode('utf-8'))
-      m.update(self.firmware_sketch.filename.encode('utf-8'))
+      
+      # The content of the sketch matters, not its location.
+      # Identical sketches in different directories, thus, share
+      # a firmware build.
+      #
+      m.update(self.firmware_sketch.getDigest().encode('utf-8'))
+      
+      self.digest = m.hexdigest()
+      
+      profiler.count("firmware_digests")
          
-      return m.hexdigest()
+      return self.digest
+   
+   # The build id names the build directory, the scripts and the
+   # targets of a unique firmware build. It is derived from the digest,
+   # so that adding or removing other firmware builds does not
+   # change it.
+   #
+   def getBuildId(self):
+      return self.getDigest()[:16]
 
 # Every subdirectory in the testing directory tree is mapped to an 
 # instance of class TestNode
 #
 class TestNode(object):
+   
+   # There is one test node per directory of the testing tree. 
+   # Slots keep the nodes of large trees compact.
+   #
+   __slots__ = ( "children",
+                 "parent",
+                 "path",
+                 "scan",
+                 "python_driver",
+                 "name",
+                 "description",
+                 "driver_cmd_line_flags",
+                 "boards_url",
+                 "boards_commit",
+                 "is_test_target",
+                 "reused_from_manifest",
+                 "firmware_build",
+                 "has_dedicated_firmware",
+                 "unique_firmware_build",
+                 "global_name" )
     
-   def __init__(self, path, parent = None):
+   def __init__(self, path, parent = None, scan = None, 
+                specifications = None):
       
-      self.children = []
+      # Most nodes are leaves. They share the empty tuple 
+      # (see addChild(...)).
+      #
+      self.children = ()
       
       self.parent = parent
       
       self.path = path
       
+      # The classified content of the node's directory
+      #
+      if not scan:
+         scan = scan_directory(path)
+      self.scan = scan
+      
       self.python_driver = None
    
       # Properties
@@ -387,24 +1099,70 @@ class TestNode(object):
       #
       self.is_test_target = False
       
-      self.setup()
+      # Is set if the node was taken over from the tree manifest
+      # of a previous run
+      #
+      self.reused_from_manifest = False
+      
+      profiler.count("test_nodes")
+      
+      self.setup(specifications)
+      
+   def addChild(self, child):
+      
+      if self.children:
+         self.children.append(child)
+      else:
+         self.children = [child]
       
    # Generates a global name that references the test node
-   # by concatenating the names of all parent nodes.
+   # by concatenating the names of all parent nodes. The name is
+   # computed once during setup, top-down, from the parent's
+   # global name (see setupGlobalName()).
    #
    def generateGlobalName(self):
-     
-      if self.parent:
-         
-         parent_name = self.parent.generateGlobalName()
-         
-         if not (self.name is self.parent.name):
-            return parent_name + "." + self.name.value
-         else:
-            return parent_name
+      return self.global_name
+   
+   # The global name of a root node is prefixed by name_prefix, 
+   # if passed. This keeps the names of tests unique if several 
+   # testing trees are prepared together.
+   #
+   def setupGlobalName(self, name_prefix = None):
+      
+      if not self.parent:
+         self.global_name = self.name.value
+         if name_prefix:
+            self.global_name = name_prefix + "." + self.global_name
+      elif self.name is self.parent.name:
+         self.global_name = self.parent.global_name
       else:
-         return self.name.value
+         self.global_name = self.parent.global_name + "." + self.name.value
+   
+   # Computes a digest of all inputs of the test that is generated 
+   # for this node, i.e. the firmware build, the content of the python 
+   # driver and the driver command line flags.
+   #
+   def getTestDigest(self):
+      
+      m = hashlib.sha256()
+      
+      m.update(self.firmware_build.getDigest().encode('utf-8'))
+      m.update(self.python_driver.getDigest().encode('utf-8'))
+      
+      if self.driver_cmd_line_flags:
+         m.update(str(self.driver_cmd_line_flags.value).encode('utf-8'))
+         
+      return m.hexdigest()
    
+   # Returns the id of the test that is generated for this node. The 
+   # id is derived from the global name, which is unique, and not 
+   # from the position in the tree. Adding or removing tests, thus, 
+   # never changes the ids of other tests.
+   #
+   def getTestId(self):
+      return hashlib.sha256(
+                self.global_name.encode('utf-8')).hexdigest()[:16]
+      
    # Checks if a node is supposed to generated tests.
    # For this to be the case, the node must either be a leaf node
    # or an interior node that defines a __test__ flag file.
@@ -412,59 +1170,46 @@ class TestNode(object):
    def generatesTests(self):
       return self.is_test_target or (len(self.children) == 0)
    
-   # Checks the validity of all test tree nodes and their 
-   # children
+   # Checks the validity of the test node. Returns a list of 
+   # problems that is empty for valid nodes.
    #
-   def recursivelyCheckValidity(self):
+   def validityProblems(self):
       
-      is_valid = True
+      problems = []
       
       if self.generatesTests():
       
-         #sys.stdout.write("A test node \"%s\" has %d children and is test_target: %d\n" % (self.path, len(self.children), self.is_test_target))
-      
          if not self.path:
-            is_valid = False
-            sys.stdout.write(
-               "A test node without a path definition was found.\n")
+            problems.append(
+               "A test node without a path definition was found.")
                   
          if not self.name:
-            is_valid = False
-            sys.stdout.write(
+            problems.append(
                "A test node for path \"%s\" was found that does not "
-               "feature a name.\n" % (self.path))
+               "feature a name." % (self.path))
          
          if not self.description:
-            is_valid = False
-            sys.stdout.write(
+            problems.append(
                "A test node for path \"%s\" was found that does not "
-               "feature a description.\n" % (self.path))
+               "feature a description." % (self.path))
                   
          if not self.python_driver:
-            is_valid = False
-            sys.stdout.write(
+            problems.append(
                "A test node for path \"%s\" was found that does not "
-               "feature a python driver file (%s).\n" 
+               "feature a python driver file (%s)." 
                   % (self.path, test_driver_pattern))
             
          if not self.firmware_build:
-            is_valid = False
-            sys.stdout.write(
+            problems.append(
                "A test node for path \"%s\" was found that does not "
-               "feature a firmware build.\n" % (self.path))
+               "feature a firmware build." % (self.path))
             
-         if not self.firmware_build.checkValidity():
-            is_valid = False
-            sys.stdout.write(
+         elif not self.firmware_build.checkValidity():
+            problems.append(
                "A test node for path \"%s\" was found that does not "
-               "feature a firmware sketch (%s).\n" % (self.path, firmware_sketch_pattern))
-            #sys.stdout.write("Node: " + str(id(self)) + "\n")
-            #sys.stdout.write("FB str: " + str(self.firmware_build) + "\n")
+               "feature a firmware sketch (%s)." % (self.path, firmware_sketch_pattern))
             
-      for child in self.children:
-         is_valid &= child.recursivelyCheckValidity()
-         
-      return is_valid
+      return problems
       
    # Copies a member variable of the parent directory's TestNode to 
    # this node (this can be seen a an inheritance of the respective property)
@@ -476,9 +1221,9 @@ class TestNode(object):
       
    # Looks for a python driver file in the current directory
    #
-   def findPythonDriver(self, path):
+   def findPythonDriver(self, scan):
 
-      python_driver_file = find_unique_file(test_driver_pattern, path,
+      python_driver_file = select_unique_file(scan.python_drivers, scan.path,
                                                "python test driver files")
       if python_driver_file:
          self.python_driver = PythonDriver(python_driver_file)
@@ -491,10 +1236,10 @@ class TestNode(object):
         
    # Looks for a python driver file in the current directory
    #
-   def findFirmwareSketch(self, path):
+   def findFirmwareSketch(self, scan):
       
-      firmware_sketch_file = find_unique_file(firmware_sketch_pattern, path,
-                                               "sketch files")
+      firmware_sketch_file = select_unique_file(scan.firmware_sketches, 
+                                               scan.path, "sketch files")
       
       if firmware_sketch_file:
          
@@ -510,9 +1255,9 @@ class TestNode(object):
                
             self.conditionallyCloneFirmwareBuild()
          
-            self.firmware_build.firmware_sketch \
-               = FirmwareSketch(firmware_sketch_file)
-            self.firmware_build.firmware_sketch.attach(self)
+            firmware_sketch = FirmwareSketch(firmware_sketch_file)
+            firmware_sketch.attach(self)
+            self.firmware_build.setFirmwareSketch(firmware_sketch)
          
          #sys.stdout.write("Sketch file %s\n" % (self.firmware_build.firmware_sketch.filename))
          return
@@ -520,31 +1265,34 @@ class TestNode(object):
    # Looks for an explicit test trigger flag file (such a file
    # is only required for non-leaf directores of the testing tree).
    #
-   def findTestTrigger(self, path):
-      
-      test_trigger = find_file(test_trigger_basename, path)
+   def findTestTrigger(self, scan):
       
-      if test_trigger:
+      if scan.has_test_trigger:
          #sys.stdout.write("File %s in path %s found\n" % (test_trigger, path))
          self.is_test_target = True
       
-   # Reads a yaml specification file, if present.
+   # Evaluates a yaml specification file, if present. The file
+   # is usually parsed in advance (see load_specifications(...)).
    #
-   def parseYAMLDefinitions(self, path):
+   def parseYAMLDefinitions(self, scan, specifications = None):
       
-      yaml_file = find_unique_file(test_specification_pattern, path,
+      yaml_file = select_unique_file(scan.specifications, scan.path,
                                                "test specification files")
       
       if not yaml_file:
          return
       
-      my_yaml = None
-      with open(yaml_file, 'r') as stream:
-         try:
-            my_yaml = yaml.load(stream)
-         except yaml.YAMLError as exc:
-            print(exc)
-            return
+      if specifications and (yaml_file in specifications):
+         my_yaml, error = specifications[yaml_file]
+      else:
+         my_yaml, error = parse_specification(read_file(yaml_file))
+         
+      if error:
+         report(error + "\n")
+         return
+      
+      if not my_yaml:
+         return
             
       # my_yaml now contains all necessary information as 
       # a nested data set of dictionaries and lists
@@ -568,22 +1316,20 @@ class TestNode(object):
       if new_boards_url:
          
          if not self.firmware_build.boards_url \
-               or not (self.firmware_build.firmware_sketch.boards_url \
-                              == new_boards_url):
+               or not (self.firmware_build.boards_url == new_boards_url):
                
             self.conditionallyCloneFirmwareBuild()
          
-            self.firmware_build.boards_url = new_boards_url
+            self.firmware_build.setBoardsUrl(new_boards_url)
          
       new_boards_commit = my_yaml.get("boards_commit") 
       if new_boards_commit:
          if not self.firmware_build.boards_commit \
-               or not (self.firmware_build.firmware_sketch.boards_commit \
-                              == new_boards_commit):
+               or not (self.firmware_build.boards_commit == new_boards_commit):
                
             self.conditionallyCloneFirmwareBuild()
          
-            self.firmware_build.boards_commit = new_boards_commit
+            self.firmware_build.setBoardsCommit(new_boards_commit)
          
       new_modules = my_yaml.get("modules")
       if new_modules:
@@ -625,7 +1371,7 @@ class TestNode(object):
       if not self.has_dedicated_firmware:
          self.cloneFirmwareBuild()
                
-   def setup(self):
+   def setup(self, specifications = None):
       
       if self.parent:
          self.firmware_build = self.parent.firmware_build
@@ -644,49 +1390,36 @@ class TestNode(object):
       # If such a directory is found, anything else (driver, specification, firmware)
       # in the path is ignored.
       #
-      external_specification_dir \
-         = find_file(external_specification_subdir_name, self.path) 
-      
-      if external_specification_dir:
+      if self.scan.external_specification:
          
-         if not os.path.isdir(external_specification_dir):
+         if not self.scan.external_specification_is_dir:
             
-            sys.exit("path \"" + self.path +
+            raise ExternalSpecificationError("path \"" + self.path +
               "\" contains an external specification \"" +
               external_specification_subdir_name
-              + "\" that is not an path.");
+              + "\" that is not an path.", self.path)
          
          # If we found an external specfication path, 
          # check for any other files being present, 
          # appart from the test trigger file.
          # If so, abort with an error.
          
-         all_files = find_files("*", self.path)
-         
          trigger_wrong_files_error = False
-         if len(all_files) > 2:
-            trigger_wrong_files_error = True
-         elif len(all_files) == 2:
-            other_file_is_test_trigger = False
-            if all_files(1) == test_trigger_basename:
-               other_file_is_test_trigger = True
-            elif all_files(2) == test_trigger_basename:
-               other_file_is_test_trigger = True
-               
-            if not other_file_is_test_trigger:
+         for other_file_name in self.scan.file_names:
+            if other_file_name != test_trigger_basename:
                trigger_wrong_files_error = True
             
          if trigger_wrong_files_error:
-            sys.exit("path \"" + self.path +
+            raise ExternalSpecificationError("path \"" + self.path +
               "\" contains an external specification \"" +
               external_specification_subdir_name
               + "\" and also additional files/directories appart from the test trigger (" + test_trigger_basename + "). "
               "Please make sure that either the external specification "
-              "or other files are found.");
+              "or other files are found.", self.path)
          
-         source_path = external_specification_dir
+         source_scan = self.scan.external_scan
       else:
-         source_path = self.path
+         source_scan = self.scan
             
       # Inherit some information from the parent node to generate a
       # default configuration that can be overriden during further 
@@ -703,262 +1436,2562 @@ class TestNode(object):
       # path or the external test reference path
       # determined above.
       
-      self.findPythonDriver(source_path)
-      self.findFirmwareSketch(source_path)
-      self.parseYAMLDefinitions(source_path)
+      self.findPythonDriver(source_scan)
+      self.findFirmwareSketch(source_scan)
+      self.parseYAMLDefinitions(source_scan, specifications)
       
       # Look in the current path for a __test__ trigger file
       #
-      self.findTestTrigger(self.path)
+      self.findTestTrigger(self.scan)
                
       if not self.name:
-         path_basename = os.path.basename(self.path)
+         path_basename = sys.intern(os.path.basename(self.path))
          self.name = Property(path_basename)
          self.name.attach(self)
          
-def setup_testing_tree(testing_tree_root):
+      self.setupGlobalName()
+         
+# Is increased whenever the layout of the tree manifest changes
+#
+manifest_format_version = 4
+
+# The testing tree stored in a manifest depends on the 
+# implementation of this script. A manifest that was written by 
+# a different version of the script is, thus, discarded.
+#
+def compute_script_digest():
+   return compute_file_digest(os.path.abspath(__file__))
+
+# The tree manifest stores the resolved test nodes of a run 
+# together with the signatures of all directories and input
+# files that were scanned to generate them.
+#
+class TreeManifest(object):
    
-   test_nodes_by_path = {}
+   # testing_tree_roots is a list of tuples (root path, name prefix)
+   #
+   def __init__(self, testing_tree_roots):
+      
+      self.format_version = manifest_format_version
+      self.script_digest = compute_script_digest()
+      self.testing_tree_roots = testing_tree_roots
+      
+      # path -> (inode, modification time)
+      #
+      self.directory_signatures = {}
+      
+      # filename -> (device, inode, modification time, size, 
+      #              content digest)
+      #
+      self.file_signatures = {}
+      
+      self.test_nodes_by_path = {}
+      
+   # The test nodes are stored as a flat table with one row 
+   # (path, parent path, node attributes) per node instead of the 
+   # linked tree. Pickling the tree would recurse once per tree level
+   # and fail for deep trees. Rows are ordered parents first, i.e.
+   # the links can be restored in a single pass.
+   #
+   node_attributes = tuple(name for name in TestNode.__slots__
+                           if name not in ("children", "parent"))
    
-   root_node = TestNode(testing_tree_root)
+   def __getstate__(self):
+      
+      state = dict(self.__dict__)
+      
+      test_node_rows = []
+      for path, test_node in self.test_nodes_by_path.items():
+         parent_path = None
+         if test_node.parent:
+            parent_path = test_node.parent.path
+         test_node_rows.append(
+            (path, parent_path, 
+             tuple(getattr(test_node, name, None) 
+                   for name in self.node_attributes)))
+         
+      del state["test_nodes_by_path"]
+      state["test_node_rows"] = test_node_rows
+      
+      return state
    
-   test_nodes_by_path[testing_tree_root] = root_node
+   def __setstate__(self, state):
+      
+      test_node_rows = state.pop("test_node_rows")
+      self.__dict__.update(state)
+      
+      self.test_nodes_by_path = {}
+      for path, parent_path, values in test_node_rows:
+         
+         test_node = TestNode.__new__(TestNode)
+         for name, value in zip(self.node_attributes, values):
+            setattr(test_node, name, value)
+            
+         test_node.children = ()
+         test_node.parent = None
+         if parent_path is not None:
+            test_node.parent = self.test_nodes_by_path[parent_path]
+            test_node.parent.addChild(test_node)
+            
+         self.test_nodes_by_path[path] = test_node
+      
+   # Records the signature of a directory and returns True if it
+   # is unchanged with respect to the previous manifest
+   #
+   def recordDirectory(self, path, previous_manifest):
+      
+      try:
+         stat = os.stat(path)
+      except OSError:
+         return False
+      
+      signature = (stat.st_ino, stat.st_mtime_ns)
+      self.directory_signatures[path] = signature
+      
+      if not previous_manifest:
+         return False
+      
+      return previous_manifest.directory_signatures.get(path) == signature
    
-   # Recursively traverses the testing directory structure
-   # and generate the testing tree.
+   # Records the signature of a file and returns True if its 
+   # content is unchanged with respect to the previous manifest.
+   # The content digest is only recomputed if the file was replaced
+   # (device or inode changed), or if modification time or size 
+   # changed.
    #
-   for dirpath, dirs, files in os.walk(testing_tree_root, followlinks=True):
+   def recordFile(self, filename, previous_manifest):
       
-      # Ignores empty directories
-      #
-      if (len(dirs) == 0) and (len(files) == 0):
-         continue
+      try:
+         stat = os.stat(filename)
+      except OSError:
+         return False
       
-      dirpath_basename = os.path.basename(dirpath)
+      previous_signature = None
+      if previous_manifest:
+         previous_signature = previous_manifest.file_signatures.get(filename)
       
-      # Skips any external testing specification dirs
-      #
-      if dirpath_basename == external_specification_subdir_name:
-         continue
+      if previous_signature \
+            and previous_signature[:4] == file_digest_cache.key(stat):
+         self.file_signatures[filename] = previous_signature
+         file_digest_cache.add(stat, previous_signature[4])
+         return True
+      
+      digest = file_digest_cache.getDigest(filename, stat)
+      self.file_signatures[filename] = file_digest_cache.key(stat) \
+                                          + (digest,)
+      
+      if not previous_signature:
+         return False
+      
+      return previous_signature[4] == digest
+   
+   # Records the signatures of a directory scan (including 
+   # an external specification dir) and returns True if nothing
+   # changed with respect to the previous manifest
+   #
+   def recordScan(self, scan, previous_manifest):
       
-      my_parent_test_node = test_nodes_by_path.get(dirpath)
+      is_unchanged = self.recordDirectory(scan.path, previous_manifest)
       
-      for my_dir in dirs:
+      for filename in scan.inputFiles():
+         is_unchanged &= self.recordFile(filename, previous_manifest)
          
-         # Skip any external testing specification dirs
-         #
-         if my_dir == external_specification_subdir_name:
-            continue
+      if scan.external_scan:
+         is_unchanged &= self.recordScan(scan.external_scan, previous_manifest)
+         
+      return is_unchanged
+   
+# Reads the manifest of a previous run. None is returned if 
+# there is no usable manifest.
+#
+def load_tree_manifest(manifest_filename, testing_tree_roots):
+   
+   if not os.path.exists(manifest_filename):
+      return None
+   
+   try:
+      with open(manifest_filename, 'rb') as stream:
+         manifest = pickle.load(stream)
+   except Exception:
+      report("Ignoring unreadable tree manifest \"%s\"\n" 
+             % manifest_filename)
+      return None
+   
+   if not isinstance(manifest, TreeManifest) \
+         or manifest.format_version != manifest_format_version \
+         or manifest.script_digest != compute_script_digest() \
+         or manifest.testing_tree_roots != testing_tree_roots:
+      return None
+   
+   return manifest
+
+# Writes the manifest. A temporary file is used to ensure that 
+# an interrupted run never leaves a truncated manifest behind.
+#
+def write_tree_manifest(manifest_filename, manifest):
+   
+   with replacing_file(manifest_filename) as stream:
+      pickle.dump(manifest, stream, pickle.HIGHEST_PROTOCOL)
+   
+# Scans a directory or reuses the scan and test node of the
+# previous manifest. As properties are inherited from parent nodes,
+# a node can only be reused if its parent was reused as well and if
+# none of the node's inputs changed.
+#
+# Returns a tuple of the directory scan and the reusable test node
+# (None if the test node must be set up again).
+#
+def plan_directory(path, parent_is_reused, previous_manifest, manifest):
+   
+   if manifest and previous_manifest and parent_is_reused:
+      
+      cached_node = previous_manifest.test_nodes_by_path.get(path)
+      
+      if cached_node \
+            and manifest.recordScan(cached_node.scan, previous_manifest):
+         return (cached_node.scan, cached_node)
+      
+   scan = scan_directory(path)
+   
+   if manifest:
+      manifest.recordScan(scan, previous_manifest)
+      
+   return (scan, None)
+      
+def setup_testing_tree(testing_tree_root, 
+                       previous_manifest = None, 
+                       manifest = None,
+                       jobs = None,
+                       specification_cache = None,
+                       name_prefix = None):
+   
+   # Traverses the testing directory structure top down. 
+   # Every directory is scanned exactly once. Directories are 
+   # registered in the same order as os.walk would visit them. 
+   # External testing specification dirs are never part of 
+   # DirectoryScan.subdirs and are, thus, not traversed.
+   #
+   # Every entry of directories is a tuple 
+   # (path, parent path, scan, reusable test node).
+   #
+   with profiler.phase("directory walk"):
+
+      root_scan, root_cached_node = plan_directory(testing_tree_root, True,
+                                                   previous_manifest, manifest)
+   
+      directories = [(testing_tree_root, None, root_scan, root_cached_node)]
+   
+      directories_to_visit = [0]
+   
+      while directories_to_visit:
+      
+         my_path, my_parent_path, my_scan, my_cached_node \
+            = directories[directories_to_visit.pop()]
+      
+         first_child_id = len(directories)
+      
+         for my_abs_dir in my_scan.subdirs:
          
-         my_abs_dir = os.path.join(dirpath, my_dir)
+            child_scan, child_cached_node \
+               = plan_directory(my_abs_dir, my_cached_node is not None,
+                                previous_manifest, manifest)
          
-         new_test_node = TestNode(my_abs_dir, my_parent_test_node)
+            directories.append((my_abs_dir, my_path, 
+                                child_scan, child_cached_node))
          
-         my_parent_test_node.children.append(new_test_node)
+         directories_to_visit.extend(
+            reversed(range(first_child_id, len(directories))))
+      
+   # Read and parse the specification files of all directories
+   # that must be set up (again) in one go.
+   #
+   with profiler.phase("specification loading"):
+
+      specification_files = []
+      for my_path, my_parent_path, my_scan, my_cached_node in directories:
+      
+         if my_cached_node:
+            continue
+      
+         source_scan = my_scan.external_scan or my_scan
+      
+         if source_scan.specifications:
+            specification_files.append(source_scan.specifications[0])
          
-         test_nodes_by_path[my_abs_dir] = new_test_node
+      specifications = load_cached_specifications(specification_files, jobs,
+                                                  specification_cache)
+   
+   # Generate the testing tree
+   #
+   with profiler.phase("node setup"):
+
+      test_nodes_by_path = {}
+   
+      for my_path, my_parent_path, my_scan, my_cached_node in directories:
+      
+         my_parent_test_node = test_nodes_by_path.get(my_parent_path)
+      
+         if my_cached_node:
+            new_test_node = my_cached_node
+            new_test_node.children = ()
+            new_test_node.reused_from_manifest = True
+         else:
+            new_test_node = TestNode(my_path, my_parent_test_node, 
+                                     my_scan, specifications)
+            
+            # The root node is set up first. Its children inherit
+            # the prefixed global name.
+            #
+            if name_prefix and not my_parent_test_node:
+               new_test_node.setupGlobalName(name_prefix)
          
+         if my_parent_test_node:
+            my_parent_test_node.addChild(new_test_node)
+      
+         test_nodes_by_path[my_path] = new_test_node
+      
    # Perform a validity check ot the testing information contained in
    # the testing directory tree.
    #
-   test_nodes_valid = root_node.recursivelyCheckValidity()
+   with profiler.phase("validity check"):
+      check_test_nodes(test_nodes_by_path)
    
-   if not test_nodes_valid:
-      
-      sys.exit("An invalid testing setup was detected. "
-         "Please correct any errors and start over.")
+   if manifest:
+      manifest.test_nodes_by_path.update(test_nodes_by_path)
          
    return test_nodes_by_path
 
-# Checks and ensures that all tests have individual names. 
-# By defining identical name properties in the yaml specification
-# files, it is possible that two subdirs test nodes
-# are assigned the same global name.
+# Converts a single testing tree root path or a list of
+# (root path, name prefix) tuples to a list of such tuples.
+# Roots must neither be nested nor be passed twice as their 
+# test nodes would be set up twice.
 #
-def check_test_name_uniqueness(test_nodes_by_path):
+def testing_tree_root_list(testing_tree_roots):
    
-   test_name_to_test_node = {}
+   if isinstance(testing_tree_roots, str):
+      return [(testing_tree_roots, None)]
    
-   for test_node in test_nodes_by_path.values():
-      
-      test_name = test_node.generateGlobalName()
-      
-      if test_name in test_name_to_test_node.keys():
-         
-         sys.exit("Two tests in directories \"%s\" and \"%s\" that "
-            "have the same name \"%s\". Please ensure that all tests have individual names" % (test_node.path, test_name_to_test_node.get(test_name).path, test_name))
-         
-      test_name_to_test_node[test_name] = test_node
+   testing_tree_roots = [(root, name_prefix or None) 
+                         for root, name_prefix in testing_tree_roots]
+   
+   real_roots = [os.path.realpath(root) for root, _ in testing_tree_roots]
+   
+   for i, real_root in enumerate(real_roots):
+      for j, other_real_root in enumerate(real_roots):
+         if i != j and (real_root == other_real_root 
+                        or real_root.startswith(other_real_root + os.sep)):
+            raise PrepareTestingError("Testing tree roots \"%s\" and \"%s\" "
+               "overlap" % (testing_tree_roots[i][0], 
+                            testing_tree_roots[j][0]))
+   
+   return testing_tree_roots
 
-# It is possible that different subdirectories of the build tree 
-# specify identical firmware modules and sketch. The corresponding 
-# firmware builds can, however, be shared. To detect this
-# we compute a digest of every firmware build, join builds with
-# identical module_digests and finally assign the unique builds to the test nodes.
+# Sets up several testing trees (see setup_testing_tree(...)) and
+# returns the test nodes of all trees in a single dict, ordered by
+# tree. The trees share the manifest. Tests of different trees must
+# have individual names which is usually achieved by passing
+# individual name prefixes.
 #
-def determine_unique_firmware_builds(test_nodes_by_path):
-
-   # Generate a unique set of firmware builds.
-
-   unique_firmware_builds_by_digest = {}
-
-   set_id = 1
-   for test_node in test_nodes_by_path.values():
+# testing_tree_roots is a list of tuples (root path, name prefix).
+#
+def setup_testing_trees(testing_tree_roots, 
+                        previous_manifest = None, 
+                        manifest = None,
+                        jobs = None,
+                        specification_cache = None):
+   
+   if len(testing_tree_roots) == 1:
+      testing_tree_root, name_prefix = testing_tree_roots[0]
+      return setup_testing_tree(testing_tree_root, 
+                                previous_manifest, 
+                                manifest,
+                                jobs,
+                                specification_cache,
+                                name_prefix)
+   
+   test_nodes_by_path = {}
+   test_nodes_by_name = {}
+   
+   for testing_tree_root, name_prefix in testing_tree_roots:
       
-      if test_node.generatesTests() and \
-            test_node.has_dedicated_firmware:
+      tree_nodes_by_path = setup_testing_tree(testing_tree_root, 
+                                              previous_manifest, 
+                                              manifest,
+                                              jobs,
+                                              specification_cache,
+                                              name_prefix)
+      
+      with profiler.phase("validity check"):
+         for test_node in tree_nodes_by_path.values():
          
-         my_digest = test_node.firmware_build.getDigest()
+            other_test_node = test_nodes_by_name.get(test_node.global_name)
          
-         if not my_digest in unique_firmware_builds_by_digest.keys():
-            test_node.firmware_build.set_id = set_id
-            unique_firmware_builds_by_digest[my_digest] = test_node.firmware_build
-            set_id = set_id + 1
+            if other_test_node:
+               raise TestNameConflictError("Two tests in directories "
+                  "\"%s\" and \"%s\" of different testing trees have "
+                  "the same name \"%s\". Please pass individual name "
+                  "prefixes for the testing trees" 
+                  % (test_node.path, other_test_node.path, 
+                     test_node.global_name),
+                  test_node.global_name, 
+                  [test_node.path, other_test_node.path])
             
-   # Now replace references to modules with the unique versions
-   #
-   for test_node in test_nodes_by_path.values():
-      
-      if test_node.generatesTests():
-         my_digest = test_node.firmware_build.getDigest()
-         
-         test_node.unique_firmware_build \
-            = unique_firmware_builds_by_digest.get(my_digest)
+            test_nodes_by_name[test_node.global_name] = test_node
       
-   return unique_firmware_builds_by_digest
+      test_nodes_by_path.update(tree_nodes_by_path)
       
-def sep_line(file):   
-   file.write(
-"################################################################################\n")
+   return test_nodes_by_path
+
+# Loads specification files like load_specifications(...). If a
+# cache (a dict returned by load_specifications(...)) is passed, only
+# files that are not yet cached are loaded and added to the cache.
+#
+def load_cached_specifications(filenames, jobs = None, 
+                               specification_cache = None):
+   
+   if specification_cache is None:
+      return load_specifications(filenames, jobs)
+   
+   missing_filenames = [filename for filename in filenames 
+                           if filename not in specification_cache]
+   if missing_filenames:
+      specification_cache.update(load_specifications(missing_filenames, 
+                                                     jobs))
       
-# Exports firmware build and test information in a way that resembels
-# CMake function calls.
+   return specification_cache
+
+# Updates the testing tree after the content of some of its 
+# directories changed. changed_paths are the paths of these 
+# directories (or of any directory below, e.g. of an __external__ 
+# directory). Paths outside the testing tree are ignored.
 #
-# A note to developers:
-#    If test specifications are supposed to be generated in other formats,
-#    just copy and adapt this function.
+# The subtree of every changed directory is set up again as 
+# properties are inherited. Only changed directories are scanned
+# again, all other directories of the subtrees keep their scans.
+# Cached specifications of changed directories are discarded.
 #
-def export_as_cmake(cmake_filename, 
-                    test_nodes_by_path, 
-                    unique_firmware_builds_by_digest):
-   
-   cmake_file = open(cmake_filename, "w") 
+# The tree may consist of several testing trees (see 
+# setup_testing_trees(...)). A root node that is set up again keeps 
+# the name prefix of the root node it replaces.
+#
+# Returns a tuple of the new test_nodes_by_path, a list of the test 
+# nodes whose directories were scanned again and a list of the paths
+# of removed test nodes. The passed tree is only modified 
+# if the update succeeds.
+#
+def patch_testing_tree(test_nodes_by_path,
+                       changed_paths,
+                       jobs = None,
+                       specification_cache = None):
    
-   # First export the firmware builds 
+   # Map the changed paths to the closest test nodes
    #
-   sep_line(cmake_file)
-   cmake_file.write("# Kaleidoscope firmware builds\n")
-   sep_line(cmake_file)
-   
-   for digest, firmware_build in sorted(unique_firmware_builds_by_digest.items(), key=lambda x: x[1].set_id):
-   #for digest, firmware_build in unique_firmware_builds_by_digest.items():
-      cmake_file.write("kaleidoscope_firmware_build(\n")
-      cmake_file.write("   BUILD_ID \"" + str(firmware_build.set_id) + "\"\n")
-      if firmware_build.boards_url:
-            cmake_file.write("   BOARDS_URL \"" + str(firmware_build.boards_url) + "\"\n")
-      if firmware_build.boards_commit:
-            cmake_file.write("   BOARDS_COMMIT \"" + str(firmware_build.boards_commit) + "\"\n")
-      cmake_file.write("   DIGEST \"" + str(digest) + "\"\n")
-      cmake_file.write("   FIRMWARE_SKETCH \"" + firmware_build.firmware_sketch.filename + "\"\n")
-      for mod in firmware_build.modules:
-         cmake_file.write("   URL \"" + mod.url + "\"\n")
-         cmake_file.write("   COMMIT \"" + mod.commit + "\"\n")
-         cmake_file.write("   NAME \"" + mod.name + "\"\n")
-      cmake_file.write(")\n")
-      cmake_file.write("\n")  
-      
-   # Now export the test definitions
+   changed_node_paths = set()
+   for path in changed_paths:
+      while path not in test_nodes_by_path:
+         parent_path = os.path.dirname(path)
+         if parent_path == path:
+            path = None
+            break
+         path = parent_path
+      if path:
+         changed_node_paths.add(path)
+         
+   # Only the topmost changed nodes are roots of subtrees that need 
+   # to be set up again
    #
-   sep_line(cmake_file)
-   cmake_file.write("# Kaleidoscope tests\n")
-   sep_line(cmake_file)
+   subtree_roots = []
+   for path in changed_node_paths:
+      node = test_nodes_by_path[path].parent
+      while node and (node.path not in changed_node_paths):
+         node = node.parent
+      if not node:
+         subtree_roots.append(path)
+         
+   rescanned_nodes = []
+   removed_paths = []
+   new_subtrees = {}
    
-   test_id = 1
-   for test_node in test_nodes_by_path.values():
+   for subtree_root in subtree_roots:
       
-      # Any interior nodes of the testing tree have to contain a
-      # tag file for tests for them to be created. 
-      # For leaf nodes of the testing tree, we always generate 
-      # tests.
-      #
-      if not test_node.generatesTests():
-         continue
+      old_root_node = test_nodes_by_path[subtree_root]
       
-      cmake_file.write("kaleidoscope_test(\n")
-      cmake_file.write("   TEST_ID \"" + str(test_id) + "\"\n")
-      cmake_file.write("   TEST_NAME \"" + test_node.generateGlobalName() + "\"\n")
-      cmake_file.write("   TEST_DESCRIPTION \"" + test_node.description.value + "\"\n")
-      if(test_node.driver_cmd_line_flags):
-         cmake_file.write("   DRIVER_CMD_LINE_FLAGS \"" + test_node.driver_cmd_line_flags.value + "\"\n")
-      cmake_file.write("   PYTHON_DRIVER \"" +
-                test_node.python_driver.filename + "\"\n")  
-      cmake_file.write("   FIRMWARE_BUILD_ID \"" +
-                str(test_node.unique_firmware_build.set_id) + "\"\n")
-      
-      # Additional information that is probably not used by CMake
-      #
-      cmake_file.write("\n") 
-      cmake_file.write("   # Directories where information was found\n") 
-      cmake_file.write("   #\n") 
-      cmake_file.write("   NAME_ORIGIN \"" + test_node.name.path + "\"\n")      
-      cmake_file.write("   DESCRIPTION_ORIGIN \"" + test_node.description.path + "\"\n")
-      if test_node.driver_cmd_line_flags:
-         cmake_file.write("   DRIVER_CMD_LINE_FLAGS_ORIGIN \"" + test_node.driver_cmd_line_flags.path + "\"\n")
-      cmake_file.write("   FIRMWARE_BUILD_ORIGIN \"" + test_node.firmware_build.path + "\"\n")
+      # Walk the subtree the same way setup_testing_tree(...) does.
+      # Every entry of directories is a tuple (path, parent path, scan,
+      # flag that signals a new scan).
+      #
+      directories = [(subtree_root, None, scan_directory(subtree_root), True)]
       
-      cmake_file.write(")\n")
-      cmake_file.write("\n")
+      directories_to_visit = [0]
       
-      test_id += 1
-   
-   cmake_file.close()
-   
-   sys.stdout.write("CMake information written to file \"" + cmake_filename
-                    + "\"\n")
-   
-def main():
-    
-    parser = argparse.ArgumentParser( 
-       description = 
+      while directories_to_visit:
+         
+         my_path, my_parent_path, my_scan, my_is_rescanned \
+            = directories[directories_to_visit.pop()]
+         
+         first_child_id = len(directories)
+         
+         for my_abs_dir in my_scan.subdirs:
+            
+            old_node = test_nodes_by_path.get(my_abs_dir)
+            
+            if old_node and (my_abs_dir not in changed_node_paths):
+               directories.append((my_abs_dir, my_path, old_node.scan, False))
+            else:
+               directories.append((my_abs_dir, my_path, 
+                                   scan_directory(my_abs_dir), True))
+               
+         directories_to_visit.extend(
+            reversed(range(first_child_id, len(directories))))
+         
+      specification_files = []
+      for my_path, my_parent_path, my_scan, my_is_rescanned in directories:
+         
+         source_scan = my_scan.external_scan or my_scan
+         
+         if not source_scan.specifications:
+            continue
+         
+         specification_file = source_scan.specifications[0]
+         
+         if my_is_rescanned and (specification_cache is not None):
+            specification_cache.pop(specification_file, None)
+            
+         specification_files.append(specification_file)
+            
+      specifications = load_cached_specifications(specification_files, jobs,
+                                                  specification_cache)
+      
+      subtree_nodes_by_path = {}
+      
+      for my_path, my_parent_path, my_scan, my_is_rescanned in directories:
+         
+         if my_parent_path:
+            my_parent_test_node = subtree_nodes_by_path[my_parent_path]
+         else:
+            my_parent_test_node = old_root_node.parent
+            
+         new_test_node = TestNode(my_path, my_parent_test_node, 
+                                  my_scan, specifications)
+         
+         if not my_parent_test_node:
+            new_test_node.setupGlobalName(root_name_prefix(old_root_node))
+         
+         if my_parent_path:
+            my_parent_test_node.addChild(new_test_node)
+            
+         subtree_nodes_by_path[my_path] = new_test_node
+         
+         if my_is_rescanned:
+            rescanned_nodes.append(new_test_node)
+            
+      new_subtrees[subtree_root] = subtree_nodes_by_path
+      
+   # Replace the subtrees
+   #
+   root_nodes = [test_node for test_node in test_nodes_by_path.values()
+                 if not test_node.parent]
+   
+   for subtree_root, subtree_nodes_by_path in new_subtrees.items():
+      
+      old_root_node = test_nodes_by_path[subtree_root]
+      new_root_node = subtree_nodes_by_path[subtree_root]
+      
+      parent = old_root_node.parent
+      if parent:
+         parent.children[parent.children.index(old_root_node)] \
+            = new_root_node
+      else:
+         root_nodes[root_nodes.index(old_root_node)] = new_root_node
+         
+      old_nodes = [old_root_node]
+      while old_nodes:
+         old_node = old_nodes.pop()
+         if old_node.path not in subtree_nodes_by_path:
+            removed_paths.append(old_node.path)
+         old_nodes.extend(old_node.children)
+         
+   # Register the test nodes in the same order as 
+   # setup_testing_trees(...) does
+   #
+   new_test_nodes_by_path = {}
+   
+   for root_node in root_nodes:
+      
+      new_test_nodes_by_path[root_node.path] = root_node
+   
+      nodes_to_visit = [root_node]
+   
+      while nodes_to_visit:
+      
+         test_node = nodes_to_visit.pop()
+      
+         for child in test_node.children:
+            new_test_nodes_by_path[child.path] = child
+         
+         nodes_to_visit.extend(reversed(test_node.children))
+      
+   return (new_test_nodes_by_path, rescanned_nodes, removed_paths)
+
+# Returns the name prefix that was passed for the testing tree of a
+# root node (see TestNode.setupGlobalName(...)) or None
+#
+def root_name_prefix(root_node):
+   
+   name = root_node.name.value
+   
+   if root_node.global_name == name:
+      return None
+   
+   return root_node.global_name[:-len(name) - 1]
+
+# Checks the validity of all test nodes and ensures that all tests 
+# have individual names in a single pass over the nodes. 
+# By defining identical name properties in the yaml specification
+# files, it is possible that two subdirs test nodes
+# are assigned the same global name.
+#
+def check_test_nodes(test_nodes_by_path):
+   
+   problems = []
+   
+   test_name_to_test_node = {}
+   
+   name_conflict = None
+   
+   for test_node in test_nodes_by_path.values():
+      
+      problems += test_node.validityProblems()
+      
+      test_name = test_node.global_name
+      
+      other_test_node = test_name_to_test_node.get(test_name)
+      
+      if other_test_node:
+         if not name_conflict:
+            name_conflict = (test_node, other_test_node)
+      else:
+         test_name_to_test_node[test_name] = test_node
+         
+   if problems:
+      
+      raise InvalidTestingTreeError("An invalid testing setup was detected. "
+         "Please correct any errors and start over.", problems)
+      
+   if name_conflict:
+      
+      test_node, other_test_node = name_conflict
+      
+      raise TestNameConflictError("Two tests in directories \"%s\" and \"%s\" that "
+         "have the same name \"%s\". Please ensure that all tests have individual names" % (test_node.path, other_test_node.path, test_node.global_name),
+         test_node.global_name, [test_node.path, other_test_node.path])
+
+# It is possible that different subdirectories of the build tree 
+# specify identical firmware modules and sketch. The corresponding 
+# firmware builds can, however, be shared. To detect this
+# we compute a digest of every firmware build, join builds with
+# identical module_digests and finally assign the unique builds to the test nodes.
+#
+def determine_unique_firmware_builds(test_nodes_by_path):
+
+   # Generate a unique set of firmware builds.
+
+   unique_firmware_builds_by_digest = {}
+
+   position = 1
+   for test_node in test_nodes_by_path.values():
+      
+      if test_node.generatesTests() and \
+            test_node.has_dedicated_firmware:
+         
+         my_digest = test_node.firmware_build.getDigest()
+         
+         if not my_digest in unique_firmware_builds_by_digest.keys():
+            test_node.firmware_build.position = position
+            unique_firmware_builds_by_digest[my_digest] = test_node.firmware_build
+            position = position + 1
+            
+   # Now replace references to modules with the unique versions.
+   # A test node may share the firmware build of an ancestor that 
+   # does not generate tests itself. Such builds are registered
+   # on first use.
+   #
+   for test_node in test_nodes_by_path.values():
+      
+      if test_node.generatesTests():
+         my_digest = test_node.firmware_build.getDigest()
+         
+         if not my_digest in unique_firmware_builds_by_digest.keys():
+            test_node.firmware_build.position = position
+            unique_firmware_builds_by_digest[my_digest] = test_node.firmware_build
+            position = position + 1
+         
+         test_node.unique_firmware_build \
+            = unique_firmware_builds_by_digest.get(my_digest)
+            
+   determine_module_sets(unique_firmware_builds_by_digest)
+      
+   return unique_firmware_builds_by_digest
+
+# The boards repository and the modules that are shared by
+# firmware builds that only differ in their sketch
+#
+class ModuleSet(object):
+   
+   __slots__ = ( "digest", "position", "firmware_build" )
+   
+   def __init__(self, digest, position, firmware_build):
+      
+      self.digest = digest
+      self.position = position
+      
+      # The first firmware build that uses the module set. It 
+      # defines boards repository and modules.
+      #
+      self.firmware_build = firmware_build
+      
+   @property
+   def boards_url(self):
+      return self.firmware_build.boards_url
+   
+   @property
+   def boards_commit(self):
+      return self.firmware_build.boards_commit
+   
+   @property
+   def modules(self):
+      return self.firmware_build.modules
+   
+   # Like the build id of a firmware build, the module set id is 
+   # derived from the digest
+   #
+   def getModuleSetId(self):
+      return self.digest[:16]
+      
+# Assigns a unique module set to every unique firmware build. Module
+# sets are ordered like the firmware builds that use them first.
+#
+def determine_module_sets(unique_firmware_builds_by_digest):
+   
+   module_sets_by_digest = {}
+   
+   for digest, firmware_build \
+         in sorted_firmware_builds(unique_firmware_builds_by_digest):
+      
+      module_set_digest = firmware_build.getModuleSetDigest()
+      
+      module_set = module_sets_by_digest.get(module_set_digest)
+      if not module_set:
+         module_set = ModuleSet(module_set_digest, 
+                                len(module_sets_by_digest) + 1,
+                                firmware_build)
+         module_sets_by_digest[module_set_digest] = module_set
+         
+      firmware_build.module_set = module_set
+      
+   return module_sets_by_digest
+
+# Returns the module sets of a set of unique firmware builds in order 
+# of first use together with the firmware builds that use them, 
+# i.e. a list of tuples (module set, list of firmware builds).
+#
+def sorted_module_sets(unique_firmware_builds_by_digest):
+   
+   firmware_builds_by_module_set = {}
+   
+   for digest, firmware_build \
+         in sorted_firmware_builds(unique_firmware_builds_by_digest):
+      firmware_builds_by_module_set.setdefault(
+         firmware_build.module_set, []).append(firmware_build)
+      
+   return sorted(firmware_builds_by_module_set.items(), 
+                 key = lambda x: x[0].position)
+      
+# Estimated costs (in seconds) of firmware builds and test runs
+# without a recorded history
+#
+default_firmware_build_cost = 60.0
+default_test_cost           = 1.0
+
+# Parses a shard specification INDEX/COUNT, e.g. 0/4. Shard indices
+# are zero based.
+#
+def parse_shard(shard):
+
+   try:
+      index, count = [int(x) for x in shard.split("/")]
+   except ValueError:
+      raise ShardSpecificationError("Invalid shard specification \"%s\", "
+                                    "expected INDEX/COUNT" % shard)
+
+   if count < 1 or index < 0 or index >= count:
+      raise ShardSpecificationError("Invalid shard specification \"%s\", "
+                                    "INDEX must be in [0, COUNT)" % shard)
+
+   return (index, count)
+
+# Reads recorded costs of firmware builds and tests. The file is
+# either a timing history database (see timing_history.py) or
+# a JSON object
+#
+#   { "firmware_builds" : { <firmware digest> : <seconds>, ... },
+#     "tests" : { <test name or digest> : <seconds>, ... } }
+#
+def load_shard_costs(costs_filename):
+   
+   import timing_history
+
+   if timing_history.is_history_file(costs_filename):
+      with timing_history.TimingHistory(costs_filename) as history:
+         return history.exportCosts()
+
+   try:
+      with open(costs_filename, "r") as stream:
+         costs = json.load(stream)
+   except (OSError, ValueError) as exc:
+      report("Ignoring shard costs \"%s\": %s\n" % (costs_filename, exc))
+      return {}
+
+   return costs
+
+# Estimates the cost of every unique firmware build, including all
+# tests that use it. Returns a dict { firmware digest : cost }.
+#
+def estimate_firmware_build_costs(test_nodes_by_path,
+                                  unique_firmware_builds_by_digest,
+                                  costs = None):
+
+   costs = costs or {}
+   build_costs = costs.get("firmware_builds", {})
+   test_costs = costs.get("tests", {})
+
+   estimated_costs = {}
+   for digest in unique_firmware_builds_by_digest.keys():
+      estimated_costs[digest] \
+         = build_costs.get(digest, default_firmware_build_cost)
+
+   for test_node in test_nodes_by_path.values():
+      if not test_node.generatesTests():
+         continue
+      test_cost = test_costs.get(test_node.generateGlobalName())
+      if test_cost is None:
+         test_cost = test_costs.get(test_node.getTestDigest(), 
+                                    default_test_cost)
+      estimated_costs[test_node.unique_firmware_build.getDigest()] \
+         += test_cost
+
+   return estimated_costs
+
+# Assigns every unique firmware build to a shard. Builds are
+# distributed in the order of decreasing costs, each to the shard
+# with the least total cost so far (longest processing time first).
+# Ties are broken by digest and shard index, i.e. every CI node
+# computes the same assignment from the same testing tree.
+#
+# Returns a dict { firmware digest : shard index }.
+#
+def assign_shards(estimated_costs, shard_count):
+
+   shard_loads = [0.0] * shard_count
+   shards_by_digest = {}
+
+   for digest, cost in sorted(estimated_costs.items(),
+                              key = lambda x: (-x[1], x[0])):
+
+      shard = min(range(shard_count), key = lambda i: (shard_loads[i], i))
+
+      shards_by_digest[digest] = shard
+      shard_loads[shard] += cost
+
+   return shards_by_digest
+
+# Restricts the test nodes and firmware builds to those of
+# a single shard. All tests that use the same firmware build are
+# assigned to the same shard, i.e. every firmware is build on exactly
+# one shard.
+#
+# Returns a tuple (test nodes by path, unique firmware builds by digest).
+#
+def select_shard(test_nodes_by_path,
+                 unique_firmware_builds_by_digest,
+                 shard_index,
+                 shard_count,
+                 costs = None):
+
+   estimated_costs = estimate_firmware_build_costs(
+                        test_nodes_by_path,
+                        unique_firmware_builds_by_digest,
+                        costs)
+
+   shards_by_digest = assign_shards(estimated_costs, shard_count)
+
+   shard_builds_by_digest = {}
+   for digest, firmware_build in unique_firmware_builds_by_digest.items():
+      if shards_by_digest[digest] == shard_index:
+         shard_builds_by_digest[digest] = firmware_build
+
+   shard_nodes_by_path = {}
+   for path, test_node in test_nodes_by_path.items():
+      if test_node.generatesTests() \
+            and test_node.unique_firmware_build.getDigest() \
+                  not in shard_builds_by_digest:
+         continue
+      shard_nodes_by_path[path] = test_node
+
+   shard_cost = sum(estimated_costs[digest]
+                    for digest in shard_builds_by_digest.keys())
+
+   report("Shard %d/%d: %d of %d firmware builds, "
+          "estimated cost %.0f s of %.0f s\n"
+      % (shard_index, shard_count, len(shard_builds_by_digest),
+         len(unique_firmware_builds_by_digest), shard_cost,
+         sum(estimated_costs.values())))
+
+   return (shard_nodes_by_path, shard_builds_by_digest)
+
+# Returns all files of a test node's directory that influence the
+# node and its descendants, i.e. sketches, drivers and specifications
+# (possibly within __external__), the __external__ entry itself and
+# the test trigger.
+#
+def test_node_input_files(test_node):
+
+   scan = test_node.scan
+
+   input_files = []
+   if scan.external_scan:
+      input_files += scan.external_scan.inputFiles()
+   else:
+      input_files += scan.inputFiles()
+
+   if scan.external_specification:
+      input_files.append(scan.external_specification)
+
+   if scan.has_test_trigger:
+      input_files.append(os.path.join(test_node.path, test_trigger_basename))
+
+   return input_files
+
+# Builds a reverse index that maps the real path of every input file
+# to the paths of all test nodes that generate tests and are affected
+# by the file. As properties are inherited, a test node depends on the
+# input files of its own directory and of all its ancestors.
+#
+def build_input_file_index(test_nodes_by_path):
+
+   input_files_by_node = {}
+   for path, test_node in test_nodes_by_path.items():
+      input_files_by_node[path] = [os.path.realpath(input_file)
+                                   for input_file
+                                   in test_node_input_files(test_node)]
+
+   test_paths_by_input_file = {}
+   for path, test_node in test_nodes_by_path.items():
+
+      if not test_node.generatesTests():
+         continue
+
+      node = test_node
+      while node:
+         for input_file in input_files_by_node[node.path]:
+            test_paths_by_input_file.setdefault(input_file, set()).add(path)
+         node = node.parent
+
+   return test_paths_by_input_file
+
+# Checks if a file name could denote an input file, e.g. one that
+# was removed since a given revision
+#
+def is_input_file_name(filename):
+
+   basename = os.path.basename(filename)
+
+   return basename in (test_trigger_basename,
+                       external_specification_subdir_name) \
+      or fnmatch.fnmatch(basename, firmware_sketch_pattern) \
+      or fnmatch.fnmatch(basename, test_driver_pattern) \
+      or fnmatch.fnmatch(basename, test_specification_pattern)
+
+# Determines the paths of all test nodes that are affected by a set
+# of changed files.
+#
+# - Known input files affect the test nodes of the reverse index.
+# - Any other input file (e.g. a removed one) affects all tests
+#   below the closest existing directory of the testing tree.
+# - Changes outside of the testing trees (e.g. of the tested module's
+#   source code) affect all tests.
+# - Any other change within a testing tree is ignored.
+#
+# testing_tree_roots is a list of the root paths of all testing trees.
+#
+def determine_affected_test_paths(test_nodes_by_path,
+                                  testing_tree_roots,
+                                  changed_files):
+
+   test_paths_by_input_file = build_input_file_index(test_nodes_by_path)
+
+   nodes_by_real_path = {}
+   for test_node in test_nodes_by_path.values():
+      nodes_by_real_path[os.path.realpath(test_node.path)] = test_node
+
+   real_roots = [os.path.realpath(testing_tree_root)
+                 for testing_tree_root in testing_tree_roots]
+
+   affected_paths = set()
+   for changed_file in changed_files:
+
+      real_file = os.path.realpath(changed_file)
+
+      if real_file in test_paths_by_input_file:
+         affected_paths |= test_paths_by_input_file[real_file]
+         continue
+
+      real_root = None
+      for candidate in real_roots:
+         if real_file == candidate \
+               or real_file.startswith(candidate + os.sep):
+            real_root = candidate
+            break
+
+      if not real_root:
+         report("File \"%s\" outside of the testing tree changed, "
+                "selecting all tests\n" % changed_file)
+         return set(path for path, test_node in test_nodes_by_path.items()
+                    if test_node.generatesTests())
+
+      if not is_input_file_name(real_file):
+         continue
+
+      # Find the closest directory of the testing tree. Files within
+      # __external__ directories belong to the parent.
+      #
+      directory = os.path.dirname(real_file)
+      while directory not in nodes_by_real_path and directory != real_root:
+         directory = os.path.dirname(directory)
+
+      if directory not in nodes_by_real_path:
+         continue
+
+      nodes = [nodes_by_real_path[directory]]
+      while nodes:
+         test_node = nodes.pop()
+         if test_node.generatesTests():
+            affected_paths.add(test_node.path)
+         nodes += test_node.children
+
+   return affected_paths
+
+# Determines the files that changed in the git repository that contains
+# the testing tree since a given revision, including uncommitted
+# and untracked files. Returns absolute paths.
+#
+def git_changed_files(testing_tree_root, revision, git_executable = "git"):
+   
+   import subprocess
+
+   def git(args):
+      try:
+         output = subprocess.check_output([git_executable] + args,
+                                          cwd = testing_tree_root)
+      except (subprocess.CalledProcessError, OSError) as exc:
+         raise GitError("Unable to determine changed files since \"%s\": %s"
+                        % (revision, exc))
+      return output.decode('utf-8').splitlines()
+
+   toplevel = git(["rev-parse", "--show-toplevel"])[0]
+
+   changed_files = git(["diff", "--name-only", revision, "--"]) \
+                 + git(["ls-files", "--others", "--exclude-standard",
+                        "--full-name"])
+
+   return [os.path.join(toplevel, changed_file)
+           for changed_file in changed_files if changed_file]
+
+# Restricts the test nodes to those affected by a set of changed files
+# and the firmware builds to those that are used by the affected nodes.
+#
+# Returns a tuple (test nodes by path, unique firmware builds by digest).
+#
+def select_changed(test_nodes_by_path,
+                   unique_firmware_builds_by_digest,
+                   testing_tree_roots,
+                   changed_files):
+
+   affected_paths = determine_affected_test_paths(test_nodes_by_path,
+                                                  testing_tree_roots,
+                                                  changed_files)
+
+   selected_nodes_by_path = {}
+   selected_builds_by_digest = {}
+   n_tests = 0
+   for path, test_node in test_nodes_by_path.items():
+
+      if test_node.generatesTests():
+         n_tests += 1
+         if path not in affected_paths:
+            continue
+         firmware_build = test_node.unique_firmware_build
+         selected_builds_by_digest[firmware_build.getDigest()] \
+            = firmware_build
+
+      selected_nodes_by_path[path] = test_node
+
+   report("%d changed file(s) affect %d of %d tests and "
+          "%d of %d firmware builds\n"
+      % (len(changed_files), len(affected_paths), n_tests,
+         len(selected_builds_by_digest),
+         len(unique_firmware_builds_by_digest)))
+
+   return (selected_nodes_by_path, selected_builds_by_digest)
+
+# The pseudo URL values that are resolved by the build system and 
+# can therefore not be mirrored.
+#
+unmirrored_urls = set(["__NONE__", "__TARGET__", ""])
+
+# Determines the path of the mirror of a git repository. The
+# basename of the URL is kept to simplify identifying mirrors.
+#
+def git_mirror_path(git_mirror_dir, url):
+   
+   url_basename = os.path.splitext(os.path.basename(url.rstrip("/")))[0]
+   url_digest = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+   
+   return os.path.join(git_mirror_dir, 
+                       url_basename + "-" + url_digest + ".git")
+
+# The commit that the build system checks out for modules 
+# that do not specify one
+#
+default_module_commit = "origin/master"
+
+# Collects the distinct repository URLs of all unique firmware builds
+# together with the commits that are checked out from them. Every
+# URL is assigned a mirror path.
+#
+# Returns a list of git_executor.GitOperation objects, ordered by 
+# first occurrence of the URLs.
+#
+def plan_git_operations(git_mirror_dir, 
+                        unique_firmware_builds_by_digest,
+                        default_boards_url = None,
+                        default_boards_commit = None,
+                        additional_urls = []):
+   
+   import git_executor
+   
+   # (url, commit) tuples. The commit may be None.
+   #
+   checkouts = []
+   
+   for firmware_build in sorted(unique_firmware_builds_by_digest.values(), 
+                                key = lambda x: x.position):
+      
+      checkouts.append((firmware_build.boards_url or default_boards_url,
+                        firmware_build.boards_commit or default_boards_commit))
+      
+      for mod in firmware_build.modules:
+         
+         commit = mod.commit
+         if commit == "__NONE__":
+            commit = default_module_commit
+            
+         checkouts.append((mod.url, commit))
+         
+   for url in additional_urls:
+      checkouts.append((url, None))
+   
+   operations_by_url = {}
+   
+   for url, commit in checkouts:
+      
+      if (not url) or (url in unmirrored_urls):
+         continue
+      
+      operation = operations_by_url.get(url)
+      if not operation:
+         operation = git_executor.GitOperation(url, 
+                                 git_mirror_path(git_mirror_dir, url))
+         operations_by_url[url] = operation
+         
+      if commit and (commit not in unmirrored_urls) \
+            and (commit not in operation.commits):
+         operation.commits.append(commit)
+      
+   return list(operations_by_url.values())
+
+# Returns the unique firmware builds in the order of their first use
+# by the test nodes
+#
+def sorted_firmware_builds(unique_firmware_builds_by_digest):
+   return sorted(unique_firmware_builds_by_digest.items(), 
+                 key = lambda x: x[1].position)
+
+# Iterates over all test nodes that generate tests and yields tuples
+# (test id, test node), see TestNode.getTestId().
+#
+def enumerate_tests(test_nodes_by_path):
+   
+   for test_node in test_nodes_by_path.values():
+      
+      # Any interior nodes of the testing tree have to contain a
+      # tag file for tests for them to be created. 
+      # For leaf nodes of the testing tree, we always generate 
+      # tests.
+      #
+      if not test_node.generatesTests():
+         continue
+      
+      yield (test_node.getTestId(), test_node)
+      
+# The layout of the build directory that is established by the 
+# CMake build system (see CMakeLists.txt). Exporters for other
+# build systems reuse the scripts that CMake generates for every
+# firmware build and test.
+#
+def firmware_build_dir(build_dir, build_id):
+   return os.path.join(build_dir, "firmware", str(build_id), "build")
+
+def firmware_binary(build_dir, build_id):
+   return os.path.join(firmware_build_dir(build_dir, build_id), 
+                       "kaleidoscope.firmware")
+
+def firmware_build_script(build_dir, build_id):
+   return os.path.join(build_dir, "cmake_scripts", 
+                       "build_firmware_%s.script.cmake" % str(build_id))
+
+def firmware_build_log_file(build_dir, build_id):
+   return os.path.join(firmware_build_dir(build_dir, build_id), 
+                       "leidokos-testing.build.log.txt")
+
+# The modules of a module set are checked out to and compiled in
+# the module set directory
+#
+def module_set_dir(build_dir, module_set_id):
+   return os.path.join(build_dir, "module_sets", str(module_set_id))
+
+def leidokos_python_module_dir(build_dir, module_set_id):
+   return os.path.join(module_set_dir(build_dir, module_set_id),
+                       "hardware", "keyboardio", "avr", "libraries",
+                       "Leidokos-Python", "python")
+
+def test_script(build_dir, test_id):
+   return os.path.join(build_dir, "cmake_scripts", 
+                       "run_test_%s.script.cmake" % str(test_id))
+
+def test_log_file(build_dir, test_name):
+   return os.path.join(build_dir, "test_logs", test_name + ".log")
+
+def sep_line(file):   
+   file.write(
+"################################################################################\n")
+
+# Files that are replaced receive the usual mode of new files instead 
+# of the mode 0600 of temporary files
+#
+def determine_default_file_mode():
+   umask = os.umask(0)
+   os.umask(umask)
+   return 0o666 & ~umask
+
+default_file_mode = determine_default_file_mode()
+
+# A context manager that yields a binary stream to a temporary file
+# and atomically replaces filename by the file when the block is left
+# without an exception. Otherwise the temporary file is removed.
+#
+# Temporary files are uniquely named and created in the directory of
+# the file, just like in firmware_cache.atomic_write(...). Concurrent
+# runs that write the same file, thus, never write to each other's
+# temporary files.
+#
+@contextlib.contextmanager
+def replacing_file(filename):
+   
+   fd, tmp_filename = tempfile.mkstemp(
+                         dir = os.path.dirname(os.path.abspath(filename)), 
+                         prefix = ".tmp.")
+   try:
+      with os.fdopen(fd, 'wb') as stream:
+         yield stream
+      os.chmod(tmp_filename, default_file_mode)
+      os.replace(tmp_filename, filename)
+   except BaseException:
+      if os.path.exists(tmp_filename):
+         os.remove(tmp_filename)
+      raise
+      
+# Writes content to a file unless the file already has exactly this
+# content, i.e. unchanged files keep their modification time and
+# do not trigger any dependent build steps. Files are replaced 
+# atomically. Returns True if the file was written.
+#
+def write_file_if_changed(filename, content):
+   
+   data = content.encode('utf-8')
+   
+   try:
+      if os.path.getsize(filename) == len(data):
+         with open(filename, 'rb') as stream:
+            if stream.read() == data:
+               return False
+   except OSError:
+      pass
+   
+   with replacing_file(filename) as stream:
+      stream.write(data)
+   
+   return True
+   
+# Tests are exported in groups of all tests of a directory's 
+# child nodes (and the directory itself in case of the root node).
+# Groups are named by a digest of the directory path.
+#
+def cmake_test_group_digest(test_node):
+   
+   group_path = test_node.path
+   if test_node.parent:
+      group_path = test_node.parent.path
+      
+   return hashlib.sha256(group_path.encode('utf-8')).hexdigest()
+
+# The directory that holds the parts of a CMake test definition file
+#
+def cmake_parts_dir(cmake_filename):
+   return os.path.splitext(cmake_filename)[0] + ".d"
+   
+def export_cmake_git_mirrors(cmake_file, git_operations):
+   
+   sep_line(cmake_file)
+   cmake_file.write("# Shared git mirrors\n")
+   sep_line(cmake_file)
+   
+   for operation in git_operations:
+      if not os.path.isdir(operation.mirror):
+         continue
+      cmake_file.write("kaleidoscope_git_mirror(\n")
+      cmake_file.write("   URL \"" + operation.url + "\"\n")
+      cmake_file.write("   MIRROR \"" + operation.mirror + "\"\n")
+      cmake_file.write(")\n")
+      cmake_file.write("\n")
+   
+def export_cmake_module_set(cmake_file, module_set):
+   
+   sep_line(cmake_file)
+   cmake_file.write("# Kaleidoscope module set\n")
+   sep_line(cmake_file)
+   
+   cmake_file.write("kaleidoscope_module_set(\n")
+   cmake_file.write("   MODULE_SET_ID \"" + str(module_set.getModuleSetId()) + "\"\n")
+   if module_set.boards_url:
+         cmake_file.write("   BOARDS_URL \"" + str(module_set.boards_url) + "\"\n")
+   if module_set.boards_commit:
+         cmake_file.write("   BOARDS_COMMIT \"" + str(module_set.boards_commit) + "\"\n")
+   cmake_file.write("   DIGEST \"" + str(module_set.digest) + "\"\n")
+   for mod in module_set.modules:
+      cmake_file.write("   URL \"" + mod.url + "\"\n")
+      cmake_file.write("   COMMIT \"" + mod.commit + "\"\n")
+      cmake_file.write("   NAME \"" + mod.name + "\"\n")
+   cmake_file.write(")\n")
+   cmake_file.write("\n")  
+   
+def export_cmake_firmware_build(cmake_file, digest, firmware_build):
+   
+   sep_line(cmake_file)
+   cmake_file.write("# Kaleidoscope firmware build\n")
+   sep_line(cmake_file)
+   
+   cmake_file.write("kaleidoscope_firmware_build(\n")
+   cmake_file.write("   BUILD_ID \"" + str(firmware_build.getBuildId()) + "\"\n")
+   cmake_file.write("   MODULE_SET_ID \"" + str(firmware_build.module_set.getModuleSetId()) + "\"\n")
+   cmake_file.write("   DIGEST \"" + str(digest) + "\"\n")
+   cmake_file.write("   FIRMWARE_SKETCH \"" + firmware_build.firmware_sketch.filename + "\"\n")
+   cmake_file.write(")\n")
+   cmake_file.write("\n")  
+   
+def export_cmake_test(cmake_file, test_id, test_node):
+      
+   cmake_file.write("kaleidoscope_test(\n")
+   cmake_file.write("   TEST_ID \"" + str(test_id) + "\"\n")
+   cmake_file.write("   TEST_NAME \"" + test_node.generateGlobalName() + "\"\n")
+   cmake_file.write("   TEST_DESCRIPTION \"" + test_node.description.value + "\"\n")
+   if(test_node.driver_cmd_line_flags):
+      cmake_file.write("   DRIVER_CMD_LINE_FLAGS \"" + test_node.driver_cmd_line_flags.value + "\"\n")
+   cmake_file.write("   PYTHON_DRIVER \"" +
+             test_node.python_driver.filename + "\"\n")  
+   cmake_file.write("   FIRMWARE_BUILD_ID \"" +
+             str(test_node.unique_firmware_build.getBuildId()) + "\"\n")
+   cmake_file.write("   TEST_DIGEST \"" + test_node.getTestDigest() + "\"\n")
+   
+   # Additional information that is probably not used by CMake
+   #
+   cmake_file.write("\n") 
+   cmake_file.write("   # Directories where information was found\n") 
+   cmake_file.write("   #\n") 
+   cmake_file.write("   NAME_ORIGIN \"" + test_node.name.path + "\"\n")      
+   cmake_file.write("   DESCRIPTION_ORIGIN \"" + test_node.description.path + "\"\n")
+   if test_node.driver_cmd_line_flags:
+      cmake_file.write("   DRIVER_CMD_LINE_FLAGS_ORIGIN \"" + test_node.driver_cmd_line_flags.path + "\"\n")
+   cmake_file.write("   FIRMWARE_BUILD_ORIGIN \"" + test_node.firmware_build.path + "\"\n")
+   
+   cmake_file.write(")\n")
+   cmake_file.write("\n")
+      
+# Exports firmware build and test information in a way that resembels
+# CMake function calls.
+#
+# The information is split into one file per firmware build 
+# (firmware_build_<digest>.cmake) and one file per group of tests
+# of sibling directories (tests_<digest>.cmake). The files are
+# stored in a directory next to the CMake file (e.g. 
+# test_definitions.d for test_definitions.cmake) and the CMake file
+# itself is an index that includes them. Every file is assembled in
+# memory and only written if its content changed. Files of 
+# firmware builds and tests that disappeared are removed.
+#
+# A note to developers:
+#    If test specifications are supposed to be generated in other formats,
+#    just copy and adapt this function.
+#
+def export_as_cmake(cmake_filename, 
+                    test_nodes_by_path, 
+                    unique_firmware_builds_by_digest,
+                    git_operations = None):
+   
+   parts_dir = cmake_parts_dir(cmake_filename)
+   os.makedirs(parts_dir, exist_ok = True)
+   
+   parts_dir_name = os.path.basename(parts_dir)
+   
+   # The index is collected while the parts are written
+   #
+   index_file = io.StringIO()
+   
+   sep_line(index_file)
+   index_file.write("# Kaleidoscope firmware builds and tests\n")
+   sep_line(index_file)
+   
+   n_parts = 0
+   n_written = 0
+   
+   # Every part is written as soon as it is complete
+   #
+   def write_part(part_name, cmake_file):
+      index_file.write("include(\"${CMAKE_CURRENT_LIST_DIR}/%s/%s\")\n"
+                       % (parts_dir_name, part_name))
+      return write_file_if_changed(os.path.join(parts_dir, part_name),
+                                   cmake_file.getvalue())
+   
+   # Git mirrors must be known before the firmware builds are defined
+   #
+   if git_operations:
+      cmake_file = io.StringIO()
+      export_cmake_git_mirrors(cmake_file, git_operations)
+      n_written += write_part("git_mirrors.cmake", cmake_file)
+      n_parts += 1
+   
+   # Module sets must be defined before the firmware builds that use
+   # them
+   #
+   module_sets = sorted_module_sets(unique_firmware_builds_by_digest)
+   
+   module_set_digests = set()
+   for module_set, firmware_builds in module_sets:
+      cmake_file = io.StringIO()
+      export_cmake_module_set(cmake_file, module_set)
+      n_written += write_part("module_set_%s.cmake" % module_set.digest, 
+                              cmake_file)
+      n_parts += 1
+      module_set_digests.add(module_set.digest)
+   
+   # Then export the firmware builds 
+   #
+   for digest, firmware_build in sorted_firmware_builds(unique_firmware_builds_by_digest):
+      cmake_file = io.StringIO()
+      export_cmake_firmware_build(cmake_file, digest, firmware_build)
+      n_written += write_part("firmware_build_%s.cmake" % digest, cmake_file)
+      n_parts += 1
+      
+   # Now export the test definitions. Test groups are included in
+   # the order of their first test. Groups store the indices of their
+   # tests in test_nodes. As test ids do not depend on the position
+   # of a test, a group only changes if one of its tests changes.
+   #
+   test_nodes = []
+   test_indices_by_digest = {}
+   for test_id, test_node in enumerate_tests(test_nodes_by_path):
+      
+      digest = cmake_test_group_digest(test_node)
+      
+      test_indices = test_indices_by_digest.get(digest)
+      if test_indices is None:
+         test_indices = array.array('L')
+         test_indices_by_digest[digest] = test_indices
+         
+      test_indices.append(len(test_nodes))
+      
+      test_nodes.append((test_id, test_node))
+      
+   for digest, test_indices in test_indices_by_digest.items():
+      
+      cmake_file = io.StringIO()
+      
+      sep_line(cmake_file)
+      cmake_file.write("# Kaleidoscope tests\n")
+      sep_line(cmake_file)
+      
+      for test_index in test_indices:
+         test_id, test_node = test_nodes[test_index]
+         export_cmake_test(cmake_file, test_id, test_node)
+         
+      n_written += write_part("tests_%s.cmake" % digest, cmake_file)
+      n_parts += 1
+         
+   # Remove the parts of a previous run that are no longer used
+   #
+   def is_part(part_name):
+      
+      if part_name == "git_mirrors.cmake":
+         return bool(git_operations)
+      
+      digest = part_name[:-len(".cmake")]
+      
+      if digest.startswith("module_set_"):
+         return digest[len("module_set_"):] in module_set_digests
+      
+      if digest.startswith("firmware_build_"):
+         return digest[len("firmware_build_"):] \
+                  in unique_firmware_builds_by_digest
+      
+      if digest.startswith("tests_"):
+         return digest[len("tests_"):] in test_indices_by_digest
+      
+      return False
+   
+   for entry in os.scandir(parts_dir):
+      if entry.name.endswith(".cmake") and not is_part(entry.name):
+         os.remove(entry.path)
+   
+   if write_file_if_changed(cmake_filename, index_file.getvalue()):
+      n_written += 1
+   
+   report("CMake information written to file \"" + cmake_filename
+          + "\" (%d of %d files changed)\n" % (n_written, n_parts + 1))
+   
+# Returns the build graph entry of a unique firmware build
+#
+def firmware_build_as_dict(digest, firmware_build):
+   
+   return {
+      "build_id" : firmware_build.getBuildId(),
+      "digest" : digest,
+      "module_set_id" : firmware_build.module_set.getModuleSetId(),
+      "firmware_sketch" : firmware_build.firmware_sketch.filename,
+      "boards_url" : firmware_build.boards_url,
+      "boards_commit" : firmware_build.boards_commit,
+      "modules" : [ { "url" : mod.url, 
+                      "commit" : mod.commit,
+                      "name" : mod.name } 
+                    for mod in firmware_build.modules ],
+      "origin" : firmware_build.path
+   }
+   
+# Returns the build graph entry of a module set
+#
+def module_set_as_dict(module_set, firmware_builds):
+   
+   return {
+      "module_set_id" : module_set.getModuleSetId(),
+      "digest" : module_set.digest,
+      "boards_url" : module_set.boards_url,
+      "boards_commit" : module_set.boards_commit,
+      "modules" : [ { "url" : mod.url, 
+                      "commit" : mod.commit,
+                      "name" : mod.name } 
+                    for mod in module_set.modules ],
+      "firmware_build_ids" : [ firmware_build.getBuildId() 
+                               for firmware_build in firmware_builds ]
+   }
+   
+# Assembles module sets, firmware builds and tests as a graph of plain data 
+# (dicts, lists, strings and numbers). Every test references the 
+# firmware build it depends on by its build id.
+#
+def build_graph(test_nodes_by_path, unique_firmware_builds_by_digest):
+   
+   module_sets = [ module_set_as_dict(module_set, firmware_builds)
+      for module_set, firmware_builds 
+         in sorted_module_sets(unique_firmware_builds_by_digest) ]
+   
+   firmware_builds = [ firmware_build_as_dict(digest, firmware_build)
+      for digest, firmware_build 
+         in sorted_firmware_builds(unique_firmware_builds_by_digest) ]
+      
+   tests = []
+   for test_id, test_node in enumerate_tests(test_nodes_by_path):
+      
+      driver_cmd_line_flags = None
+      driver_cmd_line_flags_origin = None
+      if test_node.driver_cmd_line_flags:
+         driver_cmd_line_flags = test_node.driver_cmd_line_flags.value
+         driver_cmd_line_flags_origin = test_node.driver_cmd_line_flags.path
+         
+      tests.append({
+         "test_id" : test_id,
+         "name" : test_node.generateGlobalName(),
+         "description" : test_node.description.value,
+         "python_driver" : test_node.python_driver.filename,
+         "driver_cmd_line_flags" : driver_cmd_line_flags,
+         "firmware_build_id" : test_node.unique_firmware_build.getBuildId(),
+         "digest" : test_node.getTestDigest(),
+         "path" : test_node.path,
+         "origins" : {
+            "name" : test_node.name.path,
+            "description" : test_node.description.path,
+            "driver_cmd_line_flags" : driver_cmd_line_flags_origin,
+            "firmware_build" : test_node.firmware_build.path
+         }
+      })
+      
+   return { "module_sets" : module_sets,
+            "firmware_builds" : firmware_builds, 
+            "tests" : tests }
+   
+# Exports firmware builds and tests as a machine readable JSON 
+# graph (see build_graph(...)).
+#
+def export_as_json(json_filename, 
+                   test_nodes_by_path, 
+                   unique_firmware_builds_by_digest):
+   
+   with open(json_filename, "w") as json_file:
+      json.dump(build_graph(test_nodes_by_path, 
+                            unique_firmware_builds_by_digest), 
+                json_file, indent = 3)
+      json_file.write("\n")
+   
+   report("JSON build graph written to file \"" + json_filename
+          + "\"\n")
+   
+# Exports the build graph (see build_graph(...)) in MessagePack format.
+# This requires the Python module msgpack.
+#
+def export_as_msgpack(msgpack_filename, 
+                      test_nodes_by_path, 
+                      unique_firmware_builds_by_digest):
+   
+   try:
+      import msgpack
+   except ImportError:
+      raise PrepareTestingError("The Python module msgpack is required "
+                                "to export MessagePack files")
+   
+   with open(msgpack_filename, "wb") as msgpack_file:
+      msgpack.pack(build_graph(test_nodes_by_path, 
+                               unique_firmware_builds_by_digest), 
+                   msgpack_file)
+   
+   report("MessagePack build graph written to file \"" + msgpack_filename
+          + "\"\n")
+   
+# Escapes a path for use in a ninja build statement
+#
+def ninja_escape_path(path):
+   return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+# Escapes a value that is used as part of a ninja command 
+#
+def ninja_escape_command_arg(value):
+   return shlex.quote(value).replace("$", "$$")
+
+# Exports firmware builds and tests as a ninja build file. 
+#
+# Every unique firmware build becomes a build edge whose output is 
+# the firmware binary. The edge runs the firmware build script that 
+# CMake generated for the build in build_dir. Firmware builds run 
+# in a pool to limit the number of concurrent heavy builds. They 
+# are additionally available as phony targets firmware_<digest>.
+#
+# If the firmware builds of a module set share a build tree 
+# (shared_module_builds), every firmware build additionally has an 
+# order-only dependency on the previous build of its module set. 
+# Builds of the same module set thus run one after another while
+# builds of different module sets still run in parallel.
+#
+# Every test becomes an edge that depends on its firmware and
+# python driver and that creates a stamp file when the test passed.
+# Consequently, ninja only reruns tests whose inputs changed.
+#
+# The edges are not self-contained. They only run the scripts in 
+# build_dir/cmake_scripts, which are written when CMake is configured
+# (including the checkouts of the module sets). A ninja file can,
+# thus, only be used after CMake was configured in build_dir with 
+# the same testing tree. It replaces the build and test stages, not 
+# the configuration stage.
+#
+def export_as_ninja(ninja_filename, 
+                    test_nodes_by_path, 
+                    unique_firmware_builds_by_digest,
+                    build_dir,
+                    cmake_executable = "cmake",
+                    firmware_jobs = None,
+                    shared_module_builds = True):
+   
+   if not firmware_jobs:
+      firmware_jobs = os.cpu_count() or 1
+      
+   lines = []
+   
+   lines.append("# Kaleidoscope firmware builds and tests")
+   lines.append("# generated by prepare_testing.py")
+   lines.append("#")
+   lines.append("# The build edges run the firmware build and test scripts")
+   lines.append("# that CMake generates when it is configured in")
+   lines.append("# " + build_dir)
+   lines.append("# This file is only usable after that configuration.")
+   lines.append("")
+   lines.append("ninja_required_version = 1.5")
+   lines.append("")
+   lines.append("cmake = " + ninja_escape_command_arg(cmake_executable))
+   lines.append("")
+   lines.append("pool firmware_pool")
+   lines.append("  depth = %d" % firmware_jobs)
+   lines.append("")
+   lines.append("rule firmware_build")
+   lines.append("  command = $cmake -Dlog_file=$log_file -P $script")
+   lines.append("  description = Building Kaleidoscope firmware $build_id")
+   lines.append("  pool = firmware_pool")
+   lines.append("  restat = 1")
+   lines.append("")
+   lines.append("rule kaleidoscope_test")
+   lines.append("  command = $cmake -P $script && $cmake -E touch $out")
+   lines.append("  description = Running test $test_name")
+   lines.append("")
+   
+   firmware_outputs = []
+   previous_outputs_by_module_set = {}
+   for digest, firmware_build in sorted_firmware_builds(unique_firmware_builds_by_digest):
+      
+      build_id = firmware_build.getBuildId()
+      output = ninja_escape_path(firmware_binary(build_dir, build_id))
+      firmware_outputs.append(output)
+      
+      order_only = ""
+      if shared_module_builds:
+         module_set_id = firmware_build.module_set.getModuleSetId()
+         previous_output = previous_outputs_by_module_set.get(module_set_id)
+         if previous_output:
+            order_only = " || " + previous_output
+         previous_outputs_by_module_set[module_set_id] = output
+      
+      lines.append("build %s: firmware_build | %s%s" 
+         % (output, 
+            ninja_escape_path(firmware_build.firmware_sketch.filename),
+            order_only))
+      lines.append("  build_id = %s" % build_id)
+      lines.append("  script = " + ninja_escape_command_arg(
+                      firmware_build_script(build_dir, build_id)))
+      lines.append("  log_file = " + ninja_escape_command_arg(
+                      firmware_build_log_file(build_dir, build_id)))
+      lines.append("build firmware_%s: phony %s" % (digest, output))
+      lines.append("")
+      
+   test_outputs = []
+   for test_id, test_node in enumerate_tests(test_nodes_by_path):
+      
+      test_name = test_node.generateGlobalName()
+      output = ninja_escape_path(os.path.join(build_dir, "test_results", 
+                                              test_name + ".passed"))
+      test_outputs.append(output)
+      
+      lines.append("build %s: kaleidoscope_test | %s %s" 
+         % (output,
+            ninja_escape_path(test_node.python_driver.filename),
+            ninja_escape_path(firmware_binary(build_dir, 
+                                 test_node.unique_firmware_build.getBuildId()))))
+      lines.append("  test_name = " + ninja_escape_command_arg(test_name))
+      lines.append("  script = " + ninja_escape_command_arg(
+                      test_script(build_dir, test_id)))
+      lines.append("")
+      
+   lines.append("build firmware: phony " + " ".join(firmware_outputs))
+   lines.append("build test: phony " + " ".join(test_outputs))
+   lines.append("")
+   lines.append("default firmware")
+   lines.append("")
+   
+   with open(ninja_filename, "w") as ninja_file:
+      ninja_file.write("\n".join(lines))
+   
+   report("Ninja build file written to file \"" + ninja_filename
+          + "\"\n")
+   
+# The state of the testing tree in watch mode (see watch_daemon.py). 
+# Changed directories are patched into the tree, the exports are 
+# regenerated and queries are answered from an index of the 
+# last valid tree.
+#
+class WatchedTestingTree(object):
+   
+   def __init__(self, 
+                testing_tree_root, 
+                test_nodes_by_path, 
+                unique_firmware_builds_by_digest,
+                export,
+                jobs = None,
+                specification_cache = None):
+      
+      self.testing_tree_root = testing_tree_root
+      self.test_nodes_by_path = test_nodes_by_path
+      
+      # A function that is called with the test nodes and the unique 
+      # firmware builds whenever the tree changed
+      #
+      self.export = export
+      
+      self.jobs = jobs
+      self.specification_cache = specification_cache
+      
+      # Counts the updates of the tree
+      #
+      self.generation = 0
+      
+      # The problems of the current tree. Queries are answered 
+      # from the last valid tree as long as there are problems.
+      #
+      self.problems = []
+      
+      self.setupIndex(unique_firmware_builds_by_digest)
+      
+   # Indexes the tests for queries. Tests are looked up by name
+   # and by absolute path. As paths that share a prefix are 
+   # contiguous when sorted, the tests below a path are found by
+   # bisection.
+   #
+   def setupIndex(self, unique_firmware_builds_by_digest):
+      
+      self.unique_firmware_builds_by_digest = unique_firmware_builds_by_digest
+      
+      self.tests_by_name = {}
+      tests_by_path = []
+      
+      for test_id, test_node in enumerate_tests(self.test_nodes_by_path):
+         self.tests_by_name[test_node.global_name] = (test_id, test_node)
+         tests_by_path.append((os.path.abspath(test_node.path), 
+                               test_id, test_node))
+         
+      tests_by_path.sort(key = lambda x: x[0])
+      
+      self.test_paths = [test[0] for test in tests_by_path]
+      self.tests_by_path = tests_by_path
+      
+   # Returns the directories that must be watched, i.e. all 
+   # directories of the testing tree and all __external__ directories
+   #
+   def watchedDirectories(self, test_nodes = None):
+      
+      if test_nodes is None:
+         test_nodes = self.test_nodes_by_path.values()
+      
+      for test_node in test_nodes:
+         yield test_node.path
+         if test_node.scan.external_scan:
+            yield test_node.scan.external_specification
+            
+   # Checks if a change of an entry of a watched directory might
+   # affect the testing tree
+   #
+   def isRelevantChange(self, directory, name, is_dir):
+      
+      if is_input_file_name(name):
+         return True
+      
+      test_node = self.test_nodes_by_path.get(directory)
+      
+      # Only input files are relevant within __external__ directories
+      #
+      if not test_node:
+         return False
+      
+      # Any additional file conflicts with an __external__ directory
+      #
+      return is_dir or bool(test_node.scan.external_specification)
+      
+   # Patches the changed directories into the tree and regenerates
+   # the exports.
+   #
+   # Returns a tuple of the directories that must be watched 
+   # additionally and those that are not to be watched anymore. None
+   # is returned if the tree could not be patched or exported, e.g.
+   # because files vanished while they were read. The changes must
+   # then be passed again with the next update.
+   #
+   def update(self, changed_paths):
+      
+      start_time = time.time()
+      
+      try:
+         test_nodes_by_path, rescanned_nodes, removed_paths \
+            = patch_testing_tree(self.test_nodes_by_path, 
+                                 changed_paths, 
+                                 self.jobs, 
+                                 self.specification_cache)
+      except (PrepareTestingError, OSError) as error:
+         self.problems = [str(error)]
+         report(str(error) + "\n")
+         return None
+      
+      self.test_nodes_by_path = test_nodes_by_path
+      self.generation += 1
+      
+      unwatched_paths = removed_paths \
+         + [os.path.join(path, external_specification_subdir_name)
+               for path in removed_paths] \
+         + [os.path.join(test_node.path, external_specification_subdir_name)
+               for test_node in rescanned_nodes 
+                  if not test_node.scan.external_scan]
+      
+      watch_changes = (list(self.watchedDirectories(rescanned_nodes)), 
+                       unwatched_paths)
+      
+      try:
+         check_test_nodes(test_nodes_by_path)
+      except InvalidTestingTreeError as error:
+         self.problems = error.problems + [str(error)]
+      except PrepareTestingError as error:
+         self.problems = [str(error)]
+      else:
+         self.problems = []
+         
+      if self.problems:
+         for problem in self.problems:
+            report(problem + "\n")
+         return watch_changes
+      
+      try:
+         unique_firmware_builds_by_digest \
+            = determine_unique_firmware_builds(test_nodes_by_path)
+         
+         self.export(test_nodes_by_path, unique_firmware_builds_by_digest)
+      except OSError as error:
+         self.problems = [str(error)]
+         report(str(error) + "\n")
+         return None
+      
+      self.setupIndex(unique_firmware_builds_by_digest)
+      
+      report("Testing tree updated (%d directories scanned again, "
+             "%d removed) in %.1f ms\n" 
+             % (len(rescanned_nodes), len(removed_paths), 
+                1000*(time.time() - start_time)))
+      
+      return watch_changes
+   
+   # Answers a query, a dict with an entry "query" and 
+   # query specific arguments
+   #
+   #   firmware_build: the firmware build of test "test"
+   #   tests: all tests below path "path" (default: all tests)
+   #   status: information about the tree
+   #
+   # Returns a dict. Failed queries return a dict with an 
+   # entry "error".
+   #
+   def query(self, request):
+      
+      query = request.get("query")
+      
+      if query == "firmware_build":
+         
+         test = self.tests_by_name.get(request.get("test"))
+         if not test:
+            return { "error" : "No test \"%s\"" % request.get("test") }
+         
+         test_id, test_node = test
+         firmware_build = test_node.unique_firmware_build
+         
+         return { 
+            "test" : test_node.global_name,
+            "test_id" : test_id,
+            "firmware_build" : firmware_build_as_dict(
+                                    firmware_build.getDigest(),
+                                    firmware_build)
+         }
+      
+      if query == "tests":
+         
+         path = os.path.abspath(os.path.join(self.testing_tree_root, 
+                                             request.get("path") or ""))
+         prefix = os.path.join(path, "")
+         
+         # Besides the test of path itself, the paths of the tests 
+         # below path sort between prefix and prefix with its 
+         # trailing separator replaced by the next character
+         #
+         def test_range(first_path, last_path):
+            return self.tests_by_path[
+                      bisect.bisect_left(self.test_paths, first_path):
+                      bisect.bisect_left(self.test_paths, last_path)]
+         
+         matches = test_range(path, path + "\0") \
+            + test_range(prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+         
+         tests = []
+         for test_path, test_id, test_node in sorted(matches, 
+                                                     key = lambda x: x[1]):
+            
+            tests.append({ 
+               "name" : test_node.global_name,
+               "test_id" : test_id,
+               "path" : test_node.path,
+               "firmware_build_id" : test_node.unique_firmware_build.getBuildId()
+            })
+            
+         return { "tests" : tests }
+      
+      if query == "status":
+         
+         return {
+            "testing_tree_root" : self.testing_tree_root,
+            "generation" : self.generation,
+            "test_nodes" : len(self.test_nodes_by_path),
+            "tests" : len(self.tests_by_name),
+            "firmware_builds" : len(self.unique_firmware_builds_by_digest),
+            "problems" : self.problems
+         }
+      
+      return { "error" : "Unknown query \"%s\"" % query }
+   
+# Writes cProfile statistics in the format that the pstats module 
+# reads and prints the functions with the highest cumulative time.
+#
+def write_cprofile_stats(filename, c_profile, n_functions = 25):
+   
+   import pstats
+   
+   c_profile.dump_stats(filename)
+   
+   stats = pstats.Stats(c_profile, stream = sys.stdout)
+   stats.sort_stats("cumulative").print_stats(n_functions)
+   
+def main():
+    
+    import argparse
+    
+    parser = argparse.ArgumentParser( 
+       description = 
        "This tool traverses the testing path hierarchy of a "
        "Kaleidoscope module and generates testing information "
        "that can be used to generate and run tests using an additional "
        "build system.")
 
     parser.add_argument('-d', '--testing_tree_root', 
-      metavar  = 'path', 
+      metavar  = ('path', 'name_prefix'), 
       dest     = 'testing_tree_root', 
       required = 'True', 
-      nargs    = 1,
-      help     = 'The root path of the Kaleidoscope module\'s testing tree'
+      action   = 'append',
+      nargs    = '+',
+      help     = 'The root path of the Kaleidoscope module\'s testing tree, '
+                 'optionally followed by a prefix for the names of its '
+                 'tests. Pass several times to prepare the testing trees '
+                 'of several modules together. Their tests share '
+                 'identical firmware builds'
     )
     
     parser.add_argument('-c', '--cmake_test_definition_file', 
       metavar  = 'file', 
       dest     = 'cmake_test_definition_file', 
-      required = 'False', 
+      required = False, 
       nargs    = 1,
       help     = 'An output file with test specifications in CMake format'
     )
+    
+    parser.add_argument('--json_build_graph', 
+      metavar  = 'file', 
+      dest     = 'json_build_graph', 
+      help     = 'An output file with firmware builds and tests in JSON format'
+    )
+    
+    parser.add_argument('--msgpack_build_graph', 
+      metavar  = 'file', 
+      dest     = 'msgpack_build_graph', 
+      help     = 'An output file with firmware builds and tests in '
+                 'MessagePack format (requires the Python module msgpack)'
+    )
+    
+    parser.add_argument('--ninja_file', 
+      metavar  = 'file', 
+      dest     = 'ninja_file', 
+      help     = 'An output ninja build file that builds firmwares and '
+                 'runs tests. Its edges run the scripts that CMake '
+                 'generates in the build directory, i.e. it only works '
+                 'after CMake was configured there'
+    )
+    
+    parser.add_argument('--build_dir', 
+      metavar  = 'path', 
+      dest     = 'build_dir', 
+      help     = 'The CMake build directory whose firmware build and test '
+                 'scripts are referenced by the ninja build file '
+                 '(default: current directory)'
+    )
+    
+    parser.add_argument('--cmake_executable', 
+      metavar  = 'file', 
+      dest     = 'cmake_executable', 
+      default  = 'cmake',
+      help     = 'The cmake executable used by the ninja build file'
+    )
+    
+    parser.add_argument('--ninja_firmware_jobs', 
+      metavar  = 'N', 
+      dest     = 'ninja_firmware_jobs', 
+      type     = int,
+      help     = 'The maximum number of firmware builds that ninja runs '
+                 'concurrently (default: number of CPUs)'
+    )
+    
+    parser.add_argument('--module_set_builds', 
+      dest     = 'module_set_builds', 
+      choices  = ['shared', 'separate'],
+      default  = 'shared',
+      help     = 'Whether the firmware builds of a module set share a '
+                 'build tree (shared) or compile the modules in a build '
+                 'tree of their own (separate). Must match the build '
+                 'scripts referenced by the ninja build file '
+                 '(default: %(default)s)'
+    )
+    
+    parser.add_argument('-m', '--manifest', 
+      metavar  = 'file', 
+      dest     = 'manifest', 
+      nargs    = 1,
+      help     = 'A file that stores the testing tree between runs. '
+                 'If specified, only changed parts of the testing tree '
+                 'are re-evaluated'
+    )
+    
+    parser.add_argument('-j', '--jobs', 
+      metavar  = 'N', 
+      dest     = 'jobs', 
+      type     = int,
+      help     = 'The number of parallel jobs used to read and parse '
+                 'specification files (default: number of CPUs)'
+    )
+    
+    parser.add_argument('-g', '--git_mirror_dir', 
+      metavar  = 'path', 
+      dest     = 'git_mirror_dir', 
+      nargs    = 1,
+      help     = 'A directory where shared mirrors of all git '
+                 'repositories used by the firmware builds are maintained'
+    )
+    
+    parser.add_argument('--git_plan', 
+      metavar  = 'file', 
+      dest     = 'git_plan', 
+      help     = 'An output file that lists all git repositories and '
+                 'commits required by the firmware builds (JSON). '
+                 'See git_executor.py'
+    )
+    
+    parser.add_argument('--git_jobs', 
+      metavar  = 'N', 
+      dest     = 'git_jobs', 
+      type     = int,
+      default  = 8,
+      help     = 'The maximum number of concurrent git operations when '
+                 'filling the git mirrors'
+    )
+    
+    parser.add_argument('--update_git_mirrors', 
+      dest     = 'update_git_mirrors', 
+      action   = 'store_true',
+      help     = 'Fetch existing git mirrors'
+    )
+    
+    parser.add_argument('--git_mirror_url', 
+      metavar  = 'url', 
+      dest     = 'git_mirror_urls', 
+      action   = 'append',
+      default  = [],
+      help     = 'An additional URL to mirror, e.g. of a module that is '
+                 'added to every firmware build by the build system'
+    )
+    
+    parser.add_argument('--default_boards_url', 
+      metavar  = 'url', 
+      dest     = 'default_boards_url', 
+      help     = 'The boards URL used by firmware builds that do not '
+                 'specify one'
+    )
+    
+    parser.add_argument('--default_boards_commit', 
+      metavar  = 'commit', 
+      dest     = 'default_boards_commit', 
+      help     = 'The boards commit used by firmware builds that do not '
+                 'specify one'
+    )
+    
+    parser.add_argument('--git_executable', 
+      metavar  = 'file', 
+      dest     = 'git_executable', 
+      default  = 'git',
+      help     = 'The git executable'
+    )
+                   
+    parser.add_argument('--changed_files', 
+      metavar  = 'file', 
+      dest     = 'changed_files', 
+      nargs    = '+',
+      action   = 'append',
+      help     = 'Export only the tests and firmware builds that are '
+                 'affected by changes of the given files'
+    )
+    
+    parser.add_argument('--since', 
+      metavar  = 'revision', 
+      dest     = 'since', 
+      help     = 'Export only the tests and firmware builds that are '
+                 'affected by files that changed since the given git '
+                 'revision'
+    )
+    
+    parser.add_argument('--shard', 
+      metavar  = 'INDEX/COUNT', 
+      dest     = 'shard', 
+      help     = 'Export only the firmware builds and tests of shard '
+                 'INDEX (zero based) of COUNT shards. Tests that use the '
+                 'same firmware build are assigned to the same shard'
+    )
+    
+    parser.add_argument('--shard_costs', 
+      metavar  = 'file', 
+      dest     = 'shard_costs', 
+      help     = 'A timing history database or a JSON file with '
+                 'recorded costs of firmware builds and tests that is '
+                 'used to balance shards'
+    )
+    
+    parser.add_argument('--watch', 
+      dest     = 'watch', 
+      action   = 'store_true',
+      help     = 'Keep running, watch the testing tree for changes and '
+                 'update all exports whenever it changes'
+    )
+    
+    parser.add_argument('--watch_socket', 
+      metavar  = 'file', 
+      dest     = 'watch_socket', 
+      help     = 'A Unix domain socket where queries about tests and '
+                 'firmware builds are answered in watch mode '
+                 '(see watch_daemon.py)'
+    )
+    
+    parser.add_argument('--profile', 
+      metavar  = 'file', 
+      dest     = 'profile', 
+      help     = 'Measure the time spent in the different phases and '
+                 'write it to the given file in Chrome trace event '
+                 'format. A summary is printed'
+    )
+    
+    parser.add_argument('--cprofile', 
+      metavar  = 'file', 
+      dest     = 'cprofile', 
+      help     = 'Profile all function calls with cProfile and write the '
+                 'statistics to the given file. The most expensive '
+                 'functions are printed'
+    )
                    
     args = parser.parse_args()
+    
+    if args.profile:
+       profiler.enable()
+       
+    if args.cprofile:
+       import cProfile
+       c_profile = cProfile.Profile()
+       c_profile.enable()
+       
+    try:
+       check_arguments(args)
+       with profiler.phase("prepare testing"):
+          prepare_testing(args)
+    except PrepareTestingError as error:
+       report_error(error)
+       sys.exit(1)
+       
+    if args.cprofile:
+       c_profile.disable()
+       write_cprofile_stats(args.cprofile, c_profile)
+       
+    if args.profile:
+       profiler.writeChromeTrace(args.profile)
+       profiler.writeSummary()
+       
+# Checks combinations of command line arguments that argparse can not
+# check. Raises a PrepareTestingError for invalid combinations.
+#
+def check_arguments(args):
+   
+   for values in args.testing_tree_root:
+      if len(values) > 2:
+         raise PrepareTestingError("--testing_tree_root expects a path "
+                                   "and an optional name prefix")
+    
+   if args.watch and (args.changed_files or args.since or args.shard):
+      raise PrepareTestingError("--watch cannot be combined with "
+                                "--changed_files, --since or --shard")
+       
+   if args.watch and (len(args.testing_tree_root) > 1 
+                      or len(args.testing_tree_root[0]) > 1):
+      raise PrepareTestingError("--watch supports a single testing tree "
+                                "without name prefix")
+
+# Reports an error, including the individual problems of an
+# invalid testing tree
+#
+def report_error(error):
+   
+   if isinstance(error, InvalidTestingTreeError):
+      for problem in error.problems:
+         report(problem + "\n")
+         
+   report("Error: %s\n" % error)
+
+# Sets up the testing tree, determines the unique firmware builds 
+# and restricts both to the tests that are affected by changed files
+# and to a shard, if requested. This is everything that is required
+# to export tests.
+#
+# testing_tree_roots is either the root path of a single testing tree 
+# or a list of tuples (root path, name prefix) of several trees, e.g.
+# of different Kaleidoscope modules. The tests of all trees share
+# identical firmware builds.
+#
+# Returns a tuple (test_nodes_by_path, unique_firmware_builds_by_digest).
+#
+def prepare_tests(testing_tree_roots,
+                  manifest_filename = None,
+                  jobs = None,
+                  changed_files = None,
+                  since = None,
+                  shard = None,
+                  shard_costs = None,
+                  git_executable = "git",
+                  specification_cache = None):
+   
+   testing_tree_roots = testing_tree_root_list(testing_tree_roots)
+   
+   previous_manifest = None
+   manifest = None
+   if manifest_filename:
+      with profiler.phase("load manifest"):
+         previous_manifest = load_tree_manifest(manifest_filename, 
+                                                testing_tree_roots)
+      manifest = TreeManifest(testing_tree_roots)
+   
+   with profiler.phase("setup testing tree"):
+      test_nodes_by_path = setup_testing_trees(testing_tree_roots, 
+                                               previous_manifest, 
+                                               manifest,
+                                               jobs,
+                                               specification_cache)
+   
+   with profiler.phase("firmware build deduplication"):
+      unique_firmware_builds_by_digest \
+        = determine_unique_firmware_builds(test_nodes_by_path)
+   
+   if manifest:
+      with profiler.phase("write manifest"):
+         write_tree_manifest(manifest_filename, manifest)
+      
+   if changed_files is not None or since:
+      with profiler.phase("change selection"):
+         root_paths = [root for root, _ in testing_tree_roots]
+         
+         changed_files = list(changed_files or [])
+         if since:
+            for root in root_paths:
+               changed_files += git_changed_files(root, since,
+                                                  git_executable)
+            
+            # Trees may share a git repository
+            #
+            changed_files = list(dict.fromkeys(changed_files))
+            
+         test_nodes_by_path, unique_firmware_builds_by_digest \
+            = select_changed(test_nodes_by_path, 
+                             unique_firmware_builds_by_digest,
+                             root_paths,
+                             changed_files)
+      
+   if shard:
+      with profiler.phase("sharding"):
+         shard_index, shard_count = parse_shard(shard)
+         
+         costs = None
+         if shard_costs:
+            costs = load_shard_costs(shard_costs)
+            
+         test_nodes_by_path, unique_firmware_builds_by_digest \
+            = select_shard(test_nodes_by_path, 
+                           unique_firmware_builds_by_digest,
+                           shard_index, 
+                           shard_count,
+                           costs)
+         
+   return (test_nodes_by_path, unique_firmware_builds_by_digest)
+       
+def prepare_testing(args):
+    
+    import git_executor
 
-    tree_root = "".join(args.testing_tree_root)
-    sys.stdout.write("Configuring testing tree in \"" 
-       + tree_root + "\"\n")
+    testing_tree_roots = testing_tree_root_list(
+       [(values[0], (values[1:] or [None])[0]) 
+        for values in args.testing_tree_root])
+    
+    for tree_root, name_prefix in testing_tree_roots:
+       if name_prefix:
+          report("Configuring testing tree in \"%s\" "
+                 "(name prefix \"%s\")\n" 
+                 % (tree_root, name_prefix))
+       else:
+          report("Configuring testing tree in \"" 
+             + tree_root + "\"\n")
+    
+    manifest_filename = None
+    if args.manifest:
+       manifest_filename = "".join(args.manifest)
+       
+    changed_files = None
+    if args.changed_files is not None:
+       changed_files = []
+       for files in args.changed_files:
+          changed_files += files
     
-    test_nodes_by_path = setup_testing_tree(tree_root)
+    # Parsed specifications are kept to set up changed parts of
+    # the tree in watch mode
+    #
+    specification_cache = None
+    if args.watch:
+       specification_cache = {}
     
-    check_test_name_uniqueness(test_nodes_by_path)
+    test_nodes_by_path, unique_firmware_builds_by_digest \
+       = prepare_tests(testing_tree_roots,
+                       manifest_filename = manifest_filename,
+                       jobs = args.jobs,
+                       changed_files = changed_files,
+                       since = args.since,
+                       shard = args.shard,
+                       shard_costs = args.shard_costs,
+                       git_executable = args.git_executable,
+                       specification_cache = specification_cache)
+       
+    git_operations = None
+    if args.git_mirror_dir:
+       with profiler.phase("git mirrors"):
+          git_operations = plan_git_mirrors(args, 
+                                            unique_firmware_builds_by_digest)
+          
+          if args.git_plan:
+             git_executor.write_git_plan(args.git_plan, git_operations)
+          
+          # Failed operations are not fatal. The build system clones 
+          # repositories without mirrors directly.
+          #
+          report("Filling git mirrors\n")
+          git_executor.execute_git_plan(git_operations, 
+                                        args.git_jobs,
+                                        args.git_executable,
+                                        update_existing 
+                                           = args.update_git_mirrors)
+          git_executor.report_git_plan(git_operations)
+          
+    export_tests(args, 
+                 test_nodes_by_path, 
+                 unique_firmware_builds_by_digest,
+                 git_operations)
     
-    unique_firmware_builds_by_digest \
-      = determine_unique_firmware_builds(test_nodes_by_path)
+    if args.watch:
+       
+       import watch_daemon
+       
+       # Mirrors are only filled initially. Firmware builds that
+       # require new repositories clone them directly.
+       #
+       def export(test_nodes_by_path, unique_firmware_builds_by_digest):
+          git_operations = None
+          if args.git_mirror_dir:
+             git_operations = plan_git_mirrors(args, 
+                                            unique_firmware_builds_by_digest)
+          export_tests(args, 
+                       test_nodes_by_path, 
+                       unique_firmware_builds_by_digest,
+                       git_operations)
+       
+       watched_testing_tree = WatchedTestingTree(testing_tree_roots[0][0],
+                                       test_nodes_by_path,
+                                       unique_firmware_builds_by_digest,
+                                       export,
+                                       args.jobs,
+                                       specification_cache)
+       
+       try:
+          watch_daemon.watch(watched_testing_tree, 
+                             socket_filename = args.watch_socket,
+                             report = report)
+       except OSError as error:
+          raise PrepareTestingError("Unable to watch the testing tree: %s" 
+                                    % error)
+       
+# Plans the git mirror operations for the options passed on the
+# command line
+#
+def plan_git_mirrors(args, unique_firmware_builds_by_digest):
+    return plan_git_operations("".join(args.git_mirror_dir),
+                               unique_firmware_builds_by_digest,
+                               args.default_boards_url,
+                               args.default_boards_commit,
+                               args.git_mirror_urls)
    
+# Writes all exports that were requested on the command line
+#
+def export_tests(args, 
+                 test_nodes_by_path, 
+                 unique_firmware_builds_by_digest,
+                 git_operations = None):
+    
     if args.cmake_test_definition_file:
        cmake_test_definition_file = "".join(args.cmake_test_definition_file)
-       export_as_cmake( cmake_test_definition_file, 
-                        test_nodes_by_path, 
-                        unique_firmware_builds_by_digest)
+       with profiler.phase("export cmake"):
+          export_as_cmake( cmake_test_definition_file, 
+                           test_nodes_by_path, 
+                           unique_firmware_builds_by_digest,
+                           git_operations)
+       
+    if args.json_build_graph:
+       with profiler.phase("export json"):
+          export_as_json(args.json_build_graph,
+                         test_nodes_by_path, 
+                         unique_firmware_builds_by_digest)
+       
+    if args.msgpack_build_graph:
+       with profiler.phase("export msgpack"):
+          export_as_msgpack(args.msgpack_build_graph,
+                            test_nodes_by_path, 
+                            unique_firmware_builds_by_digest)
+       
+    if args.ninja_file:
+       with profiler.phase("export ninja"):
+          export_as_ninja(args.ninja_file,
+                          test_nodes_by_path, 
+                          unique_firmware_builds_by_digest,
+                          os.path.abspath(args.build_dir or os.getcwd()),
+                          args.cmake_executable,
+                          args.ninja_firmware_jobs,
+                          args.module_set_builds == "shared")
                    
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,734 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script runs the tests of a JSON build graph that is
+# generated by prepare_testing.py (command line option
+# --json_build_graph) after the firmware builds have been build.
+#
+# When tests are run through CTest, every test starts a Python
+# interpreter of its own that loads the firmware module again.
+# This runner instead groups tests by firmware build and runs every
+# group in a worker process that imports the firmware module
+# only once. The drivers of the group are then executed one after
+# another in the worker's interpreter with their driver command line
+# flags as arguments (sys.argv).
+#
+# Large groups are split into chunks that are run by several
+# workers to keep all workers busy. Every worker process runs a single
+# chunk as the firmware module of a build can not be unloaded.
+#
+# *** Fork server mode ***
+#
+# Drivers that run in the same interpreter may observe firmware state
+# that was left behind by previous drivers. In fork server mode
+# (command line option --fork_server), every worker imports the
+# firmware module and runs an optional initialization script
+# (command line option --init_script) only once. For every test, it then
+# forks a child process that runs the driver on a copy-on-write
+# snapshot of the initialized firmware. Every test thus starts
+# in the same clean state without loading the firmware again.
+# Fork server mode requires a POSIX system.
+#
+# The output of every test is written to the same log file the
+# CMake test scripts use. Per-test results are reported and can be
+# written to a JSON file (command line option --results) and recorded
+# in a timing history (command line option --timing_history, see
+# timing_history.py).
+
+import argparse
+import sys
+import os
+import re
+import json
+import time
+import shlex
+import runpy
+import importlib
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+import prepare_testing
+import timing_history
+
+try:
+   import resource
+except ImportError:
+   resource = None
+
+# The module that is imported once per worker before any driver
+# is executed. This is the Python API of Leidokos-Python that loads
+# the firmware.
+#
+default_preload_module = "kaleidoscope"
+
+# Groups of tests are not split into chunks smaller than this as
+# every chunk loads the firmware again
+#
+min_chunk_size = 8
+
+# The tests of a firmware build that are run by a single worker
+#
+class TestChunk(object):
+
+   def __init__(self, build_id, firmware_dir, python_path, preload_module,
+                init_script, build_dir, tests):
+
+      self.build_id = build_id
+      self.firmware_dir = firmware_dir
+      self.python_path = python_path
+      self.preload_module = preload_module
+      self.init_script = init_script
+      self.build_dir = build_dir
+      self.tests = tests
+
+# Reads the tests of a JSON build graph. Returns a list of test dicts
+# as exported by prepare_testing.export_as_json.
+#
+def read_tests(json_build_graph_filename, tests_regex = None):
+
+   with open(json_build_graph_filename, "r") as stream:
+      build_graph = json.load(stream)
+
+   tests = build_graph.get("tests", [])
+
+   firmware_builds_by_id = {}
+   for firmware_build in build_graph.get("firmware_builds", []):
+      firmware_builds_by_id[firmware_build["build_id"]] = firmware_build
+
+   for test in tests:
+      firmware_build = firmware_builds_by_id.get(test["firmware_build_id"],
+                                                 {})
+      test["firmware_digest"] = firmware_build.get("digest")
+      test["module_set_id"] = firmware_build.get("module_set_id")
+
+   # Drivers are run with the firmware build directory as
+   # working directory
+   #
+   for test in tests:
+      test["python_driver"] = os.path.abspath(test["python_driver"])
+
+   if tests_regex:
+      matcher = re.compile(tests_regex)
+      tests = [test for test in tests if matcher.search(test["name"])]
+
+   return tests
+
+# Groups tests by firmware build and splits the groups into chunks of
+# at most max_chunk_size tests.
+#
+# Returns a list of TestChunk objects, ordered by decreasing size.
+#
+def plan_test_chunks(tests, build_dir, jobs,
+                     preload_module = default_preload_module,
+                     leidokos_python_dir = None,
+                     init_script = None):
+
+   tests_by_build_id = {}
+   module_set_ids = {}
+   for test in tests:
+      tests_by_build_id.setdefault(test["firmware_build_id"], []).append(test)
+      module_set_ids[test["firmware_build_id"]] = test.get("module_set_id")
+
+   # Split groups only as far as needed to occupy all workers
+   #
+   max_chunk_size = max(min_chunk_size, -(-len(tests) // max(1, jobs)))
+
+   chunks = []
+   for build_id in sorted(tests_by_build_id.keys()):
+
+      build_tests = tests_by_build_id[build_id]
+
+      firmware_dir = prepare_testing.firmware_build_dir(build_dir, build_id)
+
+      python_path = [firmware_dir,
+                     leidokos_python_dir
+                     or prepare_testing.leidokos_python_module_dir(
+                           build_dir, module_set_ids[build_id])]
+
+      for begin in range(0, len(build_tests), max_chunk_size):
+         chunks.append(TestChunk(build_id, firmware_dir, python_path,
+                                 preload_module, init_script, build_dir,
+                                 build_tests[begin:begin + max_chunk_size]))
+
+   return sorted(chunks, key = lambda x: -len(x.tests))
+
+# Orders results like the tests they belong to. Test ids do not
+# reflect the order of the tests in the testing tree.
+#
+def sort_results(results, tests):
+
+   positions = {}
+   for position, test in enumerate(tests):
+      positions[test["test_id"]] = position
+
+   return sorted(results, key = lambda x: positions[x["test_id"]])
+
+# Returns a result dict for a test
+#
+def test_result(test, status, exit_code = None, duration = 0.0,
+                log_file = None, message = None, peak_memory_kb = None):
+   return { "test_id" : test["test_id"],
+            "name" : test["name"],
+            "firmware_build_id" : test["firmware_build_id"],
+            "firmware_digest" : test.get("firmware_digest"),
+            "status" : status,
+            "exit_code" : exit_code,
+            "duration" : duration,
+            "log_file" : log_file,
+            "message" : message,
+            "peak_memory_kb" : peak_memory_kb }
+
+# Returns the peak memory usage of the current process in kB. As
+# the peak never decreases, this is an upper bound for the
+# usage of the most recent test that was run in the process.
+#
+def peak_memory_kb():
+
+   if not resource:
+      return None
+
+   return timing_history.max_rss_kb(
+             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+# Converts the code of a SystemExit exception to a process exit code
+#
+def exit_code_of(exc):
+
+   if exc.code is None:
+      return 0
+   if isinstance(exc.code, int):
+      return exc.code
+
+   sys.stderr.write(str(exc.code) + "\n")
+   return 1
+
+# Runs a single driver in the current interpreter as if it was started
+# as "python <driver> <flags>". The output of the driver, including any
+# output of the firmware, is redirected to the log file.
+#
+# Returns the exit code of the driver.
+#
+def run_driver(test, working_dir, log_filename):
+
+   argv = [test["python_driver"]] \
+          + shlex.split(test["driver_cmd_line_flags"] or "")
+
+   saved_argv = sys.argv
+   saved_cwd = os.getcwd()
+
+   # Drivers may change sys.path, e.g. to import helper modules
+   #
+   saved_path = list(sys.path)
+
+   os.makedirs(os.path.dirname(log_filename), exist_ok = True)
+
+   sys.stdout.flush()
+   sys.stderr.flush()
+
+   with open(log_filename, "w") as log_file:
+
+      saved_stdout_fd = os.dup(1)
+      saved_stderr_fd = os.dup(2)
+
+      os.dup2(log_file.fileno(), 1)
+      os.dup2(log_file.fileno(), 2)
+
+      # Like the interpreter, make modules next to the driver
+      # importable
+      #
+      sys.path.insert(0, os.path.dirname(test["python_driver"]))
+
+      try:
+         sys.argv = argv
+         os.chdir(working_dir)
+
+         runpy.run_path(test["python_driver"], run_name = "__main__")
+         exit_code = 0
+
+      except SystemExit as exc:
+         exit_code = exit_code_of(exc)
+
+      except Exception:
+         traceback.print_exc()
+         exit_code = 1
+
+      finally:
+         sys.stdout.flush()
+         sys.stderr.flush()
+
+         os.dup2(saved_stdout_fd, 1)
+         os.dup2(saved_stderr_fd, 2)
+         os.close(saved_stdout_fd)
+         os.close(saved_stderr_fd)
+
+         sys.argv = saved_argv
+         os.chdir(saved_cwd)
+         sys.path[:] = saved_path
+
+   return exit_code
+
+# Loads the firmware module of a chunk into the current interpreter
+# and runs the initialization script.
+# Returns an error message or None on success.
+#
+def preload_firmware(chunk):
+
+   sys.path[0:0] = chunk.python_path
+
+   saved_cwd = os.getcwd()
+   try:
+      os.chdir(chunk.firmware_dir)
+
+      if chunk.preload_module:
+         try:
+            importlib.import_module(chunk.preload_module)
+         except Exception:
+            return "Unable to load firmware module \"%s\":\n%s" \
+                      % (chunk.preload_module, traceback.format_exc())
+
+      if chunk.init_script:
+         try:
+            runpy.run_path(chunk.init_script, run_name = "__main__")
+         except (Exception, SystemExit):
+            return "Unable to initialize firmware with \"%s\":\n%s" \
+                      % (chunk.init_script, traceback.format_exc())
+   finally:
+      os.chdir(saved_cwd)
+
+   return None
+
+# Returns the status of a test with the given exit code
+#
+def test_status(exit_code):
+   if exit_code == 0:
+      return "passed"
+   return "failed"
+
+# Runs the tests of a chunk and yields a result for every test.
+#
+def run_test_chunk(chunk):
+
+   error = preload_firmware(chunk)
+   if error:
+      for test in chunk.tests:
+         yield test_result(test, "error", message = error)
+      return
+
+   for test in chunk.tests:
+
+      log_filename = prepare_testing.test_log_file(chunk.build_dir,
+                                                   test["name"])
+
+      start_time = time.monotonic()
+      exit_code = run_driver(test, chunk.firmware_dir, log_filename)
+      duration = time.monotonic() - start_time
+
+      yield test_result(test, test_status(exit_code), exit_code,
+                        duration, log_filename,
+                        peak_memory_kb = peak_memory_kb())
+
+# Runs the tests of a chunk in fork server mode and yields a result
+# for every test.
+#
+def run_test_chunk_forked(chunk):
+
+   error = preload_firmware(chunk)
+   if error:
+      for test in chunk.tests:
+         yield test_result(test, "error", message = error)
+      return
+
+   for test in chunk.tests:
+
+      log_filename = prepare_testing.test_log_file(chunk.build_dir,
+                                                   test["name"])
+
+      sys.stdout.flush()
+      sys.stderr.flush()
+
+      start_time = time.monotonic()
+
+      pid = os.fork()
+      if pid == 0:
+
+         # The child never returns to the worker's code
+         #
+         exit_code = 1
+         try:
+            exit_code = run_driver(test, chunk.firmware_dir, log_filename)
+         finally:
+            os._exit(exit_code)
+
+      _, wait_status, rusage = os.wait4(pid, 0)
+      duration = time.monotonic() - start_time
+
+      message = None
+      if os.WIFSIGNALED(wait_status):
+         exit_code = -os.WTERMSIG(wait_status)
+         message = "Terminated by signal %d" % os.WTERMSIG(wait_status)
+      else:
+         exit_code = os.WEXITSTATUS(wait_status)
+
+      yield test_result(test, test_status(exit_code), exit_code,
+                        duration, log_filename, message,
+                        timing_history.max_rss_kb(rusage.ru_maxrss))
+
+# The entry point of worker processes. Results are sent to the
+# parent process one by one, followed by None.
+#
+def chunk_worker(chunk_runner, chunk, connection):
+
+   for result in chunk_runner(chunk):
+      connection.send(result)
+
+   connection.send(None)
+   connection.close()
+
+# Runs chunks in at most jobs worker processes. Every worker runs a
+# single chunk. Further chunks can be added while workers are running,
+# e.g. as soon as another firmware build becomes available.
+#
+# A driver may crash its worker process, e.g. by a segmentation fault
+# of the firmware. The test that was running is then reported as
+# crashed and the remaining tests of the chunk are run by
+# a new worker.
+#
+class TestChunkPool(object):
+
+   def __init__(self, jobs, chunk_runner):
+
+      self.jobs = max(1, jobs)
+      self.chunk_runner = chunk_runner
+      self.pending_chunks = []
+
+      # { connection : (process, chunk, number of results received) }
+      #
+      self.workers = {}
+
+   def addChunks(self, chunks):
+      self.pending_chunks.extend(chunks)
+
+   def isIdle(self):
+      return not self.pending_chunks and not self.workers
+
+   # Starts workers for pending chunks as long as less than jobs
+   # workers are running
+   #
+   def startWorkers(self):
+
+      while self.pending_chunks and len(self.workers) < self.jobs:
+
+         chunk = self.pending_chunks.pop(0)
+
+         receiver, sender = multiprocessing.Pipe(duplex = False)
+         process = multiprocessing.Process(target = chunk_worker,
+                                           args = (self.chunk_runner, chunk,
+                                                   sender))
+         process.start()
+         sender.close()
+
+         self.workers[receiver] = (process, chunk, 0)
+
+   # The connections of all running workers, see
+   # multiprocessing.connection.wait(...)
+   #
+   def connections(self):
+      return list(self.workers.keys())
+
+   # Receives from the connection of a worker that is ready and yields
+   # the results that were received.
+   #
+   def receive(self, receiver):
+
+      process, chunk, n_received = self.workers[receiver]
+
+      try:
+         result = receiver.recv()
+      except EOFError:
+         result = None
+         process.join()
+
+         if n_received < len(chunk.tests):
+            test = chunk.tests[n_received]
+            yield test_result(test, "crashed",
+               exit_code = process.exitcode,
+               log_file = prepare_testing.test_log_file(chunk.build_dir,
+                                                        test["name"]),
+               message = "The worker process terminated with "
+                         "exit code %d" % process.exitcode)
+            n_received += 1
+
+            if n_received < len(chunk.tests):
+               chunk.tests = chunk.tests[n_received:]
+               self.pending_chunks.insert(0, chunk)
+
+      if result is None:
+         del self.workers[receiver]
+         receiver.close()
+         process.join()
+         return
+
+      self.workers[receiver] = (process, chunk, n_received + 1)
+
+      yield result
+
+# Runs chunks in at most jobs worker processes and yields all
+# results (see TestChunkPool).
+#
+def run_test_chunks(chunks, jobs, chunk_runner):
+
+   pool = TestChunkPool(jobs, chunk_runner)
+   pool.addChunks(chunks)
+
+   while not pool.isIdle():
+
+      pool.startWorkers()
+
+      for receiver in multiprocessing.connection.wait(pool.connections()):
+         for result in pool.receive(receiver):
+            yield result
+
+def report_result(result, n_reported, n_tests, file = sys.stdout):
+
+   file.write("%4d/%d  %-8s %8.2f s  %s\n"
+      % (n_reported, n_tests, result["status"].upper(), result["duration"],
+         result["name"]))
+
+   if result["status"] == "passed":
+      return
+
+   if result["message"]:
+      file.write("   " + result["message"].strip().replace("\n", "\n   ")
+                 + "\n")
+
+   if result["log_file"]:
+      file.write("   See \"%s\"\n" % result["log_file"])
+
+# Runs all tests in at most jobs worker processes. Tests whose firmware
+# was not build are not run.
+#
+# Returns a list of result dicts ordered like tests.
+#
+def run_tests(tests, build_dir, jobs,
+              preload_module = default_preload_module,
+              leidokos_python_dir = None,
+              init_script = None,
+              chunk_runner = run_test_chunk,
+              file = sys.stdout):
+
+   results = []
+   runnable_tests = []
+   for test in tests:
+      if os.path.exists(prepare_testing.firmware_binary(
+                           build_dir, test["firmware_build_id"])):
+         runnable_tests.append(test)
+      else:
+         results.append(test_result(test, "not_built",
+            message = "Firmware build %s does not exist"
+                      % str(test["firmware_build_id"])))
+
+   for result in results:
+      report_result(result, len(results), len(tests), file)
+
+   chunks = plan_test_chunks(runnable_tests, build_dir, jobs,
+                             preload_module, leidokos_python_dir,
+                             init_script)
+
+   for result in run_test_chunks(chunks, max(1, jobs), chunk_runner):
+      results.append(result)
+      report_result(result, len(results), len(tests), file)
+
+   return sort_results(results, tests)
+
+def report_summary(results, duration, file = sys.stdout):
+
+   n_passed = sum(1 for result in results if result["status"] == "passed")
+
+   file.write("\n%d of %d tests passed, %.2f s\n"
+              % (n_passed, len(results), duration))
+
+   for result in results:
+      if result["status"] != "passed":
+         file.write("   %-10s %s\n" % (result["status"], result["name"]))
+
+def write_results(results_filename, results):
+
+   with open(results_filename, "w") as stream:
+      json.dump({ "tests" : results }, stream, indent = 3)
+      stream.write("\n")
+
+# Records the results of all tests that were run in a timing history
+#
+def record_results(history_filename, results):
+
+   with timing_history.TimingHistory(history_filename) as history:
+      for result in results:
+         if result["status"] in ("not_built", "error"):
+            continue
+         history.recordTest(result["name"], result["duration"],
+                            exit_status = result["exit_code"],
+                            peak_memory_kb = result["peak_memory_kb"],
+                            firmware_digest = result["firmware_digest"])
+
+# Adds the options that control how workers load the firmware and
+# run tests to an argument parser. They are shared with
+# build_pipeline.py, see worker_options(...).
+#
+def add_worker_arguments(parser):
+
+   parser.add_argument('--preload_module',
+     metavar  = 'name',
+     dest     = 'preload_module',
+     default  = default_preload_module,
+     help     = 'The Python module that is imported once per worker '
+                'to load the firmware (an empty string disables '
+                'preloading)'
+   )
+
+   parser.add_argument('--leidokos_python_dir',
+     metavar  = 'path',
+     dest     = 'leidokos_python_dir',
+     help     = 'The python directory of Leidokos-Python '
+                '(default: the one of the respective firmware build)'
+   )
+
+   parser.add_argument('--init_script',
+     metavar  = 'file',
+     dest     = 'init_script',
+     help     = 'A Python script that is run once per worker after '
+                'the firmware module was loaded, e.g. to initialize '
+                'the firmware'
+   )
+
+   parser.add_argument('--fork_server',
+     dest     = 'fork_server',
+     action   = 'store_true',
+     help     = 'Run every test in a child process that is forked '
+                'from the worker after the firmware was loaded and '
+                'initialized'
+   )
+
+# Returns a tuple (preload module, Leidokos-Python directory,
+# init script, chunk runner) for the options added by
+# add_worker_arguments(...). Paths are made absolute as workers
+# run in the firmware build directories.
+#
+def worker_options(args):
+
+   chunk_runner = run_test_chunk
+   if args.fork_server:
+      if not hasattr(os, "fork"):
+         sys.exit("Fork server mode is not supported on this platform.")
+      chunk_runner = run_test_chunk_forked
+
+   init_script = None
+   if args.init_script:
+      init_script = os.path.abspath(args.init_script)
+
+   leidokos_python_dir = None
+   if args.leidokos_python_dir:
+      leidokos_python_dir = os.path.abspath(args.leidokos_python_dir)
+
+   return (args.preload_module, leidokos_python_dir, init_script,
+           chunk_runner)
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool runs the tests of a JSON build graph that is "
+       "generated by prepare_testing.py in a pool of worker processes "
+       "that load every firmware only once.")
+
+    parser.add_argument('-g', '--json_build_graph',
+      metavar  = 'file',
+      dest     = 'json_build_graph',
+      required = True,
+      help     = 'The JSON build graph generated by prepare_testing.py'
+    )
+
+    parser.add_argument('-b', '--build_dir',
+      metavar  = 'path',
+      dest     = 'build_dir',
+      help     = 'The CMake build directory that contains the firmware '
+                 'builds (default: current directory)'
+    )
+
+    parser.add_argument('-j', '--jobs',
+      metavar  = 'N',
+      dest     = 'jobs',
+      type     = int,
+      default  = multiprocessing.cpu_count(),
+      help     = 'The number of worker processes'
+    )
+
+    parser.add_argument('-R', '--tests_regex',
+      metavar  = 'regex',
+      dest     = 'tests_regex',
+      help     = 'Only run tests whose names match the regular expression'
+    )
+
+    add_worker_arguments(parser)
+
+    parser.add_argument('--timing_history',
+      metavar  = 'file',
+      dest     = 'timing_history',
+      help     = 'A timing history database (see timing_history.py) '
+                 'that the results are recorded in'
+    )
+
+    parser.add_argument('--results',
+      metavar  = 'file',
+      dest     = 'results',
+      help     = 'An output file with per-test results (JSON)'
+    )
+
+    args = parser.parse_args()
+
+    build_dir = os.path.abspath(args.build_dir or os.getcwd())
+
+    preload_module, leidokos_python_dir, init_script, chunk_runner \
+       = worker_options(args)
+
+    tests = read_tests(args.json_build_graph, args.tests_regex)
+
+    start_time = time.monotonic()
+
+    results = run_tests(tests, build_dir, args.jobs,
+                        preload_module,
+                        leidokos_python_dir,
+                        init_script,
+                        chunk_runner)
+
+    report_summary(results, time.monotonic() - start_time)
+
+    if args.results:
+       write_results(args.results, results)
+
+    if args.timing_history:
+       record_results(args.timing_history, results)
+
+    if any(result["status"] != "passed" for result in results):
+       sys.exit(1)
+
+if __name__ == "__main__":
+    main()
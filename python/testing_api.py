@@ -0,0 +1,393 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This module is the in-process interface to prepare_testing.py.
+# It allows tools to query tests and firmware builds of a testing
+# tree without spawning a process and without parsing generated
+# CMake code.
+#
+#    import testing_api
+#
+#    tree = testing_api.prepare("path/to/testing_tree")
+#    for test in tree.tests:
+#       print(test.name, test.firmware_build.digest)
+#
+# Errors are reported by raising exceptions derived from
+# testing_api.PrepareTestingError instead of exiting the interpreter.
+# Diagnostics that prepare_testing.py writes to stdout are collected
+# in TestingTree.diagnostics.
+#
+# Trees can be stored as JSON or MessagePack build graphs (see
+# dump(...) and load(...)), the same format that prepare_testing.py
+# writes with --json_build_graph and --msgpack_build_graph. Loading
+# a stored tree neither imports prepare_testing nor scans the tree
+# which makes plain queries start fast. The module msgpack is only
+# required for MessagePack files.
+
+import json
+
+class ModuleInfo(object):
+
+   __slots__ = ("url", "commit", "name")
+
+   def __init__(self, url, commit, name):
+      self.url = url
+      self.commit = commit
+      self.name = name
+
+   def toDict(self):
+      return { "url" : self.url, "commit" : self.commit, "name" : self.name }
+
+   def __repr__(self):
+      return "ModuleInfo(%r, %r, %r)" % (self.url, self.commit, self.name)
+
+# The boards repository and firmware modules that are shared by
+# firmware builds
+#
+class ModuleSetInfo(object):
+
+   __slots__ = ("module_set_id", "digest", "boards_url", "boards_commit",
+                "modules", "firmware_builds")
+
+   def __init__(self, module_set_id, digest, boards_url, boards_commit,
+                modules):
+      self.module_set_id = module_set_id
+      self.digest = digest
+      self.boards_url = boards_url
+      self.boards_commit = boards_commit
+      self.modules = modules
+
+      # The firmware builds that use the module set (filled by TestingTree)
+      #
+      self.firmware_builds = []
+
+   def toDict(self):
+      return {
+         "module_set_id" : self.module_set_id,
+         "digest" : self.digest,
+         "boards_url" : self.boards_url,
+         "boards_commit" : self.boards_commit,
+         "modules" : [ module.toDict() for module in self.modules ],
+         "firmware_build_ids" : [ firmware_build.build_id
+                                  for firmware_build in self.firmware_builds ]
+      }
+
+   @staticmethod
+   def fromDict(data):
+      return ModuleSetInfo(
+         module_set_id = data["module_set_id"],
+         digest = data["digest"],
+         boards_url = data["boards_url"],
+         boards_commit = data["boards_commit"],
+         modules = [ ModuleInfo(module["url"], module["commit"],
+                                module["name"])
+                     for module in data["modules"] ])
+
+   def __repr__(self):
+      return "ModuleSetInfo(%r, %r)" % (self.module_set_id, self.digest)
+
+class FirmwareBuildInfo(object):
+
+   __slots__ = ("build_id", "digest", "module_set_id", "firmware_sketch",
+                "boards_url", "boards_commit", "modules", "origin",
+                "module_set", "tests")
+
+   def __init__(self, build_id, digest, firmware_sketch, boards_url,
+                boards_commit, modules, origin, module_set_id = None):
+      self.build_id = build_id
+      self.digest = digest
+      self.module_set_id = module_set_id
+      self.firmware_sketch = firmware_sketch
+      self.boards_url = boards_url
+      self.boards_commit = boards_commit
+      self.modules = modules
+      self.origin = origin
+
+      # The module set of the firmware (filled by TestingTree)
+      #
+      self.module_set = None
+
+      # The tests that run the firmware (filled by TestingTree)
+      #
+      self.tests = []
+
+   def toDict(self):
+      return {
+         "build_id" : self.build_id,
+         "digest" : self.digest,
+         "module_set_id" : self.module_set_id,
+         "firmware_sketch" : self.firmware_sketch,
+         "boards_url" : self.boards_url,
+         "boards_commit" : self.boards_commit,
+         "modules" : [ module.toDict() for module in self.modules ],
+         "origin" : self.origin
+      }
+
+   @staticmethod
+   def fromDict(data):
+      return FirmwareBuildInfo(
+         build_id = data["build_id"],
+         digest = data["digest"],
+         module_set_id = data.get("module_set_id"),
+         firmware_sketch = data["firmware_sketch"],
+         boards_url = data["boards_url"],
+         boards_commit = data["boards_commit"],
+         modules = [ ModuleInfo(module["url"], module["commit"],
+                                module["name"])
+                     for module in data["modules"] ],
+         origin = data["origin"])
+
+   def __repr__(self):
+      return "FirmwareBuildInfo(%r, %r)" % (self.build_id, self.digest)
+
+class TestInfo(object):
+
+   __slots__ = ("test_id", "name", "description", "python_driver",
+                "driver_cmd_line_flags", "firmware_build", "digest",
+                "path", "origins")
+
+   def __init__(self, test_id, name, description, python_driver,
+                driver_cmd_line_flags, firmware_build, digest, path,
+                origins):
+      self.test_id = test_id
+      self.name = name
+      self.description = description
+      self.python_driver = python_driver
+      self.driver_cmd_line_flags = driver_cmd_line_flags
+      self.firmware_build = firmware_build
+      self.digest = digest
+      self.path = path
+
+      # A dict that maps the names of inherited properties
+      # to the paths of the files that define them
+      #
+      self.origins = origins
+
+   def toDict(self):
+      return {
+         "test_id" : self.test_id,
+         "name" : self.name,
+         "description" : self.description,
+         "python_driver" : self.python_driver,
+         "driver_cmd_line_flags" : self.driver_cmd_line_flags,
+         "firmware_build_id" : self.firmware_build.build_id,
+         "digest" : self.digest,
+         "path" : self.path,
+         "origins" : dict(self.origins)
+      }
+
+   @staticmethod
+   def fromDict(data, firmware_builds_by_id):
+      return TestInfo(
+         test_id = data["test_id"],
+         name = data["name"],
+         description = data["description"],
+         python_driver = data["python_driver"],
+         driver_cmd_line_flags = data["driver_cmd_line_flags"],
+         firmware_build = firmware_builds_by_id[data["firmware_build_id"]],
+         digest = data["digest"],
+         path = data["path"],
+         origins = data["origins"])
+
+   def __repr__(self):
+      return "TestInfo(%r, %r)" % (self.test_id, self.name)
+
+# The tests, firmware builds and module sets of a testing tree
+#
+class TestingTree(object):
+
+   def __init__(self, firmware_builds, tests,
+                diagnostics = None,
+                test_nodes_by_path = None,
+                module_sets = None):
+
+      self.firmware_builds = firmware_builds
+      self.tests = tests
+      self.module_sets = module_sets or []
+
+      # Diagnostic messages that were emitted while the
+      # tree was prepared
+      #
+      self.diagnostics = diagnostics or []
+
+      # The test nodes of prepare_testing.py, ordered by path. Only
+      # available for trees that were returned by prepare(...).
+      #
+      self.test_nodes_by_path = test_nodes_by_path
+
+      self.tests_by_name = {}
+      self.tests_by_id = {}
+      for test in tests:
+         self.tests_by_name[test.name] = test
+         self.tests_by_id[test.test_id] = test
+         test.firmware_build.tests.append(test)
+
+      self.firmware_builds_by_id = {}
+      self.firmware_builds_by_digest = {}
+      for firmware_build in firmware_builds:
+         self.firmware_builds_by_id[firmware_build.build_id] = firmware_build
+         self.firmware_builds_by_digest[firmware_build.digest] \
+            = firmware_build
+
+      self.module_sets_by_id = {}
+      for module_set in self.module_sets:
+         self.module_sets_by_id[module_set.module_set_id] = module_set
+      for firmware_build in firmware_builds:
+         module_set = self.module_sets_by_id.get(firmware_build.module_set_id)
+         if module_set is not None:
+            firmware_build.module_set = module_set
+            module_set.firmware_builds.append(firmware_build)
+
+   def getTest(self, name):
+      return self.tests_by_name[name]
+
+   def getFirmwareBuild(self, build_id):
+      return self.firmware_builds_by_id[build_id]
+
+   def getModuleSet(self, module_set_id):
+      return self.module_sets_by_id[module_set_id]
+
+   # Returns the build graph as plain data, see
+   # prepare_testing.build_graph(...)
+   #
+   def toDict(self):
+      return {
+         "module_sets" : [ module_set.toDict()
+                           for module_set in self.module_sets ],
+         "firmware_builds" : [ firmware_build.toDict()
+                               for firmware_build in self.firmware_builds ],
+         "tests" : [ test.toDict() for test in self.tests ]
+      }
+
+   @staticmethod
+   def fromDict(data, diagnostics = None, test_nodes_by_path = None):
+
+      # Build graphs that were written before module sets were
+      # introduced do not list any
+      #
+      module_sets = [ ModuleSetInfo.fromDict(module_set)
+                      for module_set in data.get("module_sets", []) ]
+
+      firmware_builds = [ FirmwareBuildInfo.fromDict(firmware_build)
+                          for firmware_build in data["firmware_builds"] ]
+
+      firmware_builds_by_id = {}
+      for firmware_build in firmware_builds:
+         firmware_builds_by_id[firmware_build.build_id] = firmware_build
+
+      tests = [ TestInfo.fromDict(test, firmware_builds_by_id)
+                for test in data["tests"] ]
+
+      return TestingTree(firmware_builds, tests,
+                         diagnostics, test_nodes_by_path, module_sets)
+
+# Scans and prepares the testing tree at testing_tree_roots, a path
+# or a list of tuples (path, name prefix) of several testing trees
+# that share firmware builds. The keyword arguments are those of
+# prepare_testing.prepare_tests(...).
+#
+# Raises a PrepareTestingError if the testing tree is invalid.
+#
+def prepare(testing_tree_roots, **kwargs):
+
+   import prepare_testing
+
+   diagnostics = []
+
+   previous_reporter = prepare_testing.reporter
+   prepare_testing.reporter = diagnostics.append
+   try:
+      test_nodes_by_path, unique_firmware_builds_by_digest \
+         = prepare_testing.prepare_tests(testing_tree_roots, **kwargs)
+   finally:
+      prepare_testing.reporter = previous_reporter
+
+   return TestingTree.fromDict(
+               prepare_testing.build_graph(test_nodes_by_path,
+                                           unique_firmware_builds_by_digest),
+               diagnostics,
+               test_nodes_by_path)
+
+def import_msgpack():
+
+   try:
+      import msgpack
+   except ImportError:
+      raise ImportError("The Python module msgpack is required "
+                        "to read and write MessagePack files")
+   return msgpack
+
+# Determines the format of a build graph file from its extension
+#
+def guess_format(filename):
+
+   if filename.endswith((".msgpack", ".mp")):
+      return "msgpack"
+   return "json"
+
+# Loads a testing tree from a JSON or MessagePack build graph file
+#
+def load(filename, format = None):
+
+   format = format or guess_format(filename)
+
+   if format == "msgpack":
+      msgpack = import_msgpack()
+      with open(filename, "rb") as stream:
+         data = msgpack.unpack(stream, raw = False)
+   else:
+      with open(filename, "r") as stream:
+         data = json.load(stream)
+
+   return TestingTree.fromDict(data)
+
+# Stores a testing tree as a JSON or MessagePack build graph file
+#
+def dump(tree, filename, format = None):
+
+   format = format or guess_format(filename)
+
+   if format == "msgpack":
+      msgpack = import_msgpack()
+      with open(filename, "wb") as stream:
+         msgpack.pack(tree.toDict(), stream)
+   else:
+      with open(filename, "w") as stream:
+         json.dump(tree.toDict(), stream, indent = 3)
+         stream.write("\n")
+
+exception_names = ("PrepareTestingError",
+                   "InvalidTestingTreeError",
+                   "ExternalSpecificationError",
+                   "TestNameConflictError",
+                   "ShardSpecificationError",
+                   "GitError")
+
+# The exception classes are defined by prepare_testing. They are
+# resolved on first access to keep the import of this module cheap.
+#
+def __getattr__(name):
+
+   if name in exception_names:
+      import prepare_testing
+      return getattr(prepare_testing, name)
+
+   raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,323 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script generates synthetic testing trees of arbitrary
+# size that can be processed by prepare_testing.py. It is used by
+# the benchmark suite (see benchmark.py) to measure how the preparation
+# of testing trees scales.
+#
+# The shape of a tree is defined by a set of parameters
+#
+# - depth: the number of directory levels below the root
+# - fan_out: the number of subdirectories of every interior directory
+# - test_share: the share of interior directories that contain a
+#     __test__ flag file
+# - specification_share: the share of directories that contain a
+#     specification file. Properties of specification files are
+#     inherited by all subdirectories
+# - modules: the number of modules a specification file adds to
+#     the firmware build
+# - module_pool: the number of distinct module repositories
+#     modules are selected from
+# - sketch_share: the share of directories that contain a sketch
+# - sketch_variants: the number of distinct sketch contents. The smaller
+#     this number, the more firmware builds are shared
+# - driver_share: the share of directories that contain a driver
+# - seed: the seed of the random number generator
+#
+# The root directory always contains a specification, a sketch and
+# a driver, i.e. every generated tree is valid. Trees are
+# generated deterministically, i.e. equal parameters result in
+# identical trees.
+
+import argparse
+import sys
+import os
+import random
+import json
+
+class TreeParameters(object):
+
+   def __init__(self,
+                depth = 3,
+                fan_out = 10,
+                test_share = 0.1,
+                specification_share = 0.2,
+                modules = 2,
+                module_pool = 20,
+                sketch_share = 0.1,
+                sketch_variants = 10,
+                driver_share = 0.2,
+                seed = 1):
+
+      self.depth = depth
+      self.fan_out = fan_out
+      self.test_share = test_share
+      self.specification_share = specification_share
+      self.modules = modules
+      self.module_pool = module_pool
+      self.sketch_share = sketch_share
+      self.sketch_variants = sketch_variants
+      self.driver_share = driver_share
+      self.seed = seed
+
+   # The number of directories of a tree with the given parameters
+   #
+   def getNumDirectories(self):
+      return sum(self.fan_out**level for level in range(self.depth + 1))
+
+   def toDict(self):
+      return dict(self.__dict__)
+
+   @staticmethod
+   def fromDict(parameters):
+      return TreeParameters(**parameters)
+
+# Counts the files and directories that are generated
+#
+class TreeStatistics(object):
+
+   def __init__(self):
+      self.directories = 0
+      self.test_flags = 0
+      self.specifications = 0
+      self.sketches = 0
+      self.drivers = 0
+
+   def toDict(self):
+      return dict(self.__dict__)
+
+def write_file(filename, content):
+   with open(filename, "w") as stream:
+      stream.write(content)
+
+def generate_specification(rng, parameters, name):
+
+   lines = [ "---",
+             "   description: Synthetic test %s" % name ]
+
+   n_modules = min(parameters.modules, parameters.module_pool)
+
+   if n_modules > 0:
+      lines.append("   modules:")
+
+      for module_id in sorted(rng.sample(range(parameters.module_pool),
+                                         n_modules)):
+         lines.append("      - url: https://example.com/Module%d.git"
+                      % module_id)
+         lines.append("        commit: commit%d" % rng.randint(0, 1))
+         lines.append("        name: Module%d" % module_id)
+
+   return "\n".join(lines) + "\n"
+
+def generate_sketch(rng, parameters):
+
+   variant = rng.randrange(max(1, parameters.sketch_variants))
+
+   return "// Synthetic sketch variant %d\n" % variant
+
+def generate_driver(rng, name):
+   return "# Synthetic driver of %s\n" % name
+
+# Generates a testing tree in directory root. The directory must not
+# exist or be empty.
+#
+def generate_testing_tree(root, parameters):
+
+   rng = random.Random(parameters.seed)
+
+   statistics = TreeStatistics()
+
+   # Every entry is a tuple (path, level)
+   #
+   directories_to_visit = [(root, 0)]
+
+   while directories_to_visit:
+
+      path, level = directories_to_visit.pop()
+
+      os.makedirs(path, exist_ok = True)
+      statistics.directories += 1
+
+      is_root = (level == 0)
+      is_leaf = (level == parameters.depth)
+
+      name = os.path.relpath(path, root)
+
+      if is_root or rng.random() < parameters.specification_share:
+         write_file(os.path.join(path, "specification.yaml"),
+                    generate_specification(rng, parameters, name))
+         statistics.specifications += 1
+
+      if is_root or rng.random() < parameters.sketch_share:
+         write_file(os.path.join(path, "sketch.ino"),
+                    generate_sketch(rng, parameters))
+         statistics.sketches += 1
+
+      if is_root or rng.random() < parameters.driver_share:
+         write_file(os.path.join(path, "driver.py"),
+                    generate_driver(rng, name))
+         statistics.drivers += 1
+
+      if not is_leaf and rng.random() < parameters.test_share:
+         write_file(os.path.join(path, "__test__"), "")
+         statistics.test_flags += 1
+
+      if is_leaf:
+         continue
+
+      for child_id in reversed(range(parameters.fan_out)):
+         directories_to_visit.append(
+            (os.path.join(path, "n%d" % child_id), level + 1))
+
+   return statistics
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool generates synthetic testing trees that can be "
+       "processed by prepare_testing.py.")
+
+    defaults = TreeParameters()
+
+    parser.add_argument('-d', '--testing_tree_root',
+      metavar  = 'path',
+      dest     = 'testing_tree_root',
+      required = True,
+      help     = 'The root directory of the generated testing tree'
+    )
+
+    parser.add_argument('--depth',
+      metavar  = 'N',
+      dest     = 'depth',
+      type     = int,
+      default  = defaults.depth,
+      help     = 'The number of directory levels below the root '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--fan_out',
+      metavar  = 'N',
+      dest     = 'fan_out',
+      type     = int,
+      default  = defaults.fan_out,
+      help     = 'The number of subdirectories of every interior '
+                 'directory (default: %(default)s)'
+    )
+
+    parser.add_argument('--test_share',
+      metavar  = 'share',
+      dest     = 'test_share',
+      type     = float,
+      default  = defaults.test_share,
+      help     = 'The share of interior directories with a __test__ '
+                 'flag file (default: %(default)s)'
+    )
+
+    parser.add_argument('--specification_share',
+      metavar  = 'share',
+      dest     = 'specification_share',
+      type     = float,
+      default  = defaults.specification_share,
+      help     = 'The share of directories with a specification file '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--modules',
+      metavar  = 'N',
+      dest     = 'modules',
+      type     = int,
+      default  = defaults.modules,
+      help     = 'The number of modules per specification file '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--module_pool',
+      metavar  = 'N',
+      dest     = 'module_pool',
+      type     = int,
+      default  = defaults.module_pool,
+      help     = 'The number of distinct modules '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--sketch_share',
+      metavar  = 'share',
+      dest     = 'sketch_share',
+      type     = float,
+      default  = defaults.sketch_share,
+      help     = 'The share of directories with a sketch file '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--sketch_variants',
+      metavar  = 'N',
+      dest     = 'sketch_variants',
+      type     = int,
+      default  = defaults.sketch_variants,
+      help     = 'The number of distinct sketch contents '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--driver_share',
+      metavar  = 'share',
+      dest     = 'driver_share',
+      type     = float,
+      default  = defaults.driver_share,
+      help     = 'The share of directories with a driver file '
+                 '(default: %(default)s)'
+    )
+
+    parser.add_argument('--seed',
+      metavar  = 'N',
+      dest     = 'seed',
+      type     = int,
+      default  = defaults.seed,
+      help     = 'The seed of the random number generator '
+                 '(default: %(default)s)'
+    )
+
+    args = parser.parse_args()
+
+    parameters = TreeParameters(depth = args.depth,
+                                fan_out = args.fan_out,
+                                test_share = args.test_share,
+                                specification_share
+                                   = args.specification_share,
+                                modules = args.modules,
+                                module_pool = args.module_pool,
+                                sketch_share = args.sketch_share,
+                                sketch_variants = args.sketch_variants,
+                                driver_share = args.driver_share,
+                                seed = args.seed)
+
+    if os.path.exists(args.testing_tree_root) \
+          and os.listdir(args.testing_tree_root):
+       sys.exit("Directory \"%s\" is not empty" % args.testing_tree_root)
+
+    statistics = generate_testing_tree(args.testing_tree_root, parameters)
+
+    json.dump(statistics.toDict(), sys.stdout, indent = 1, sort_keys = True)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# Shared fixtures of the tests of the Python tools. The tools are
+# plain modules in the parent directory.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import testing_tree_generator
+
+# A small synthetic testing tree (see testing_tree_generator.py)
+#
+@pytest.fixture
+def testing_tree(tmp_path):
+
+   root = str(tmp_path / "testing")
+
+   testing_tree_generator.generate_testing_tree(root,
+      testing_tree_generator.TreeParameters(depth = 2, fan_out = 3,
+                                            test_share = 0.5))
+
+   return root
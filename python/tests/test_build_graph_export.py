@@ -0,0 +1,63 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+import prepare_testing
+import testing_api
+
+def prepare(testing_tree):
+   return prepare_testing.prepare_tests(testing_tree)
+
+def test_msgpack_export_matches_json_export(testing_tree, tmp_path):
+
+   msgpack = pytest.importorskip("msgpack")
+
+   test_nodes_by_path, unique_firmware_builds_by_digest \
+      = prepare(testing_tree)
+
+   json_filename = str(tmp_path / "build_graph.json")
+   msgpack_filename = str(tmp_path / "build_graph.msgpack")
+
+   prepare_testing.export_as_json(json_filename, test_nodes_by_path,
+                                  unique_firmware_builds_by_digest)
+   prepare_testing.export_as_msgpack(msgpack_filename, test_nodes_by_path,
+                                     unique_firmware_builds_by_digest)
+
+   with open(json_filename, "r") as stream:
+      json_graph = json.load(stream)
+
+   with open(msgpack_filename, "rb") as stream:
+      msgpack_graph = msgpack.unpack(stream, raw = False)
+
+   assert json_graph["tests"]
+   assert msgpack_graph == json_graph
+
+def test_stored_trees_round_trip(testing_tree, tmp_path):
+
+   pytest.importorskip("msgpack")
+
+   tree = testing_api.prepare(testing_tree)
+
+   for filename in ("tree.json", "tree.msgpack"):
+      testing_api.dump(tree, str(tmp_path / filename))
+      loaded_tree = testing_api.load(str(tmp_path / filename))
+      assert loaded_tree.toDict() == tree.toDict()
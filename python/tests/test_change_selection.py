@@ -0,0 +1,127 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# -*- coding: utf-8 -*-
+
+import os
+
+import prepare_testing
+
+def prepare(testing_tree):
+
+   test_nodes_by_path, unique_firmware_builds_by_digest \
+      = prepare_testing.prepare_tests(testing_tree)
+
+   return test_nodes_by_path
+
+def affected(test_nodes_by_path, testing_tree, changed_files):
+   return prepare_testing.determine_affected_test_paths(test_nodes_by_path,
+                                                        [testing_tree],
+                                                        changed_files)
+
+# The paths of all test nodes at or below a directory that generate
+# tests
+#
+def generating_paths_below(test_nodes_by_path, directory):
+   return set(path for path, test_node in test_nodes_by_path.items()
+              if test_node.generatesTests()
+              and (path == directory
+                   or path.startswith(directory + os.sep)))
+
+# Returns a directory below the root that defines its own driver
+#
+def node_with_driver(test_nodes_by_path, testing_tree):
+
+   for path, test_node in sorted(test_nodes_by_path.items()):
+      if path != testing_tree and test_node.python_driver \
+            and os.path.dirname(test_node.python_driver.filename) == path:
+         return path
+
+   return None
+
+def test_changed_driver_affects_the_generating_paths_below(testing_tree):
+
+   test_nodes_by_path = prepare(testing_tree)
+
+   path = node_with_driver(test_nodes_by_path, testing_tree)
+   assert path
+
+   driver = test_nodes_by_path[path].python_driver.filename
+
+   assert affected(test_nodes_by_path, testing_tree, [driver]) \
+      == generating_paths_below(test_nodes_by_path, path)
+
+def test_changed_root_specification_affects_all_tests(testing_tree):
+
+   test_nodes_by_path = prepare(testing_tree)
+
+   specification = os.path.join(testing_tree, "specification.yaml")
+   assert os.path.exists(specification)
+
+   assert affected(test_nodes_by_path, testing_tree, [specification]) \
+      == generating_paths_below(test_nodes_by_path, testing_tree)
+
+def test_changes_outside_of_the_tree_affect_all_tests(testing_tree, tmp_path):
+
+   test_nodes_by_path = prepare(testing_tree)
+
+   source_file = str(tmp_path / "src" / "Kaleidoscope-Plugin.cpp")
+
+   assert affected(test_nodes_by_path, testing_tree, [source_file]) \
+      == generating_paths_below(test_nodes_by_path, testing_tree)
+
+def test_removed_input_file_affects_the_tests_of_its_directory(testing_tree):
+
+   test_nodes_by_path = prepare(testing_tree)
+
+   path = node_with_driver(test_nodes_by_path, testing_tree)
+
+   removed_sketch = os.path.join(path, "removed_sketch.ino")
+
+   assert affected(test_nodes_by_path, testing_tree, [removed_sketch]) \
+      == generating_paths_below(test_nodes_by_path, path)
+
+def test_other_files_of_the_tree_are_ignored(testing_tree):
+
+   test_nodes_by_path = prepare(testing_tree)
+
+   readme = os.path.join(testing_tree, "README.md")
+
+   assert affected(test_nodes_by_path, testing_tree, [readme]) == set()
+
+def test_selection_keeps_the_firmware_builds_of_affected_tests(testing_tree):
+
+   test_nodes_by_path, unique_firmware_builds_by_digest \
+      = prepare_testing.prepare_tests(testing_tree)
+
+   path = node_with_driver(test_nodes_by_path, testing_tree)
+   driver = test_nodes_by_path[path].python_driver.filename
+
+   selected_nodes_by_path, selected_builds_by_digest \
+      = prepare_testing.select_changed(test_nodes_by_path,
+                                       unique_firmware_builds_by_digest,
+                                       [testing_tree], [driver])
+
+   selected_tests = set(path for path, test_node 
+                        in selected_nodes_by_path.items()
+                        if test_node.generatesTests())
+
+   assert selected_tests == generating_paths_below(test_nodes_by_path, path)
+   assert set(selected_builds_by_digest.keys()) \
+      == set(selected_nodes_by_path[path].unique_firmware_build.getDigest()
+             for path in selected_tests)
@@ -0,0 +1,144 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import socket
+import threading
+import http.server
+
+import pytest
+
+import firmware_cache
+
+key = "0123456789abcdef" * 4
+other_key = "fedcba9876543210" * 4
+
+def write_firmware(path, data):
+   path.write_bytes(data)
+   return str(path)
+
+def test_restore_after_publish(tmp_path):
+
+   cache = firmware_cache.open_cache(str(tmp_path / "cache"))
+
+   source = write_firmware(tmp_path / "firmware.so", b"firmware")
+   target = str(tmp_path / "restored" / "firmware.so")
+
+   assert not cache.restore(key, target)
+   assert not os.path.exists(target)
+
+   cache.publish(key, source)
+
+   assert cache.restore(key, target)
+   with open(target, "rb") as stream:
+      assert stream.read() == b"firmware"
+
+   statistics = cache.statistics.toDict()
+   assert (statistics["hits"], statistics["misses"],
+           statistics["publishes"]) == (1, 1, 1)
+   assert statistics["hit_rate"] == 0.5
+
+def test_least_recently_used_artifacts_are_evicted(tmp_path):
+
+   cache = firmware_cache.open_cache(str(tmp_path / "cache"), max_size = 15)
+
+   source = write_firmware(tmp_path / "firmware.so", b"0123456789")
+
+   cache.publish(key, source)
+   os.utime(cache.backend.artifactPath(key), (1000, 1000))
+
+   cache.publish(other_key, source)
+
+   assert cache.statistics.evictions == 1
+   assert not cache.backend.contains(key)
+   assert cache.backend.contains(other_key)
+
+def unused_port():
+   with socket.socket() as sock:
+      sock.bind(("127.0.0.1", 0))
+      return sock.getsockname()[1]
+
+def test_unreachable_server_counts_as_miss(tmp_path, capsys):
+
+   cache = firmware_cache.open_cache("http://127.0.0.1:%d" % unused_port(),
+                                     timeout = 1)
+
+   source = write_firmware(tmp_path / "firmware.so", b"firmware")
+   target = str(tmp_path / "restored" / "firmware.so")
+
+   assert not cache.restore(key, target)
+   cache.publish(key, source)
+
+   assert cache.statistics.toDict()["misses"] == 1
+   assert cache.statistics.publishes == 0
+   assert "unavailable" in capsys.readouterr().out
+
+   with pytest.raises(firmware_cache.CacheUnavailableError):
+      cache.backend.contains(key)
+
+@pytest.fixture
+def cache_server(tmp_path, monkeypatch):
+
+   server_cache = firmware_cache.open_cache(str(tmp_path / "server"))
+   monkeypatch.setattr(firmware_cache.CacheRequestHandler, "cache",
+                       server_cache)
+
+   server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                            firmware_cache.CacheRequestHandler)
+   thread = threading.Thread(target = server.serve_forever)
+   thread.start()
+
+   try:
+      yield ("http://127.0.0.1:%d" % server.server_address[1], server_cache)
+   finally:
+      server.shutdown()
+      thread.join()
+      server.server_close()
+
+def test_restore_from_server(cache_server, tmp_path):
+
+   url, server_cache = cache_server
+
+   cache = firmware_cache.open_cache(url)
+
+   source = write_firmware(tmp_path / "firmware.so", b"firmware")
+   target = str(tmp_path / "restored" / "firmware.so")
+
+   assert not cache.restore(key, target)
+
+   cache.publish(key, source)
+   assert cache.backend.contains(key)
+
+   assert cache.restore(key, target)
+   with open(target, "rb") as stream:
+      assert stream.read() == b"firmware"
+
+   assert server_cache.statistics.toDict()["publishes"] == 1
+   assert json.loads(cache.backend.readStatistics())["hits"] == 1
+
+def test_server_rejects_invalid_keys(cache_server, tmp_path):
+
+   url, server_cache = cache_server
+
+   cache = firmware_cache.open_cache(url)
+
+   with pytest.raises(firmware_cache.CacheUnavailableError):
+      cache.backend.read("../secret")
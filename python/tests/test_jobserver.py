@@ -0,0 +1,115 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# -*- coding: utf-8 -*-
+
+import os
+
+import jobserver
+
+def acquire_all(server):
+
+   tokens = []
+   while True:
+      token = server.tryAcquire()
+      if token is None:
+         return tokens
+      tokens.append(token)
+
+def test_jobserver_holds_one_token_less_than_slots():
+
+   with jobserver.create_jobserver(4) as server:
+
+      assert server.slots == 4
+      assert " -j4 " in server.makeflags + " "
+      assert "--jobserver-auth=" in server.makeflags
+
+      # The implicit slot is owned by this process
+      #
+      assert len(acquire_all(server)) == 3
+
+def test_released_tokens_can_be_acquired_again():
+
+   with jobserver.create_jobserver(3) as server:
+
+      tokens = acquire_all(server)
+      assert server.tryAcquire() is None
+
+      server.release(tokens.pop())
+
+      token = server.tryAcquire()
+      assert token is not None
+      assert server.tryAcquire() is None
+
+      for token in tokens + [token]:
+         server.release(token)
+
+      assert len(acquire_all(server)) == 2
+
+def test_single_slot_jobserver_has_no_tokens():
+
+   for slots in (0, 1):
+      with jobserver.create_jobserver(slots) as server:
+         assert server.slots == 1
+         assert server.tryAcquire() is None
+
+def test_child_environment_uses_the_jobserver():
+
+   with jobserver.create_jobserver(2) as server:
+
+      env = server.environment({ "MAKEFLAGS" : "-k", "MFLAGS" : "-k",
+                                 "PATH" : "/bin" })
+
+      assert env["MAKEFLAGS"] == server.makeflags
+      assert "MFLAGS" not in env
+      assert env["PATH"] == "/bin"
+
+def test_joined_jobserver_shares_tokens():
+
+   with jobserver.create_jobserver(3) as server:
+
+      fifo = os.path.join(server.tmp_dir, "jobserver")
+
+      joined = jobserver.join_jobserver(" -j3 --jobserver-auth=fifo:" + fifo)
+      assert joined.slots == 3
+
+      try:
+         token = joined.tryAcquire()
+         assert token is not None
+         assert len(acquire_all(server)) == 1
+
+         joined.release(token)
+         assert server.tryAcquire() == token
+      finally:
+         joined.close()
+
+def test_close_removes_the_named_pipe():
+
+   server = jobserver.create_jobserver(2)
+   tmp_dir = server.tmp_dir
+
+   server.close()
+
+   assert not os.path.exists(tmp_dir)
+
+def test_missing_jobserver_is_not_joined():
+
+   assert jobserver.join_jobserver(None) is None
+   assert jobserver.join_jobserver("-k") is None
+   assert jobserver.join_jobserver(
+             " -j2 --jobserver-auth=fifo:/nonexistent/jobserver") is None
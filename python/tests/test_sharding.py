@@ -0,0 +1,109 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import prepare_testing
+
+def test_shard_specifications_are_parsed():
+
+   assert prepare_testing.parse_shard("1/4") == (1, 4)
+
+   for shard in ("4/4", "-1/4", "0/0", "1", "a/b"):
+      with pytest.raises(prepare_testing.ShardSpecificationError):
+         prepare_testing.parse_shard(shard)
+
+def test_shard_assignment_is_deterministic():
+
+   estimated_costs = dict(("%02x" % n, float(n % 5)) for n in range(30))
+   reversed_costs = dict(reversed(list(estimated_costs.items())))
+
+   assert prepare_testing.assign_shards(estimated_costs, 4) \
+      == prepare_testing.assign_shards(reversed_costs, 4)
+
+def test_shard_assignment_balances_costs():
+
+   estimated_costs = { "a" : 7.0, "b" : 5.0, "c" : 4.0, "d" : 3.0, 
+                       "e" : 1.0 }
+
+   shards_by_digest = prepare_testing.assign_shards(estimated_costs, 2)
+
+   loads = [0.0, 0.0]
+   for digest, shard in shards_by_digest.items():
+      loads[shard] += estimated_costs[digest]
+
+   assert sorted(loads) == [10.0, 10.0]
+
+def test_ties_are_broken_by_digest():
+
+   shards_by_digest = prepare_testing.assign_shards({ "b" : 1.0, 
+                                                      "a" : 1.0 }, 2)
+
+   assert shards_by_digest == { "a" : 0, "b" : 1 }
+
+def test_shards_partition_firmware_builds_and_tests(testing_tree):
+
+   test_nodes_by_path, unique_firmware_builds_by_digest \
+      = prepare_testing.prepare_tests(testing_tree)
+
+   all_tests = set(test_id for test_id, test_node
+                   in prepare_testing.enumerate_tests(test_nodes_by_path))
+
+   shard_count = 3
+
+   digests = []
+   tests = []
+   for shard_index in range(shard_count):
+
+      shard_nodes_by_path, shard_builds_by_digest \
+         = prepare_testing.select_shard(test_nodes_by_path,
+                                        unique_firmware_builds_by_digest,
+                                        shard_index, shard_count)
+
+      digests += shard_builds_by_digest.keys()
+
+      for test_id, test_node \
+            in prepare_testing.enumerate_tests(shard_nodes_by_path):
+         assert test_node.unique_firmware_build.getDigest() \
+                  in shard_builds_by_digest
+         tests.append(test_id)
+
+   assert sorted(digests) == sorted(unique_firmware_builds_by_digest.keys())
+   assert len(tests) == len(all_tests)
+   assert set(tests) == all_tests
+
+def test_recorded_costs_move_builds_between_shards(testing_tree):
+
+   test_nodes_by_path, unique_firmware_builds_by_digest \
+      = prepare_testing.prepare_tests(testing_tree)
+
+   digests = sorted(unique_firmware_builds_by_digest.keys())
+   assert len(digests) > 1
+
+   # A single expensive build occupies one shard on its own
+   #
+   costs = { "firmware_builds" : { digests[-1] : 1.0e6 } }
+
+   shard_nodes_by_path, shard_builds_by_digest \
+      = prepare_testing.select_shard(test_nodes_by_path,
+                                     unique_firmware_builds_by_digest,
+                                     0, 2, costs)
+
+   assert list(shard_builds_by_digest.keys()) == [digests[-1]]
@@ -0,0 +1,116 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# -*- coding: utf-8 -*-
+
+import os
+
+import test_runner
+
+def make_test(n, build_id, module_set_id = "m"):
+   return { "test_id" : "%016x" % n,
+            "name" : "test_%d" % n,
+            "firmware_build_id" : build_id,
+            "module_set_id" : module_set_id }
+
+def test_chunks_group_tests_by_firmware_build(tmp_path):
+
+   tests = [make_test(n, "b%d" % (n % 2)) for n in range(10)]
+
+   chunks = test_runner.plan_test_chunks(tests, str(tmp_path), jobs = 1)
+
+   assert sorted(chunk.build_id for chunk in chunks) == ["b0", "b1"]
+
+   for chunk in chunks:
+      assert all(test["firmware_build_id"] == chunk.build_id
+                 for test in chunk.tests)
+      assert chunk.python_path[0] == chunk.firmware_dir
+
+def test_chunks_are_split_to_occupy_all_workers(tmp_path):
+
+   tests = [make_test(n, "b") for n in range(40)]
+
+   chunks = test_runner.plan_test_chunks(tests, str(tmp_path), jobs = 4)
+
+   assert [len(chunk.tests) for chunk in chunks] == [10, 10, 10, 10]
+   assert [test for chunk in chunks for test in chunk.tests] == tests
+
+def test_small_groups_are_not_split(tmp_path):
+
+   tests = [make_test(n, "b") for n in range(test_runner.min_chunk_size)]
+
+   chunks = test_runner.plan_test_chunks(tests, str(tmp_path), jobs = 8)
+
+   assert len(chunks) == 1
+
+def test_chunks_are_ordered_by_decreasing_size(tmp_path):
+
+   tests = [make_test(n, "small") for n in range(2)] \
+         + [make_test(n, "large") for n in range(2, 12)]
+
+   chunks = test_runner.plan_test_chunks(tests, str(tmp_path), jobs = 1)
+
+   assert [chunk.build_id for chunk in chunks] == ["large", "small"]
+
+# A chunk runner that terminates its worker process when it reaches
+# a test whose name starts with "crash"
+#
+def crashing_chunk_runner(chunk):
+
+   for test in chunk.tests:
+      if test["name"].startswith("crash"):
+         os._exit(3)
+      yield test_runner.test_result(test, "passed", 0)
+
+def test_pool_reschedules_the_rest_of_a_crashed_chunk(tmp_path):
+
+   tests = [make_test(n, "b") for n in range(5)]
+   tests[1]["name"] = "crash_1"
+
+   chunk = test_runner.TestChunk("b", str(tmp_path), [], None, None,
+                                 str(tmp_path), list(tests))
+
+   results = list(test_runner.run_test_chunks([chunk], 2,
+                                              crashing_chunk_runner))
+
+   statuses = dict((result["name"], result["status"]) for result in results)
+
+   assert statuses == { "test_0" : "passed",
+                        "crash_1" : "crashed",
+                        "test_2" : "passed",
+                        "test_3" : "passed",
+                        "test_4" : "passed" }
+
+   crashed = [result for result in results if result["status"] == "crashed"]
+   assert crashed[0]["exit_code"] == 3
+
+def test_pool_reports_every_crash_of_a_chunk(tmp_path):
+
+   tests = [make_test(n, "b") for n in range(4)]
+   tests[0]["name"] = "crash_0"
+   tests[3]["name"] = "crash_3"
+
+   chunk = test_runner.TestChunk("b", str(tmp_path), [], None, None,
+                                 str(tmp_path), list(tests))
+
+   results = test_runner.sort_results(
+      list(test_runner.run_test_chunks([chunk], 1, crashing_chunk_runner)),
+      tests)
+
+   assert [result["status"] for result in results] \
+      == ["crashed", "passed", "passed", "crashed"]
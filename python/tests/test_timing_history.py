@@ -0,0 +1,105 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import timing_history
+
+@pytest.fixture
+def history(tmp_path):
+   with timing_history.TimingHistory(str(tmp_path / "history.sqlite"),
+                                     max_runs = 3) as history:
+      yield history
+
+def test_first_run_initializes_the_rollup(history):
+
+   history.recordTest("test", 2.0, exit_status = 0, peak_memory_kb = 100)
+
+   rollup = history.rollup(timing_history.kind_test, "test")
+
+   assert rollup["n_runs"] == 1
+   assert rollup["n_failures"] == 0
+   assert rollup["ewma_duration"] == 2.0
+   assert rollup["p95_duration"] == 2.0
+   assert rollup["last_duration"] == 2.0
+   assert rollup["max_peak_memory_kb"] == 100
+
+def test_rollup_accumulates_runs(history):
+
+   history.recordTest("test", 2.0, exit_status = 0, peak_memory_kb = 100)
+   history.recordTest("test", 4.0, exit_status = 1, peak_memory_kb = 50)
+   history.recordTest("test", 1.0, exit_status = 0)
+
+   rollup = history.rollup(timing_history.kind_test, "test")
+
+   alpha = timing_history.ewma_alpha
+   ewma = alpha * 4.0 + (1.0 - alpha) * 2.0
+   ewma = alpha * 1.0 + (1.0 - alpha) * ewma
+
+   assert rollup["n_runs"] == 3
+   assert rollup["n_failures"] == 1
+   assert rollup["ewma_duration"] == pytest.approx(ewma)
+   assert rollup["p95_duration"] == 4.0
+   assert rollup["last_duration"] == 1.0
+   assert rollup["last_exit_status"] == 0
+   assert rollup["max_peak_memory_kb"] == 100
+
+def test_only_the_most_recent_runs_are_kept(history):
+
+   for n in range(5):
+      history.recordTest("test", float(n), started = 1000.0 + n)
+
+   runs = history.runs(timing_history.kind_test, "test")
+
+   assert [run["duration"] for run in runs] == [4.0, 3.0, 2.0]
+
+   # The rollup counts all runs, the percentile only the kept ones
+   #
+   rollup = history.rollup(timing_history.kind_test, "test")
+   assert rollup["n_runs"] == 5
+   assert rollup["p95_duration"] == 4.0
+
+def test_retention_is_per_key(history):
+
+   for n in range(5):
+      history.recordTest("a", 1.0, started = 1000.0 + n)
+   history.recordTest("b", 1.0)
+
+   assert len(history.runs(timing_history.kind_test, "a")) == 3
+   assert len(history.runs(timing_history.kind_test, "b")) == 1
+
+def test_costs_are_exported_by_kind(history):
+
+   history.recordBuild("digest", 60.0)
+   history.recordTest("test", 2.0)
+
+   assert history.exportCosts() == { "firmware_builds" : { "digest" : 60.0 },
+                                     "tests" : { "test" : 2.0 } }
+
+def test_history_files_are_recognized(history, tmp_path):
+
+   history.recordTest("test", 1.0)
+
+   other_file = tmp_path / "costs.json"
+   other_file.write_text("{}")
+
+   assert timing_history.is_history_file(str(tmp_path / "history.sqlite"))
+   assert not timing_history.is_history_file(str(other_file))
+   assert not timing_history.is_history_file(str(tmp_path / "missing"))
@@ -0,0 +1,168 @@
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# -*- coding: utf-8 -*-
+
+import os
+
+import prepare_testing
+
+def prepare(testing_tree, manifest_filename, **kwargs):
+
+   test_nodes_by_path, unique_firmware_builds_by_digest \
+      = prepare_testing.prepare_tests(testing_tree, manifest_filename,
+                                      **kwargs)
+
+   return test_nodes_by_path
+
+def reused_paths(test_nodes_by_path):
+   return set(path for path, test_node in test_nodes_by_path.items()
+              if test_node.reused_from_manifest)
+
+def build_graph(test_nodes_by_path):
+
+   unique_firmware_builds_by_digest \
+      = prepare_testing.determine_unique_firmware_builds(test_nodes_by_path)
+
+   return prepare_testing.build_graph(test_nodes_by_path, 
+                                      unique_firmware_builds_by_digest)
+
+# Returns a directory below the root that defines its own driver
+#
+def node_with_driver(test_nodes_by_path, testing_tree):
+
+   for path, test_node in sorted(test_nodes_by_path.items()):
+      if path != testing_tree and test_node.python_driver \
+            and os.path.dirname(test_node.python_driver.filename) == path:
+         return path
+
+   return None
+
+def test_unchanged_tree_is_reused(testing_tree, tmp_path):
+
+   manifest_filename = str(tmp_path / "manifest.pkl")
+
+   test_nodes_by_path = prepare(testing_tree, manifest_filename)
+   assert reused_paths(test_nodes_by_path) == set()
+   assert os.path.exists(manifest_filename)
+
+   reused_nodes_by_path = prepare(testing_tree, manifest_filename)
+   assert reused_paths(reused_nodes_by_path) \
+      == set(test_nodes_by_path.keys())
+
+   assert build_graph(reused_nodes_by_path) \
+      == build_graph(prepare(testing_tree, None))
+
+def test_changed_file_invalidates_its_subtree(testing_tree, tmp_path):
+
+   manifest_filename = str(tmp_path / "manifest.pkl")
+
+   test_nodes_by_path = prepare(testing_tree, manifest_filename)
+
+   path = node_with_driver(test_nodes_by_path, testing_tree)
+   assert path
+
+   with open(test_nodes_by_path[path].python_driver.filename, "a") as stream:
+      stream.write("# changed\n")
+
+   reused_nodes_by_path = prepare(testing_tree, manifest_filename)
+
+   subtree = set(other_path for other_path in test_nodes_by_path.keys()
+                 if other_path == path 
+                 or other_path.startswith(path + os.sep))
+
+   assert reused_paths(reused_nodes_by_path) \
+      == set(test_nodes_by_path.keys()) - subtree
+
+   assert build_graph(reused_nodes_by_path) \
+      == build_graph(prepare(testing_tree, None))
+
+def test_replaced_file_with_same_size_and_time_is_detected(testing_tree,
+                                                           tmp_path):
+
+   manifest_filename = str(tmp_path / "manifest.pkl")
+
+   test_nodes_by_path = prepare(testing_tree, manifest_filename)
+
+   path = node_with_driver(test_nodes_by_path, testing_tree)
+   driver = test_nodes_by_path[path].python_driver.filename
+
+   with open(driver, "rb") as stream:
+      content = stream.read()
+
+   stat = os.stat(driver)
+
+   # Same size and modification time, but another inode
+   #
+   replacement = driver + ".new"
+   new_content = content.replace(b"#", b"$", 1)
+   assert new_content != content
+
+   with open(replacement, "wb") as stream:
+      stream.write(new_content)
+   os.utime(replacement, ns = (stat.st_atime_ns, stat.st_mtime_ns))
+   os.replace(replacement, driver)
+
+   assert os.stat(driver).st_size == stat.st_size
+
+   reused_nodes_by_path = prepare(testing_tree, manifest_filename)
+
+   assert path not in reused_paths(reused_nodes_by_path)
+
+def test_new_directory_is_set_up(testing_tree, tmp_path):
+
+   manifest_filename = str(tmp_path / "manifest.pkl")
+
+   test_nodes_by_path = prepare(testing_tree, manifest_filename)
+
+   new_path = os.path.join(testing_tree, "new_node")
+   os.mkdir(new_path)
+
+   reused_nodes_by_path = prepare(testing_tree, manifest_filename)
+
+   assert new_path in reused_nodes_by_path
+   assert testing_tree not in reused_paths(reused_nodes_by_path)
+
+   assert build_graph(reused_nodes_by_path) \
+      == build_graph(prepare(testing_tree, None))
+
+def test_manifest_of_other_trees_is_ignored(testing_tree, tmp_path):
+
+   manifest_filename = str(tmp_path / "manifest.pkl")
+
+   prepare(testing_tree, manifest_filename)
+
+   testing_tree_roots = prepare_testing.testing_tree_root_list(
+                           [(testing_tree, "prefix")])
+
+   assert prepare_testing.load_tree_manifest(manifest_filename, 
+                                             testing_tree_roots) is None
+
+def test_unreadable_manifest_is_ignored(testing_tree, tmp_path):
+
+   manifest_filename = str(tmp_path / "manifest.pkl")
+
+   with open(manifest_filename, "wb") as stream:
+      stream.write(b"garbage")
+
+   test_nodes_by_path = prepare(testing_tree, manifest_filename)
+
+   assert reused_paths(test_nodes_by_path) == set()
+
+   assert reused_paths(prepare(testing_tree, manifest_filename)) \
+      == set(test_nodes_by_path.keys())
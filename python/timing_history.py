@@ -0,0 +1,493 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script maintains a history of the durations of
+# firmware builds and test runs in an SQLite database.
+#
+# Firmware builds are identified by their firmware digest, tests by
+# their global name (see TestNode.generateGlobalName in
+# prepare_testing.py). For every run, the duration, the exit status
+# and the peak memory usage are recorded. Only the most recent runs
+# of every build and test are kept. Additionally, a rollup with an
+# exponentially weighted moving average (EWMA) and the 95th percentile
+# of the durations is maintained.
+#
+# The build system runs firmware builds and tests through this script
+# to record them, e.g.
+#
+#   timing_history.py -d <database> run_test --name <test name> \
+#      -- <command>
+#
+# The recorded durations can be inspected with the "show" command and
+# exported as costs that are used to balance shards (see the command
+# line option --shard_costs of prepare_testing.py).
+
+import argparse
+import sys
+import os
+import json
+import time
+import sqlite3
+import subprocess
+
+try:
+   import resource
+except ImportError:
+   resource = None
+
+# Kinds of records
+#
+kind_build = "build"
+kind_test = "test"
+
+# The weight of the most recent duration in the EWMA
+#
+ewma_alpha = 0.3
+
+# The number of most recent runs that are kept per build or test
+#
+default_max_runs = 50
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+   id INTEGER PRIMARY KEY,
+   kind TEXT NOT NULL,
+   key TEXT NOT NULL,
+   firmware_digest TEXT,
+   started REAL NOT NULL,
+   duration REAL NOT NULL,
+   exit_status INTEGER,
+   peak_memory_kb INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_by_key ON runs (kind, key, started);
+CREATE TABLE IF NOT EXISTS rollups (
+   kind TEXT NOT NULL,
+   key TEXT NOT NULL,
+   firmware_digest TEXT,
+   n_runs INTEGER NOT NULL,
+   n_failures INTEGER NOT NULL,
+   ewma_duration REAL NOT NULL,
+   p95_duration REAL NOT NULL,
+   last_duration REAL NOT NULL,
+   last_exit_status INTEGER,
+   max_peak_memory_kb INTEGER,
+   updated REAL NOT NULL,
+   PRIMARY KEY (kind, key)
+);
+"""
+
+rollup_columns = ["kind", "key", "firmware_digest", "n_runs", "n_failures",
+                  "ewma_duration", "p95_duration", "last_duration",
+                  "last_exit_status", "max_peak_memory_kb", "updated"]
+
+# Returns the p-th percentile of a list of values (nearest rank)
+#
+def percentile(values, p):
+
+   if not values:
+      return 0.0
+
+   values = sorted(values)
+   rank = max(1, -(-len(values) * p // 100))
+
+   return values[int(rank) - 1]
+
+# Converts a maximum resident set size as reported by getrusage to kB
+#
+def max_rss_kb(max_rss):
+
+   # macOS reports bytes instead of kilobytes
+   #
+   if sys.platform == "darwin":
+      return max_rss // 1024
+
+   return max_rss
+
+# Returns the peak memory usage of all terminated child processes in kB
+#
+def children_peak_memory_kb():
+
+   if not resource:
+      return None
+
+   return max_rss_kb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+# Checks if a file is an SQLite database
+#
+def is_history_file(filename):
+   try:
+      with open(filename, "rb") as stream:
+         return stream.read(16) == b"SQLite format 3\x00"
+   except OSError:
+      return False
+
+class TimingHistory(object):
+
+   def __init__(self, filename, max_runs = default_max_runs):
+
+      self.max_runs = max_runs
+
+      # Many tests may record concurrently, e.g. when run by ctest -j.
+      #
+      self.connection = sqlite3.connect(filename, timeout = 60)
+      self.connection.execute("PRAGMA journal_mode=WAL")
+      self.connection.executescript(schema)
+
+   def close(self):
+      self.connection.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   # Records a run and updates the rollup of the build or test
+   #
+   def record(self, kind, key, duration,
+              exit_status = None,
+              peak_memory_kb = None,
+              firmware_digest = None,
+              started = None):
+
+      if started is None:
+         started = time.time() - duration
+
+      with self.connection:
+
+         # Serialize concurrent writers of the same rollup
+         #
+         self.connection.execute("BEGIN IMMEDIATE")
+
+         self.connection.execute(
+            "INSERT INTO runs (kind, key, firmware_digest, started, "
+            "duration, exit_status, peak_memory_kb) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, key, firmware_digest, started, duration, exit_status,
+             peak_memory_kb))
+
+         # Drop runs beyond the retention window
+         #
+         self.connection.execute(
+            "DELETE FROM runs WHERE kind = ? AND key = ? AND id NOT IN "
+            "(SELECT id FROM runs WHERE kind = ? AND key = ? "
+            "ORDER BY started DESC, id DESC LIMIT ?)",
+            (kind, key, kind, key, self.max_runs))
+
+         durations = [row[0] for row in self.connection.execute(
+            "SELECT duration FROM runs WHERE kind = ? AND key = ?",
+            (kind, key))]
+
+         previous = self.connection.execute(
+            "SELECT n_runs, n_failures, ewma_duration, max_peak_memory_kb "
+            "FROM rollups WHERE kind = ? AND key = ?",
+            (kind, key)).fetchone()
+
+         failed = int(exit_status not in (None, 0))
+
+         if previous:
+            n_runs = previous[0] + 1
+            n_failures = previous[1] + failed
+            ewma_duration = ewma_alpha * duration \
+                            + (1.0 - ewma_alpha) * previous[2]
+            max_peak_memory_kb = max(x for x in (previous[3], peak_memory_kb,
+                                                 0) if x is not None)
+         else:
+            n_runs = 1
+            n_failures = failed
+            ewma_duration = duration
+            max_peak_memory_kb = peak_memory_kb
+
+         self.connection.execute(
+            "INSERT OR REPLACE INTO rollups (" + ", ".join(rollup_columns)
+            + ") VALUES (" + ", ".join(["?"] * len(rollup_columns)) + ")",
+            (kind, key, firmware_digest, n_runs, n_failures, ewma_duration,
+             percentile(durations, 95), duration, exit_status,
+             max_peak_memory_kb, time.time()))
+
+   def recordBuild(self, firmware_digest, duration, **kwargs):
+      self.record(kind_build, firmware_digest, duration,
+                  firmware_digest = firmware_digest, **kwargs)
+
+   def recordTest(self, test_name, duration, **kwargs):
+      self.record(kind_test, test_name, duration, **kwargs)
+
+   # Returns the rollup of a build or test as a dict or None
+   #
+   def rollup(self, kind, key):
+
+      row = self.connection.execute(
+         "SELECT " + ", ".join(rollup_columns)
+         + " FROM rollups WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+
+      if not row:
+         return None
+
+      return dict(zip(rollup_columns, row))
+
+   # Returns the rollups of all builds and/or tests, ordered by
+   # decreasing EWMA
+   #
+   def rollups(self, kind = None):
+
+      query = "SELECT " + ", ".join(rollup_columns) + " FROM rollups"
+      parameters = ()
+      if kind:
+         query += " WHERE kind = ?"
+         parameters = (kind,)
+      query += " ORDER BY ewma_duration DESC, key"
+
+      return [dict(zip(rollup_columns, row))
+              for row in self.connection.execute(query, parameters)]
+
+   # Returns the recorded runs of a build or test, most recent first
+   #
+   def runs(self, kind, key):
+
+      columns = ["started", "duration", "exit_status", "peak_memory_kb"]
+
+      return [dict(zip(columns, row)) for row in self.connection.execute(
+         "SELECT " + ", ".join(columns) + " FROM runs "
+         "WHERE kind = ? AND key = ? ORDER BY started DESC, id DESC",
+         (kind, key))]
+
+   # Returns the EWMA durations in the format of the shard costs
+   # of prepare_testing.py
+   #
+   def exportCosts(self):
+
+      costs = { "firmware_builds" : {}, "tests" : {} }
+
+      for rollup in self.rollups():
+         if rollup["kind"] == kind_build:
+            costs["firmware_builds"][rollup["key"]] = rollup["ewma_duration"]
+         else:
+            costs["tests"][rollup["key"]] = rollup["ewma_duration"]
+
+      return costs
+
+# Runs a command and records its duration, exit status and peak
+# memory usage. Returns the exit status of the command.
+#
+def run_and_record(history_filename, kind, key, command,
+                   firmware_digest = None):
+
+   started = time.time()
+   start_time = time.monotonic()
+
+   try:
+      exit_status = subprocess.call(command)
+   except OSError as exc:
+      sys.stderr.write("Unable to run \"%s\": %s\n" % (command[0], exc))
+      exit_status = 127
+
+   duration = time.monotonic() - start_time
+
+   # A broken history must never fail a build or test
+   #
+   try:
+      with TimingHistory(history_filename) as history:
+         history.record(kind, key, duration,
+                        exit_status = exit_status,
+                        peak_memory_kb = children_peak_memory_kb(),
+                        firmware_digest = firmware_digest,
+                        started = started)
+   except sqlite3.Error as exc:
+      sys.stderr.write("Unable to record timing in \"%s\": %s\n"
+                       % (history_filename, exc))
+
+   return exit_status
+
+def format_rollup(rollup):
+
+   memory = "-"
+   if rollup["max_peak_memory_kb"]:
+      memory = "%.1f MB" % (rollup["max_peak_memory_kb"] / 1024.0)
+
+   return "%-5s  %8.2f s  %8.2f s  %4d  %4d  %9s  %s" \
+      % (rollup["kind"], rollup["ewma_duration"], rollup["p95_duration"],
+         rollup["n_runs"], rollup["n_failures"], memory, rollup["key"])
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool records and reports the durations of firmware builds "
+       "and tests.")
+
+    parser.add_argument('-d', '--database',
+      metavar  = 'file',
+      dest     = 'database',
+      required = True,
+      help     = 'The SQLite database that stores the history'
+    )
+
+    subparsers = parser.add_subparsers(dest = 'command')
+    subparsers.required = True
+
+    run_build_parser = subparsers.add_parser('run_build',
+       help = 'Run and record a firmware build')
+    run_build_parser.add_argument('--digest',
+      dest     = 'digest',
+      required = True,
+      help     = 'The firmware digest'
+    )
+
+    run_test_parser = subparsers.add_parser('run_test',
+       help = 'Run and record a test')
+    run_test_parser.add_argument('--name',
+      dest     = 'name',
+      required = True,
+      help     = 'The global name of the test'
+    )
+    run_test_parser.add_argument('--firmware_digest',
+      dest     = 'firmware_digest',
+      help     = 'The digest of the firmware the test uses'
+    )
+
+    for run_parser in (run_build_parser, run_test_parser):
+       run_parser.add_argument('run_command',
+         metavar  = 'command',
+         nargs    = argparse.REMAINDER,
+         help     = 'The command to run (after --)'
+       )
+
+    record_parser = subparsers.add_parser('record',
+       help = 'Record a run that was timed elsewhere')
+    record_parser.add_argument('--kind',
+      dest     = 'kind',
+      choices  = [kind_build, kind_test],
+      required = True
+    )
+    record_parser.add_argument('--key',
+      dest     = 'key',
+      required = True,
+      help     = 'The firmware digest or the global name of the test'
+    )
+    record_parser.add_argument('--duration',
+      dest     = 'duration',
+      type     = float,
+      required = True,
+      help     = 'The duration in seconds'
+    )
+    record_parser.add_argument('--exit_status',
+      dest     = 'exit_status',
+      type     = int
+    )
+    record_parser.add_argument('--peak_memory_kb',
+      dest     = 'peak_memory_kb',
+      type     = int
+    )
+
+    show_parser = subparsers.add_parser('show',
+       help = 'Show the rollups of builds and tests')
+    show_parser.add_argument('--kind',
+      dest     = 'kind',
+      choices  = [kind_build, kind_test]
+    )
+    show_parser.add_argument('--key',
+      dest     = 'key',
+      help     = 'Show the individual runs of a build or test'
+    )
+    show_parser.add_argument('--limit',
+      dest     = 'limit',
+      type     = int,
+      help     = 'Show only the slowest builds and tests'
+    )
+    show_parser.add_argument('--json',
+      dest     = 'json',
+      action   = 'store_true',
+      help     = 'Write JSON instead of a table'
+    )
+
+    export_parser = subparsers.add_parser('export_costs',
+       help = 'Export the EWMA durations as shard costs '
+              '(see prepare_testing.py --shard_costs)')
+    export_parser.add_argument('-o', '--output',
+      dest     = 'output',
+      required = True,
+      help     = 'The JSON output file'
+    )
+
+    args = parser.parse_args()
+
+    if args.command in ('run_build', 'run_test'):
+
+       command = args.run_command
+       if command and command[0] == "--":
+          command = command[1:]
+       if not command:
+          sys.exit("No command specified.")
+
+       if args.command == 'run_build':
+          sys.exit(run_and_record(args.database, kind_build, args.digest,
+                                  command, args.digest))
+
+       sys.exit(run_and_record(args.database, kind_test, args.name,
+                               command, args.firmware_digest))
+
+    with TimingHistory(args.database) as history:
+
+       if args.command == 'record':
+          history.record(args.kind, args.key, args.duration,
+                         exit_status = args.exit_status,
+                         peak_memory_kb = args.peak_memory_kb)
+
+       elif args.command == 'show':
+
+          if args.key:
+             kinds = [args.kind] if args.kind else [kind_build, kind_test]
+             runs = []
+             for kind in kinds:
+                runs += history.runs(kind, args.key)
+             if args.json:
+                json.dump(runs, sys.stdout, indent = 3)
+                sys.stdout.write("\n")
+             else:
+                for run in runs:
+                   sys.stdout.write("%s  %8.2f s  exit %s  %s kB\n"
+                      % (time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(run["started"])),
+                         run["duration"], run["exit_status"],
+                         run["peak_memory_kb"]))
+             return
+
+          rollups = history.rollups(args.kind)
+          if args.limit:
+             rollups = rollups[:args.limit]
+
+          if args.json:
+             json.dump(rollups, sys.stdout, indent = 3)
+             sys.stdout.write("\n")
+          else:
+             sys.stdout.write("%-5s  %10s  %10s  %4s  %4s  %9s  %s\n"
+                % ("kind", "ewma", "p95", "runs", "fail", "peak mem",
+                   "digest/name"))
+             for rollup in rollups:
+                sys.stdout.write(format_rollup(rollup) + "\n")
+
+       elif args.command == 'export_costs':
+          with open(args.output, "w") as stream:
+             json.dump(history.exportCosts(), stream, indent = 3)
+             stream.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,557 @@
+#!/usr/bin/python
+
+# -*- mode: python -*-
+# Leidokos-Testing -- Testing framework for the Kaleidoscope firmware
+# Copyright (C) 2017 noseglasses (shinynoseglasses@github.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+
+# This python script implements the watch mode of prepare_testing.py
+# (command line option --watch) and a client that queries a running
+# watch daemon.
+#
+# The daemon keeps the testing tree in memory. Every directory of the
+# tree and every __external__ directory is watched with inotify
+# (Linux only). Changes are collected until no further change
+# arrives for a short settle time. Then only the changed directories
+# are patched into the tree and the exports are regenerated (see
+# WatchedTestingTree in prepare_testing.py).
+#
+# Queries are answered via a Unix domain socket. Every request and
+# every response is a single line of JSON, e.g.
+#
+#    {"query": "firmware_build", "test": "MyModule.test1"}
+#    {"query": "tests", "path": "subdir"}
+#    {"query": "status"}
+#    {"query": "stop"}
+#
+# Changes and queries are processed by a single thread, i.e. queries
+# always see a consistent tree.
+#
+# Example client usage:
+#
+#    watch_daemon.py -s testing.socket firmware_build MyModule.test1
+#    watch_daemon.py -s testing.socket tests subdir
+
+import argparse
+import sys
+import os
+import json
+import errno
+import socket
+import stat
+import struct
+import selectors
+import signal
+import time
+
+# The time (in seconds) without further changes before the tree
+# is updated. Editors and version control tools usually change
+# several files in a row.
+#
+default_settle_time = 0.05
+
+# Inotify constants from <sys/inotify.h>
+#
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0o2000000
+
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM \
+           | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF \
+           | IN_MOVE_SELF | IN_ONLYDIR
+
+inotify_event_header = struct.Struct("iIII")
+
+# A thin wrapper of the Linux inotify API. The C library is accessed
+# via ctypes as the Python standard library does not support inotify.
+#
+class Inotify(object):
+
+   def __init__(self):
+
+      import ctypes
+      import ctypes.util
+
+      self.libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                              use_errno = True)
+
+      if not hasattr(self.libc, "inotify_init1"):
+         raise OSError(errno.ENOSYS, "inotify is not supported on this "
+                       "platform")
+
+      self.get_errno = ctypes.get_errno
+
+      self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+      if self.fd < 0:
+         self.raiseError("inotify_init1")
+
+   def raiseError(self, function, path = None):
+      error = self.get_errno()
+      raise OSError(error, "%s: %s" % (function, os.strerror(error)), path)
+
+   def fileno(self):
+      return self.fd
+
+   # Returns the watch descriptor. Watching the same directory via
+   # different paths (e.g. symbolic links) returns the same
+   # descriptor.
+   #
+   def addWatch(self, path, mask = watch_mask):
+
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+      if wd < 0:
+         self.raiseError("inotify_add_watch", path)
+      return wd
+
+   def removeWatch(self, wd):
+      self.libc.inotify_rm_watch(self.fd, wd)
+
+   # Reads all pending events. Returns a list of tuples
+   # (watch descriptor, mask, name). The name is empty for events
+   # that concern the watched directory itself.
+   #
+   def readEvents(self):
+
+      events = []
+
+      while True:
+
+         try:
+            data = os.read(self.fd, 1 << 16)
+         except BlockingIOError:
+            break
+
+         offset = 0
+         while offset < len(data):
+            wd, mask, cookie, length \
+               = inotify_event_header.unpack_from(data, offset)
+            offset += inotify_event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+
+      return events
+
+   def close(self):
+      os.close(self.fd)
+
+# Maintains the inotify watches of a set of directories
+#
+class DirectoryWatcher(object):
+
+   def __init__(self, inotify, report):
+
+      self.inotify = inotify
+      self.report = report
+
+      # A directory might be watched via several paths
+      #
+      self.paths_by_wd = {}
+      self.wds_by_path = {}
+
+      self.watch_limit_reported = False
+
+   def add(self, path):
+
+      if path in self.wds_by_path:
+         return
+
+      try:
+         wd = self.inotify.addWatch(path)
+      except OSError as error:
+
+         # Directories might have vanished in the meantime. Those are
+         # handled by the events of their parent directories.
+         #
+         if error.errno == errno.ENOSPC and not self.watch_limit_reported:
+            self.report("The inotify watch limit is exhausted. Changes "
+                        "of some directories are not recognized. The limit "
+                        "can be increased via "
+                        "/proc/sys/fs/inotify/max_user_watches\n")
+            self.watch_limit_reported = True
+         return
+
+      self.wds_by_path[path] = wd
+      self.paths_by_wd.setdefault(wd, []).append(path)
+
+   def remove(self, path):
+
+      wd = self.wds_by_path.pop(path, None)
+      if wd is None:
+         return
+
+      paths = self.paths_by_wd[wd]
+      paths.remove(path)
+
+      if not paths:
+         del self.paths_by_wd[wd]
+         self.inotify.removeWatch(wd)
+
+   # Is called when the kernel removed a watch, e.g. because the
+   # directory was deleted
+   #
+   def forget(self, wd):
+
+      for path in self.paths_by_wd.pop(wd, []):
+         del self.wds_by_path[path]
+
+   def getPaths(self, wd):
+      return self.paths_by_wd.get(wd, ())
+
+# A client connection of the query server. Requests are read
+# without blocking. Responses are written blocking with a timeout.
+#
+class QueryConnection(object):
+
+   def __init__(self, connection):
+      self.connection = connection
+      self.connection.settimeout(5.0)
+      self.buffer = b""
+
+# Answers queries about the watched testing tree via a Unix
+# domain socket
+#
+class QueryServer(object):
+
+   def __init__(self, socket_filename, tree, selector):
+
+      self.socket_filename = socket_filename
+      self.tree = tree
+      self.selector = selector
+
+      self.stop_requested = False
+
+      # A stale socket file of a daemon that is not running anymore
+      # is replaced
+      #
+      if os.path.exists(socket_filename):
+
+         if not stat.S_ISSOCK(os.stat(socket_filename).st_mode):
+            raise OSError(errno.EEXIST, "\"%s\" exists and is not a socket"
+                          % socket_filename)
+         try:
+            query(socket_filename, { "query" : "status" })
+         except OSError:
+            os.unlink(socket_filename)
+         else:
+            raise OSError(errno.EADDRINUSE, "A watch daemon is already "
+                          "listening at \"%s\"" % socket_filename)
+
+      self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.listener.bind(socket_filename)
+      self.listener.listen(16)
+      self.listener.setblocking(False)
+
+      self.selector.register(self.listener, selectors.EVENT_READ,
+                             self.accept)
+
+   def accept(self):
+
+      try:
+         connection, address = self.listener.accept()
+      except BlockingIOError:
+         return
+
+      query_connection = QueryConnection(connection)
+
+      self.selector.register(connection, selectors.EVENT_READ,
+                             lambda: self.receive(query_connection))
+
+   def disconnect(self, query_connection):
+      self.selector.unregister(query_connection.connection)
+      query_connection.connection.close()
+
+   def receive(self, query_connection):
+
+      try:
+         data = query_connection.connection.recv(1 << 16)
+      except OSError:
+         data = None
+
+      if not data:
+         self.disconnect(query_connection)
+         return
+
+      query_connection.buffer += data
+
+      while b"\n" in query_connection.buffer:
+
+         line, query_connection.buffer \
+            = query_connection.buffer.split(b"\n", 1)
+
+         response = self.answer(line)
+
+         try:
+            query_connection.connection.sendall(
+               json.dumps(response).encode("utf-8") + b"\n")
+         except OSError:
+            self.disconnect(query_connection)
+            return
+
+   def answer(self, line):
+
+      try:
+         request = json.loads(line.decode("utf-8"))
+      except ValueError as error:
+         return { "error" : "Invalid request: %s" % error }
+
+      if not isinstance(request, dict):
+         return { "error" : "Invalid request: a JSON object is expected" }
+
+      if request.get("query") == "stop":
+         self.stop_requested = True
+         return {}
+
+      return self.tree.query(request)
+
+   def close(self):
+
+      self.selector.unregister(self.listener)
+      self.listener.close()
+
+      if os.path.exists(self.socket_filename):
+         os.unlink(self.socket_filename)
+
+# Collects the paths of directories whose content changed since the
+# last update
+#
+class PendingChanges(object):
+
+   def __init__(self):
+      self.paths = set()
+
+      # The time when the last change was registered. None if
+      # there were no changes since the last update attempt.
+      #
+      self.last_change_time = None
+
+   def add(self, path):
+      self.paths.add(path)
+      self.last_change_time = time.monotonic()
+
+class StopWatching(Exception):
+   pass
+
+def raise_stop_watching(signum, frame):
+   raise StopWatching()
+
+# Watches the testing tree and keeps it up to date until the daemon
+# is stopped by a stop query, SIGTERM or SIGINT.
+#
+# tree is an instance of prepare_testing.WatchedTestingTree. Queries
+# are answered if a socket filename is passed.
+#
+def watch(tree,
+          socket_filename = None,
+          settle_time = default_settle_time,
+          report = sys.stdout.write):
+
+   inotify = Inotify()
+
+   watcher = DirectoryWatcher(inotify, report)
+   for path in tree.watchedDirectories():
+      watcher.add(path)
+
+   changes = PendingChanges()
+
+   def read_events():
+
+      for wd, mask, name in inotify.readEvents():
+
+         if mask & IN_Q_OVERFLOW:
+
+            # Events were lost. The complete tree is checked.
+            #
+            changes.add(tree.testing_tree_root)
+            continue
+
+         if mask & IN_IGNORED:
+            watcher.forget(wd)
+            continue
+
+         for path in watcher.getPaths(wd):
+            if (not name) \
+                  or tree.isRelevantChange(path, name,
+                                           bool(mask & IN_ISDIR)):
+               changes.add(path)
+
+   selector = selectors.DefaultSelector()
+   selector.register(inotify, selectors.EVENT_READ, read_events)
+
+   server = None
+
+   previous_signal_handler = signal.signal(signal.SIGTERM,
+                                           raise_stop_watching)
+   try:
+
+      if socket_filename:
+         server = QueryServer(socket_filename, tree, selector)
+
+      report("Watching %d directories of testing tree \"%s\"\n"
+             % (len(watcher.wds_by_path), tree.testing_tree_root))
+
+      while not (server and server.stop_requested):
+
+         timeout = None
+         if changes.last_change_time is not None:
+            timeout = max(0.0, changes.last_change_time + settle_time
+                                  - time.monotonic())
+
+         for key, mask in selector.select(timeout):
+            key.data()
+
+         if (changes.last_change_time is None) \
+               or (time.monotonic() < changes.last_change_time
+                                         + settle_time):
+            continue
+
+         changes.last_change_time = None
+
+         watch_changes = tree.update(changes.paths)
+
+         # Changes that could not be applied are applied together
+         # with the next change
+         #
+         if watch_changes is None:
+            continue
+
+         changes.paths.clear()
+
+         watched_paths, unwatched_paths = watch_changes
+
+         for path in unwatched_paths:
+            watcher.remove(path)
+         for path in watched_paths:
+            watcher.add(path)
+
+   except (StopWatching, KeyboardInterrupt):
+      pass
+
+   finally:
+      signal.signal(signal.SIGTERM, previous_signal_handler)
+
+      if server:
+         server.close()
+
+      selector.close()
+      inotify.close()
+
+   report("Stopped watching testing tree \"%s\"\n" % tree.testing_tree_root)
+
+# A connection to a watch daemon that can be used for several queries
+#
+class QueryClient(object):
+
+   def __init__(self, socket_filename, timeout = 10.0):
+
+      self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.connection.settimeout(timeout)
+      self.connection.connect(socket_filename)
+
+      self.buffer = b""
+
+   def query(self, request):
+
+      self.connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+      while b"\n" not in self.buffer:
+         data = self.connection.recv(1 << 16)
+         if not data:
+            raise ConnectionError("The watch daemon closed the connection")
+         self.buffer += data
+
+      line, self.buffer = self.buffer.split(b"\n", 1)
+
+      return json.loads(line.decode("utf-8"))
+
+   def close(self):
+      self.connection.close()
+
+# Sends a single query to a watch daemon and returns the response
+#
+def query(socket_filename, request):
+
+   client = QueryClient(socket_filename)
+   try:
+      return client.query(request)
+   finally:
+      client.close()
+
+def main():
+
+    parser = argparse.ArgumentParser(
+       description =
+       "This tool queries a watch daemon that was started by "
+       "prepare_testing.py --watch.")
+
+    parser.add_argument('-s', '--socket',
+      metavar  = 'file',
+      dest     = 'socket',
+      required = True,
+      help     = 'The Unix domain socket of the watch daemon '
+                 '(prepare_testing.py --watch_socket)'
+    )
+
+    parser.add_argument('query',
+      choices  = [ 'firmware_build', 'tests', 'status', 'stop' ],
+      help     = 'firmware_build: the firmware build of a test, '
+                 'tests: the tests below a path, '
+                 'status: information about the testing tree, '
+                 'stop: stop the daemon'
+    )
+
+    parser.add_argument('argument',
+      nargs    = '?',
+      help     = 'The test name (firmware_build) or the path relative '
+                 'to the testing tree root (tests)'
+    )
+
+    args = parser.parse_args()
+
+    request = { "query" : args.query }
+    if args.query == "firmware_build":
+       request["test"] = args.argument
+    elif args.query == "tests":
+       request["path"] = args.argument
+
+    try:
+       response = query(args.socket, request)
+    except OSError as error:
+       sys.exit("Unable to query the watch daemon at \"%s\": %s"
+                % (args.socket, error))
+
+    json.dump(response, sys.stdout, indent = 3)
+    sys.stdout.write("\n")
+
+    if "error" in response:
+       sys.exit(1)
+
+if __name__ == "__main__":
+    main()